@@ -0,0 +1,150 @@
+import numpy as np
+
+#
+#   Vectorized color conversions used to match image pixels against emoji colors
+#   everything here works on whole (..., 3) arrays so we never have to loop per pixel
+#
+
+# Rec. 709 luminance weights of the legacy color distance
+LUMINANCE_WEIGHTS = np.array([0.2126, 0.7152, 0.0722], dtype=np.float32)
+# The legacy distance multiplies the luminance difference by 3 to emphasize it
+LUMINANCE_EMPHASIS = 3.0
+
+def srgb_to_linear(rgb):
+    """sRGB (0-255) to linear RGB (0-1) for any array with a trailing channel axis of 3"""
+    c = np.asarray(rgb, dtype=np.float32) / 255.0
+    return np.where(c > 0.04045, ((c + 0.055) / 1.055) ** 2.4, c / 12.92).astype(np.float32)
+
+def rgb_to_match_features(rgb):
+    """
+    Converts sRGB colors to the 4D space ([r, g, b, 3 * luminance], linear RGB)
+    in which plain euclidean distance equals the legacy color distance.
+    Args:
+        rgb (array-like): (..., 3) colors in 0-255
+    Returns:
+        np.ndarray: (..., 4) float32 features
+    """
+    linear = srgb_to_linear(rgb)
+    luminance = (linear @ LUMINANCE_WEIGHTS) * LUMINANCE_EMPHASIS
+    return np.concatenate([linear, luminance[..., None]], axis=-1).astype(np.float32)
+
+def pack_rgb(rgb):
+    """Packs (..., 3) uint8 colors in to single uint32 keys (handy for np.unique)"""
+    rgb = np.asarray(rgb, dtype=np.uint32)
+    return (rgb[..., 0] << 16) | (rgb[..., 1] << 8) | rgb[..., 2]
+
+def unpack_rgb(keys):
+    """Inverse of pack_rgb"""
+    keys = np.asarray(keys, dtype=np.uint32)
+    return np.stack([(keys >> 16) & 0xFF, (keys >> 8) & 0xFF, keys & 0xFF], axis=-1).astype(np.uint8)
+
+#
+#   Perceptual color spaces, matching can use these instead of the luminance weighted RGB above
+#
+
+# Distance modes we can match with, and the space every one of them is computed in
+#   legacy      euclidean in rgb_to_match_features space (same as ImageToEmojiConverter used to do)
+#   oklab       euclidean in OKLab
+#   ciede2000   CIEDE2000 on CIELAB (euclidean CIELAB to find candidates, CIEDE2000 to pick between them)
+DISTANCE_MODES = ("legacy", "oklab", "ciede2000")
+
+# Distances of every mode get multiplied by these so black to white is about as far apart in every mode,
+# that way thresholds and penalties (e.g. the edge contrast threshold) mean the same thing for every mode
+DISTANCE_SCALE = {
+    "legacy": 1.0,
+    "oklab": float(np.sqrt(12.0)),
+    "ciede2000": float(np.sqrt(12.0)) / 100.0,
+}
+
+# sRGB (linear) to LMS, and LMS' to OKLab (https://bottosson.github.io/posts/oklab/)
+_OKLAB_M1 = np.array([[0.4122214708, 0.5363325363, 0.0514459929],
+                      [0.2119034982, 0.6806995451, 0.1073969566],
+                      [0.0883024619, 0.2817188376, 0.6299787005]], dtype=np.float32)
+_OKLAB_M2 = np.array([[0.2104542553, 0.7936177850, -0.0040720468],
+                      [1.9779984951, -2.4285922050, 0.4505937099],
+                      [0.0259040371, 0.7827717662, -0.8086757660]], dtype=np.float32)
+
+# sRGB (linear) to XYZ, D65 white point
+_XYZ_M = np.array([[0.4124564, 0.3575761, 0.1804375],
+                   [0.2126729, 0.7151522, 0.0721750],
+                   [0.0193339, 0.1191920, 0.9503041]], dtype=np.float32)
+_D65_WHITE = np.array([0.95047, 1.0, 1.08883], dtype=np.float32)
+
+def srgb_to_oklab(rgb):
+    """sRGB (0-255) to OKLab for any (..., 3) array, returns float32 (L is 0-1)"""
+    lms = srgb_to_linear(rgb) @ _OKLAB_M1.T
+    return (np.cbrt(lms) @ _OKLAB_M2.T).astype(np.float32)
+
+def srgb_to_cielab(rgb):
+    """sRGB (0-255) to CIELAB (D65) for any (..., 3) array, returns float32 (L is 0-100)"""
+    xyz = (srgb_to_linear(rgb) @ _XYZ_M.T) / _D65_WHITE
+    f = np.where(xyz > (6 / 29) ** 3, np.cbrt(xyz), xyz / (3 * (6 / 29) ** 2) + 4 / 29)
+    lab = np.stack([116 * f[..., 1] - 16, 500 * (f[..., 0] - f[..., 1]), 200 * (f[..., 1] - f[..., 2])], axis=-1)
+    return lab.astype(np.float32)
+
+def ciede2000(lab1, lab2):
+    """
+    CIEDE2000 color difference between CIELAB colors, vectorized and broadcasting like any numpy operation.
+    Follows Sharma, Wu and Dalal, "The CIEDE2000 Color-Difference Formula: Implementation Notes" (2005)
+    """
+    lab1 = np.asarray(lab1, dtype=np.float64)
+    lab2 = np.asarray(lab2, dtype=np.float64)
+    L1, a1, b1 = lab1[..., 0], lab1[..., 1], lab1[..., 2]
+    L2, a2, b2 = lab2[..., 0], lab2[..., 1], lab2[..., 2]
+
+    C_mean = (np.hypot(a1, b1) + np.hypot(a2, b2)) / 2
+    G = 0.5 * (1 - np.sqrt(C_mean ** 7 / (C_mean ** 7 + 25.0 ** 7)))
+    a1p = (1 + G) * a1
+    a2p = (1 + G) * a2
+    C1p = np.hypot(a1p, b1)
+    C2p = np.hypot(a2p, b2)
+    h1p = np.degrees(np.arctan2(b1, a1p)) % 360
+    h2p = np.degrees(np.arctan2(b2, a2p)) % 360
+
+    dLp = L2 - L1
+    dCp = C2p - C1p
+    chroma_zero = (C1p * C2p) == 0
+    dhp = h2p - h1p
+    dhp = np.where(dhp > 180, dhp - 360, np.where(dhp < -180, dhp + 360, dhp))
+    dhp = np.where(chroma_zero, 0, dhp)
+    dHp = 2 * np.sqrt(C1p * C2p) * np.sin(np.radians(dhp) / 2)
+
+    Lp_mean = (L1 + L2) / 2
+    Cp_mean = (C1p + C2p) / 2
+    h_sum = h1p + h2p
+    hp_mean = np.where(np.abs(h1p - h2p) > 180, np.where(h_sum < 360, h_sum + 360, h_sum - 360), h_sum) / 2
+    hp_mean = np.where(chroma_zero, h_sum, hp_mean)
+
+    T = (1 - 0.17 * np.cos(np.radians(hp_mean - 30)) + 0.24 * np.cos(np.radians(2 * hp_mean))
+         + 0.32 * np.cos(np.radians(3 * hp_mean + 6)) - 0.20 * np.cos(np.radians(4 * hp_mean - 63)))
+    d_theta = 30 * np.exp(-(((hp_mean - 275) / 25) ** 2))
+    R_C = 2 * np.sqrt(Cp_mean ** 7 / (Cp_mean ** 7 + 25.0 ** 7))
+    S_L = 1 + 0.015 * (Lp_mean - 50) ** 2 / np.sqrt(20 + (Lp_mean - 50) ** 2)
+    S_C = 1 + 0.045 * Cp_mean
+    S_H = 1 + 0.015 * Cp_mean * T
+    R_T = -np.sin(np.radians(2 * d_theta)) * R_C
+
+    return np.sqrt((dLp / S_L) ** 2 + (dCp / S_C) ** 2 + (dHp / S_H) ** 2
+                   + R_T * (dCp / S_C) * (dHp / S_H)).astype(np.float32)
+
+def to_distance_space(rgb, mode):
+    """sRGB (0-255) colors converted to the space the given distance mode works in"""
+    if mode == "legacy":
+        return rgb_to_match_features(rgb)
+    if mode == "oklab":
+        return srgb_to_oklab(rgb)
+    if mode == "ciede2000":
+        return srgb_to_cielab(rgb)
+    raise ValueError(f"Unknown distance mode {mode}, expected one of {DISTANCE_MODES}")
+
+def space_distance(features1, features2, mode):
+    """Scaled (see DISTANCE_SCALE) distance between colors already converted with to_distance_space"""
+    if mode == "ciede2000":
+        distance = ciede2000(features1, features2)
+    else:
+        distance = np.linalg.norm(np.asarray(features1) - np.asarray(features2), axis=-1)
+    return distance * DISTANCE_SCALE[mode]
+
+def color_distance(rgb1, rgb2, mode="legacy"):
+    """Scaled distance between sRGB (0-255) colors (or arrays of them) for the given distance mode"""
+    return space_distance(to_distance_space(rgb1, mode), to_distance_space(rgb2, mode), mode)
@@ -0,0 +1,276 @@
+import time
+import random
+import asyncio
+import urllib.request
+import urllib.error
+import concurrent.futures
+from email.utils import parsedate_to_datetime
+try:
+    import aiohttp
+    HAS_AIOHTTP = True
+except ImportError:
+    HAS_AIOHTTP = False
+
+#
+#   Downloads lots of urls as fast as the server lets us without losing any of them
+#   Concurrency is adjusted AIMD style (like TCP): one more slot after a full window of successes,
+#   halved when the server pushes back (429/5xx/timeouts). Retry-After pauses everything, since rate limits
+#   are per host, and failed requests are retried with jittered exponential backoff.
+#   Uses aiohttp if it's installed, plain urllib on a thread pool otherwise.
+#
+
+# Statuses that mean "slow down/try again later" rather than "this will never work"
+RETRYABLE_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+
+class FetchResult:
+    def __init__(self, status, data=b"", headers=None):
+        self.status = status
+        self.data = data
+        # Header names are lower cased, servers aren't consistent about them
+        self.headers = {key.lower(): value for key, value in (headers or {}).items()}
+
+class DownloadStats:
+    def __init__(self):
+        self.requests = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.retries = 0
+        self.rate_limited = 0       # 429 responses
+        self.server_errors = 0      # 5xx responses and timeouts/connection errors
+        self.peak_concurrency = 0
+        self.final_concurrency = 0
+        self.start_time = time.time()
+        self.end_time = None
+
+    @property
+    def elapsed(self):
+        return (self.end_time or time.time()) - self.start_time
+
+    @property
+    def throughput(self):
+        """Successful downloads per second"""
+        return self.succeeded / self.elapsed if self.elapsed > 0 else 0.0
+
+    def summary(self):
+        return (f"{self.succeeded} downloaded, {self.failed} failed in {self.elapsed:.1f}s "
+                f"({self.throughput:.1f}/s), {self.requests} requests, {self.retries} retries, "
+                f"{self.rate_limited} rate limited, {self.server_errors} server errors, "
+                f"concurrency peak {self.peak_concurrency} final {self.final_concurrency}")
+
+class DownloadScheduler:
+    def __init__(self, initial_concurrency=8, min_concurrency=1, max_concurrency=32, max_retries=6,
+                 base_backoff=0.5, max_backoff=30.0, timeout=10, progress_callback=None):
+        """
+        Args:
+            initial_concurrency (int): concurrent requests we start with
+            min_concurrency (int): we never go below this, even when getting rate limited a lot
+            max_concurrency (int): we never go above this
+            max_retries (int): retries per url before we give up on it
+            base_backoff (float): backoff in seconds for the first retry, doubles every retry (before jitter)
+            max_backoff (float): upper limit for the backoff in seconds
+            timeout (float): timeout per request in seconds
+            progress_callback (callable): called with (finished, total) after every url we're done with
+        """
+        self.concurrency = initial_concurrency
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.progress_callback = progress_callback
+        self.stats = DownloadStats()
+
+    @staticmethod
+    def parse_retry_after(value):
+        """Retry-After is either a number of seconds or a HTTP date, returns seconds (or None)"""
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    def backoff_delay(self, attempt):
+        """'Full jitter' exponential backoff, spreads retries out so they don't all hit the server at once"""
+        return random.uniform(0, min(self.max_backoff, self.base_backoff * (2 ** attempt)))
+
+    async def download_all(self, urls, on_complete, headers_for=None):
+        """
+        Downloads every url, calls on_complete(name, url, result) exactly once per url
+        with a FetchResult (200 or 304) or None if we gave up on it.
+        Args:
+            urls (dict): name -> url
+            on_complete (callable): see above, can also be a coroutine function, the worker that downloaded
+                                    the url waits for it, so a slow consumer slows the downloads down with it
+            headers_for (callable): optional url -> dict of extra request headers (e.g. for revalidation)
+        Returns:
+            DownloadStats
+        """
+        self.stats = DownloadStats()
+        self._loop = asyncio.get_running_loop()
+        self._active = 0
+        self._pause_until = 0.0
+        self._last_decrease = 0.0
+        self._successes_in_window = 0
+        self._slot_freed = asyncio.Event()
+        self._total = len(urls)
+        self._finished = 0
+        self._all_done = asyncio.Event()
+        if not urls:
+            self._all_done.set()
+
+        queue = asyncio.Queue()
+        for name, url in urls.items():
+            queue.put_nowait((name, url, 0))
+
+        executor = None
+        session = None
+        if HAS_AIOHTTP:
+            session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_concurrency, limit_per_host=self.max_concurrency),
+                timeout=aiohttp.ClientTimeout(total=self.timeout)
+            )
+        else:
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_concurrency)
+
+        workers = [
+            asyncio.create_task(self._worker(queue, on_complete, headers_for, session, executor))
+            for _ in range(self.max_concurrency)
+        ]
+        try:
+            await self._all_done.wait()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            if session is not None:
+                await session.close()
+            if executor is not None:
+                executor.shutdown(wait=False)
+            self.stats.end_time = time.time()
+            self.stats.final_concurrency = self.concurrency
+        return self.stats
+
+    async def _worker(self, queue, on_complete, headers_for, session, executor):
+        while True:
+            name, url, attempt = await queue.get()
+
+            await self._acquire_slot()
+            result = None
+            error = None
+            try:
+                # In here so a failing headers_for counts as a failed download instead of killing the worker
+                headers = headers_for(url) if headers_for else {}
+                self.stats.requests += 1
+                result = await self._fetch(url, headers, session, executor)
+            except Exception as e:
+                error = e
+            finally:
+                self._release_slot()
+
+            if result is not None and result.status in (200, 304):
+                self._on_success()
+                self.stats.succeeded += 1
+                await self._complete(on_complete, name, url, result)
+                continue
+
+            if result is None:
+                retryable = self._is_transient_error(error)
+            else:
+                retryable = result.status in RETRYABLE_STATUSES
+            if result is None:
+                self.stats.server_errors += 1
+            elif result.status == 429:
+                self.stats.rate_limited += 1
+            elif result.status >= 500:
+                self.stats.server_errors += 1
+
+            if retryable and attempt < self.max_retries:
+                retry_after = self.parse_retry_after(result.headers.get("retry-after")) if result is not None else None
+                self._on_congestion(retry_after)
+                self.stats.retries += 1
+                delay = max(self.backoff_delay(attempt), retry_after or 0.0)
+                self._loop.call_later(delay, queue.put_nowait, (name, url, attempt + 1))
+                continue
+
+            reason = f"HTTP {result.status}" if result is not None else repr(error)
+            print(f"Failed to download {name}: {reason} (after {attempt + 1} attempts)")
+            self.stats.failed += 1
+            await self._complete(on_complete, name, url, None)
+
+    @staticmethod
+    def _is_transient_error(error):
+        """Timeouts and connection problems are worth retrying, a malformed url or similar isn't"""
+        if isinstance(error, (asyncio.TimeoutError, OSError)):
+            return True
+        return HAS_AIOHTTP and isinstance(error, aiohttp.ClientError)
+
+    async def _complete(self, on_complete, name, url, result):
+        try:
+            handled = on_complete(name, url, result)
+            if asyncio.iscoroutine(handled):
+                await handled
+        except Exception as e:
+            print(f"Error processing {name}: {e}")
+        self._finished += 1
+        if self.progress_callback:
+            self.progress_callback(self._finished, self._total)
+        if self._finished >= self._total:
+            self._all_done.set()
+
+    async def _acquire_slot(self):
+        while True:
+            pause = self._pause_until - self._loop.time()
+            if pause > 0:
+                await asyncio.sleep(pause)
+                continue
+            if self._active < self.concurrency:
+                self._active += 1
+                self.stats.peak_concurrency = max(self.stats.peak_concurrency, self._active)
+                return
+            self._slot_freed.clear()
+            await self._slot_freed.wait()
+
+    def _release_slot(self):
+        self._active -= 1
+        self._slot_freed.set()
+
+    def _on_success(self):
+        # Additive increase: one extra slot per window of successful requests
+        self._successes_in_window += 1
+        if self._successes_in_window >= self.concurrency:
+            self._successes_in_window = 0
+            if self.concurrency < self.max_concurrency:
+                self.concurrency += 1
+                self._slot_freed.set()
+
+    def _on_congestion(self, retry_after):
+        now = self._loop.time()
+        # Multiplicative decrease, but only once per burst, all the requests that were in flight
+        # when we got pushed back will likely fail too and shouldn't each halve the concurrency
+        if now - self._last_decrease > 1.0:
+            self.concurrency = max(self.min_concurrency, self.concurrency // 2)
+            self._successes_in_window = 0
+            self._last_decrease = now
+        if retry_after:
+            self._pause_until = max(self._pause_until, now + retry_after)
+
+    async def _fetch(self, url, headers, session, executor):
+        if session is not None:
+            async with session.get(url, headers=headers) as response:
+                data = await response.read() if response.status == 200 else b""
+                return FetchResult(response.status, data, dict(response.headers))
+        return await self._loop.run_in_executor(executor, self._fetch_urllib, url, headers)
+
+    def _fetch_urllib(self, url, headers):
+        request = urllib.request.Request(url, headers=headers)
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return FetchResult(response.status, response.read(), dict(response.headers))
+        except urllib.error.HTTPError as e:
+            return FetchResult(e.code, b"", dict(e.headers or {}))
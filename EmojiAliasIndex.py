@@ -0,0 +1,103 @@
+import os
+import hashlib
+import numpy as np
+
+#
+#   Emoji JSONs often have several names for the same image (e.g. +1 and thumbsup), and since every character of
+#   a message counts we'd rather always send the shortest one. This maps every image url to all of its names,
+#   shortest first. Built once per loaded JSON and saved along with the emoji features (see to_columns),
+#   so the next start can skip building it.
+#
+
+class EmojiAliasIndex:
+    _loaded = {} # JSON digest -> index, so everything in this process shares the same one
+
+    def __init__(self, emojis, shortest_names=None):
+        """
+        Args:
+            emojis (dict): name -> image url, as loaded from the emoji JSON (names without colons)
+            shortest_names (dict): name -> shortest alias if we already know it (e.g. from the cache)
+        """
+        self.emojis = emojis
+        self._names_by_url = None
+        if shortest_names is None:
+            shortest_names = {name: self.names_by_url[url][0] for name, url in emojis.items()}
+        self.shortest_names = shortest_names # name -> shortest name for the same image (can be itself)
+
+    @staticmethod
+    def digest(emojis):
+        """Identifies the exact contents of an emoji JSON, the cached index is only used if this matches"""
+        content = "\n".join(f"{name}\t{url}" for name, url in emojis.items())
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    @classmethod
+    def for_emojis(cls, emojis, cache_filename=None):
+        """
+        The index for this emoji JSON, from memory if we already have it, else from the feature cache, else built
+        Args:
+            emojis (dict): name -> image url
+            cache_filename (str): feature cache to look in (see EmojiPrecomputer.FEATURE_CACHE_FILE)
+        """
+        digest = cls.digest(emojis)
+        index = cls._loaded.get(digest)
+        if index is None and cache_filename is not None:
+            index = cls.load(cache_filename, emojis, digest)
+        if index is None:
+            index = cls(emojis)
+        cls._loaded[digest] = index
+        return index
+
+    @property
+    def names_by_url(self):
+        """url -> all names for it, shortest first"""
+        if self._names_by_url is None:
+            names_by_url = {}
+            for name, url in self.emojis.items():
+                names_by_url.setdefault(url, []).append(name)
+            for names in names_by_url.values():
+                names.sort(key=lambda name: (len(name), name))
+            self._names_by_url = names_by_url
+        return self._names_by_url
+
+    def names_for(self, url):
+        return self.names_by_url.get(url, [])
+
+    def shortest(self, name):
+        """Shortest name for the image of this emoji, accepts names with or without colons (and keeps them)"""
+        if len(name) > 2 and name.startswith(':') and name.endswith(':'):
+            return f":{self.shortest(name[1:-1])}:"
+        return self.shortest_names.get(name, name)
+
+    def to_columns(self):
+        """
+        The index as flat columns to save with the emoji features:
+            alias_digest    digest of the emoji JSON it was built for
+            alias_names     utf-8 blob of all emoji names joined by newlines
+            alias_shortest  (N,) int32 row of the shortest alias of every name
+        """
+        names = list(self.emojis.keys())
+        rows = {name: i for i, name in enumerate(names)}
+        return {
+            "alias_digest": np.str_(self.digest(self.emojis)),
+            "alias_names": np.frombuffer("\n".join(names).encode("utf-8"), dtype=np.uint8),
+            "alias_shortest": np.array([rows[self.shortest_names[name]] for name in names], dtype=np.int32),
+        }
+
+    @classmethod
+    def load(cls, filename, emojis, digest=None):
+        """Index saved in the feature cache, None if there isn't one or it was built for a different JSON"""
+        if not os.path.exists(filename):
+            return None
+        try:
+            with np.load(filename, allow_pickle=False) as cache_data:
+                if "alias_digest" not in cache_data.files:
+                    return None
+                if str(cache_data["alias_digest"]) != (digest or cls.digest(emojis)):
+                    return None
+                text = cache_data["alias_names"].tobytes().decode("utf-8")
+                names = text.split("\n") if text else []
+                shortest = cache_data["alias_shortest"].tolist()
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Failed to load emoji alias index: {e}")
+            return None
+        return cls(emojis, {name: names[row] for name, row in zip(names, shortest)})
@@ -0,0 +1,66 @@
+#
+#   Turns mouse positions in to the cells a stroke paints
+#   Motion events come in a lot slower than a fast drag moves, so instead of only painting the cell under the cursor
+#   we draw a (Bresenham) line from the cell of the previous event to this one and stamp the brush on every cell of it.
+#
+
+BRUSH_SIZES = (1, 2, 3, 5, 9) # Brush widths in cells
+
+def line_cells(row0, col0, row1, col1):
+    """Every cell on the line from (row0, col0) to (row1, col1), both included, using Bresenham's algorithm"""
+    cells = []
+    d_row, d_col = abs(row1 - row0), -abs(col1 - col0)
+    step_row = 1 if row0 < row1 else -1
+    step_col = 1 if col0 < col1 else -1
+    error = d_row + d_col
+    row, col = row0, col0
+    while True:
+        cells.append((row, col))
+        if row == row1 and col == col1:
+            return cells
+        error2 = 2 * error
+        if error2 >= d_col:
+            error += d_col
+            row += step_row
+        if error2 <= d_row:
+            error += d_row
+            col += step_col
+
+class EmojiBrush:
+    def __init__(self, size=1):
+        self.size = size
+        self.last_cell = None # Cell of the previous event in this stroke, None when we're not in a stroke
+
+    def end_stroke(self):
+        """Next stroke_to starts a new stroke instead of connecting to the last one"""
+        self.last_cell = None
+
+    def footprint(self, row, col):
+        """(top, left, bottom, right) the brush covers when centered on a cell, bottom/right exclusive"""
+        top = row - (self.size - 1) // 2
+        left = col - (self.size - 1) // 2
+        return top, left, top + self.size, left + self.size
+
+    def stroke_to(self, grid, row, col, value):
+        """
+        Paints value from the last cell of the stroke to this one (or just this one if a stroke starts here)
+        Args:
+            grid (EmojiGrid): grid to paint in, cells outside of it are ignored
+            row, col (int): cell under the cursor, can be outside the grid
+            value (int): palette index to paint
+        Returns:
+            bool: if any cell of the grid got painted
+        """
+        start = self.last_cell if self.last_cell is not None else (row, col)
+        self.last_cell = (row, col)
+
+        painted = False
+        for cell_row, cell_col in line_cells(start[0], start[1], row, col):
+            top, left, bottom, right = self.footprint(cell_row, cell_col)
+            # Clip to the grid, negative indices would wrap around
+            top, left = max(top, 0), max(left, 0)
+            bottom, right = min(bottom, grid.rows), min(right, grid.cols)
+            if top < bottom and left < right:
+                grid.fill(value, top, left, bottom, right)
+                painted = True
+        return painted
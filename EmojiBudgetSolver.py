@@ -0,0 +1,153 @@
+import numpy as np
+
+from ColorSpace import pack_rgb, unpack_rgb, to_distance_space, space_distance, DISTANCE_SCALE
+
+#
+#   Picks emojis for an image so the message fits in a character budget
+#   Every :emoji_name: costs its full name in characters, so instead of always taking the closest emoji we take the one
+#   with the lowest color distance + lambda * name length, and binary search lambda for the best grid that still fits.
+#   The candidates (and their distances) are found once per image, after that a solve is only a bit of array math,
+#   fast enough to re-solve on every change of the budget.
+#
+
+BUDGET_CANDIDATES = 16 # Nearest emojis per color we choose between
+SHORT_NAME_POOL = 256 # The emojis with the shortest names, so every color has some short ones to fall back to
+SHORT_NAME_CANDIDATES = 8 # Nearest emojis out of the SHORT_NAME_POOL added to the candidates of every color
+SHORTEST_NAMES = 4 # The emojis with the very shortest names are candidates for every color, for tiny budgets
+LAMBDA_SEARCH_STEPS = 30 # Max binary search steps
+LAMBDA_TOLERANCE = 1e-3 # Stop searching once lambda is known this precisely (relative)
+MAX_LAMBDA = 1e4 # At this point only the name length counts anymore
+LENGTH_TIE_BREAK = 1e-6 # Even without a budget, of two equally close emojis take the shorter one
+
+def emoji_message_length(name):
+    """Characters one emoji costs in a message, its name plus the colons around it"""
+    return len(name.strip(':')) + 2
+
+class EmojiBudgetSolver:
+    def __init__(self, emoji_precomputer, pixels, rows, candidates=BUDGET_CANDIDATES):
+        """
+        Args:
+            emoji_precomputer (EmojiPrecomputer): with its features calculated, uses its distance_mode
+            pixels (np.ndarray): (N, 3) uint8 RGB colors of the resized image, row by row
+            rows (int): rows in the image, every row but the last one costs a newline
+            candidates (int): nearest emojis per color to choose between
+        """
+        precomputer = emoji_precomputer
+        self.mode = precomputer.distance_mode
+        self.rows = rows
+        self.palette = precomputer.palette_spaces[self.mode]
+        self.flicker = precomputer.flicker_penalty * np.sqrt(precomputer.palette_temporal_variance)
+        # Names get swapped for their shortest alias when the grid is made, so that's what they cost
+        aliases = precomputer.get_alias_index()
+        self.name_lengths = np.array(
+            [emoji_message_length(aliases.shortest(name)) for name in precomputer.palette_names], dtype=np.float64
+        )
+
+        # Images usually have way less unique colors than pixels, everything below works on those (with their counts)
+        keys, inverse, counts = np.unique(pack_rgb(pixels), return_inverse=True, return_counts=True)
+        self.inverse = inverse.reshape(-1)
+        self.counts = counts
+        self.features = to_distance_space(unpack_rgb(keys), self.mode)
+
+        k = min(candidates, len(self.palette))
+        _, nearest = precomputer.get_color_index(self.mode).query(self.features, k=k)
+        # Plus the closest emojis with short names, the nearest ones alone might all have long names,
+        # and the shortest ones of all so even tiny budgets can be met
+        pool = np.argsort(self.name_lengths, kind='stable')[:SHORT_NAME_POOL]
+        short_k = min(SHORT_NAME_CANDIDATES, len(pool))
+        pool_distance = self._euclidean_distances(self.features, pool)
+        short = pool[np.argpartition(pool_distance, short_k - 1, axis=1)[:, :short_k]]
+        shortest = np.broadcast_to(pool[:SHORTEST_NAMES], (len(self.features), min(SHORTEST_NAMES, len(pool))))
+        self.candidates = np.concatenate([nearest.reshape(-1, k), short, shortest], axis=1)
+        # Real distances, for ciede2000 the tree only gives us the nearest ones in CIELAB
+        self.distances = space_distance(self.features[:, None, :], self.palette[self.candidates], self.mode) \
+            + self.flicker[self.candidates]
+        self.lengths = self.name_lengths[self.candidates]
+
+    def message_length(self, picks):
+        """Characters the whole grid costs with picks (one emoji per unique color), including the newlines"""
+        return int(self.counts @ self.name_lengths[picks]) + max(0, self.rows - 1)
+
+    def solve(self, char_budget=None, max_distinct=None):
+        """
+        Best grid that fits in char_budget characters and uses at most max_distinct different emojis.
+        If even the shortest names don't fit, returns the shortest grid we can make.
+        Args:
+            char_budget (int): max message length, None for no limit
+            max_distinct (int): max different emojis, None for no limit
+        Returns:
+            (np.ndarray, int): (N,) indices in to palette_names per pixel, and the message length
+        """
+        picks = self._pick(0.0, max_distinct)
+        length = self.message_length(picks)
+        if char_budget is None or length <= char_budget:
+            return picks[self.inverse], length
+
+        # Find a lambda that fits, then narrow it down to the smallest one that does
+        low, high = 0.0, 1e-3
+        while True:
+            fitting = self._pick(high, max_distinct)
+            fitting_length = self.message_length(fitting)
+            if fitting_length <= char_budget or high >= MAX_LAMBDA:
+                break
+            low, high = high, high * 4
+        if fitting_length > char_budget:
+            return fitting[self.inverse], fitting_length
+
+        for _ in range(LAMBDA_SEARCH_STEPS):
+            if high - low <= high * LAMBDA_TOLERANCE:
+                break
+            middle = (low + high) / 2
+            picks = self._pick(middle, max_distinct)
+            length = self.message_length(picks)
+            if length <= char_budget:
+                high, fitting, fitting_length = middle, picks, length
+            else:
+                low = middle
+        return fitting[self.inverse], fitting_length
+
+    def _pick(self, lam, max_distinct=None):
+        """Emoji with the lowest distance + lam * length per unique color, using at most max_distinct emojis"""
+        picks = self._pick_allowed(lam, None)
+        if max_distinct is None:
+            return picks
+        max_distinct = max(1, max_distinct)
+        while True:
+            used = np.unique(picks)
+            if len(used) <= max_distinct:
+                return picks
+            # Drop (about half of the excess of) the least used emojis, their pixels go to the next best one we kept
+            usage = np.bincount(picks, weights=self.counts, minlength=len(self.palette))[used]
+            drop_count = max(1, (len(used) - max_distinct + 1) // 2)
+            allowed = np.zeros(len(self.palette), dtype=bool)
+            allowed[used[np.argsort(usage, kind='stable')[drop_count:]]] = True
+            picks = self._pick_allowed(lam, allowed)
+
+    def _pick_allowed(self, lam, allowed):
+        cost = self.distances + (lam + LENGTH_TIE_BREAK) * self.lengths
+        if allowed is not None:
+            cost = np.where(allowed[self.candidates], cost, np.inf)
+        choice = np.argmin(cost, axis=1)
+        rows = np.arange(len(cost))
+        picks = self.candidates[rows, choice]
+        if allowed is None:
+            return picks
+
+        # Colors whose candidates all got dropped look through every emoji we kept instead
+        orphans = np.flatnonzero(np.isinf(cost[rows, choice]))
+        if len(orphans):
+            kept = np.flatnonzero(allowed)
+            orphan_cost = self._euclidean_distances(self.features[orphans], kept) \
+                + self.flicker[kept] + (lam + LENGTH_TIE_BREAK) * self.name_lengths[kept]
+            picks[orphans] = kept[np.argmin(orphan_cost, axis=1)]
+        return picks
+
+    def _euclidean_distances(self, features, rows):
+        """
+        Scaled euclidean distances between features and the palette rows, all at once with a matrix product
+        (for ciede2000 that's the CIELAB distance, close enough for picking fallbacks)
+        """
+        palette = self.palette[rows].astype(np.float64)
+        features = np.asarray(features, dtype=np.float64)
+        squared = (features ** 2).sum(axis=1)[:, None] - 2.0 * (features @ palette.T) + (palette ** 2).sum(axis=1)
+        return np.sqrt(np.maximum(squared, 0)) * DISTANCE_SCALE[self.mode]
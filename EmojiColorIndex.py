@@ -0,0 +1,162 @@
+import numpy as np
+
+#
+#   Exact k-nearest neighbour index over emoji colors
+#   It's a k-d tree that stops splitting at small leaves, queries then run leaf by leaf with array math
+#   instead of walking the tree per pixel in Python, which keeps it fast for whole images at once
+#
+
+# Max amount of query x leaf/point distances we compute in one go (~16MB of float32)
+QUERY_CHUNK_ELEMENTS = 1 << 22
+
+class EmojiColorIndex:
+    def __init__(self, points=None, leaf_size=32):
+        """
+        Args:
+            points (np.ndarray): (N, D) feature vectors, euclidean distance between them should be the
+                                 distance we want to match on (see ColorSpace.rgb_to_match_features)
+            leaf_size (int): max amount of points per leaf
+        """
+        self.leaf_size = leaf_size
+        self.points = np.zeros((0, 0), dtype=np.float32)
+        self.order = np.zeros(0, dtype=np.int64)        # index in the original points for every sorted point
+        self.leaf_bounds = np.zeros((0, 2), dtype=np.int64)  # [start, end) in to the sorted points per leaf
+        self.leaf_min = np.zeros((0, 0), dtype=np.float32)
+        self.leaf_max = np.zeros((0, 0), dtype=np.float32)
+        self._padded = None
+        if points is not None:
+            self.build(points)
+
+    def __len__(self):
+        return len(self.order)
+
+    def build(self, points):
+        points = np.asarray(points, dtype=np.float32)
+        if points.ndim != 2:
+            raise ValueError("EmojiColorIndex expects a (N, D) array of points")
+
+        order = np.arange(len(points))
+        leaves = []
+        # Split on the widest dimension at the median until the leaves are small enough
+        stack = [(0, len(points))]
+        while stack:
+            start, end = stack.pop()
+            if end - start <= self.leaf_size:
+                if end > start:
+                    leaves.append((start, end))
+                continue
+            segment = points[order[start:end]]
+            dim = int(np.argmax(segment.max(axis=0) - segment.min(axis=0)))
+            mid = (end - start) // 2
+            split = np.argpartition(segment[:, dim], mid)
+            order[start:end] = order[start:end][split]
+            stack.append((start + mid, end))
+            stack.append((start, start + mid))
+
+        self.order = order
+        self.points = points[order]
+        self.leaf_bounds = np.array(sorted(leaves), dtype=np.int64).reshape(-1, 2)
+        self.leaf_min = np.array([self.points[s:e].min(axis=0) for s, e in self.leaf_bounds], dtype=np.float32)
+        self.leaf_max = np.array([self.points[s:e].max(axis=0) for s, e in self.leaf_bounds], dtype=np.float32)
+        self.leaf_min = self.leaf_min.reshape(len(self.leaf_bounds), points.shape[1])
+        self.leaf_max = self.leaf_max.reshape(len(self.leaf_bounds), points.shape[1])
+        self._padded = None
+
+    def query(self, queries, k=1):
+        """
+        Exact k-nearest neighbours.
+        Args:
+            queries (np.ndarray): (Q, D) feature vectors
+            k (int): amount of neighbours to return (clamped to the index size)
+        Returns:
+            (np.ndarray, np.ndarray): (Q, k) euclidean distances and (Q, k) indices in to the original points,
+                                      both sorted from closest to furthest
+        """
+        if len(self) == 0:
+            raise ValueError("EmojiColorIndex is empty")
+        queries = np.asarray(queries, dtype=np.float32).reshape(-1, self.points.shape[1])
+        k = max(1, min(k, len(self)))
+
+        distances = np.empty((len(queries), k), dtype=np.float32)
+        indices = np.empty((len(queries), k), dtype=np.int64)
+        chunk = max(1, QUERY_CHUNK_ELEMENTS // max(len(self.leaf_bounds), self.leaf_size))
+        for start in range(0, len(queries), chunk):
+            d, i = self._query_chunk(queries[start:start + chunk], k)
+            distances[start:start + chunk] = d
+            indices[start:start + chunk] = i
+        return distances, indices
+
+    def _query_chunk(self, queries, k):
+        n = len(queries)
+        best_sq = np.full((n, k), np.inf, dtype=np.float32)
+        best_idx = np.zeros((n, k), dtype=np.int64)
+
+        # Lower bound of the squared distance from every query to anything inside a leaf,
+        # using the ball around the leaf box (cheap to compute for all leaves with one matrix product)
+        centers = (self.leaf_min + self.leaf_max) * 0.5
+        radii = np.linalg.norm(self.leaf_max - centers, axis=1)
+        center_sq = np.einsum('qd,qd->q', queries, queries)[:, None] - 2.0 * (queries @ centers.T) + \
+                    np.einsum('ld,ld->l', centers, centers)[None, :]
+        box_sq = np.maximum(np.sqrt(np.maximum(center_sq, 0)) - radii[None, :], 0) ** 2
+        # Leaves are visited closest first so the k-th best shrinks as fast as possible
+        visit_order = np.argsort(box_sq, axis=1)
+        rows = np.arange(n)
+
+        # Leaves padded to leaf_size so a whole step can gather its candidates with one fancy index
+        leaf_points, leaf_indices, leaf_valid = self._padded_leaves()
+        for step in range(len(self.leaf_bounds)):
+            leaf_ids = visit_order[:, step]
+            # A leaf can only help if its box is closer than the current k-th best
+            active = box_sq[rows, leaf_ids] < best_sq[:, -1]
+            if not np.any(active):
+                break
+            q_rows = rows[active]
+            leaves = leaf_ids[active]
+            diff = queries[q_rows, None, :] - leaf_points[leaves]
+            cand_sq = np.where(leaf_valid[leaves], np.einsum('qpd,qpd->qp', diff, diff), np.inf)
+            self._merge(best_sq, best_idx, q_rows, cand_sq, leaf_indices[leaves], k)
+
+        return np.sqrt(best_sq), self.order[best_idx]
+
+    def _padded_leaves(self):
+        if self._padded is None:
+            size = int((self.leaf_bounds[:, 1] - self.leaf_bounds[:, 0]).max())
+            slots = self.leaf_bounds[:, :1] + np.arange(size)[None, :]
+            valid = slots < self.leaf_bounds[:, 1:]
+            slots = np.where(valid, slots, self.leaf_bounds[:, :1])
+            self._padded = (self.points[slots], slots, valid)
+        return self._padded
+
+    @staticmethod
+    def _merge(best_sq, best_idx, q_rows, cand_sq, cand_idx, k):
+        all_sq = np.concatenate([best_sq[q_rows], cand_sq], axis=1)
+        all_idx = np.concatenate([best_idx[q_rows], cand_idx], axis=1)
+        if k == 1:
+            pick = np.argmin(all_sq, axis=1)[:, None]
+        else:
+            pick = np.argpartition(all_sq, k - 1, axis=1)[:, :k]
+            picked = np.take_along_axis(all_sq, pick, axis=1)
+            pick = np.take_along_axis(pick, np.argsort(picked, axis=1), axis=1)
+        best_sq[q_rows] = np.take_along_axis(all_sq, pick, axis=1)
+        best_idx[q_rows] = np.take_along_axis(all_idx, pick, axis=1)
+
+    def to_dict(self):
+        """Plain arrays so the index can be saved together with the feature cache"""
+        return {
+            "leaf_size": self.leaf_size,
+            "points": self.points,
+            "order": self.order,
+            "leaf_bounds": self.leaf_bounds,
+            "leaf_min": self.leaf_min,
+            "leaf_max": self.leaf_max,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        index = cls(leaf_size=int(data["leaf_size"]))
+        index.points = np.asarray(data["points"], dtype=np.float32)
+        index.order = np.asarray(data["order"], dtype=np.int64)
+        index.leaf_bounds = np.asarray(data["leaf_bounds"], dtype=np.int64)
+        index.leaf_min = np.asarray(data["leaf_min"], dtype=np.float32)
+        index.leaf_max = np.asarray(data["leaf_max"], dtype=np.float32)
+        return index
@@ -0,0 +1,111 @@
+#
+#   Turns an emoji grid in to the text we paste in Slack/Discord
+#   Chat apps count every character of every :emoji_name:, so besides joining the names this keeps messages short:
+#   blank background emojis at the end of a row can be dropped (they're invisible), names can be swapped for a shorter
+#   alias of the same image, and a grid that doesn't fit in one message gets split in to several that do.
+#   Everything is a single pass over the grid.
+#
+
+FALLBACK_EMOJI = "⬛" # Used for cells whose index has no emoji mapped to it
+
+class EmojiExporter:
+    def __init__(self, emoji_names, background=0, aliases=None, trim_background=True, fallback=FALLBACK_EMOJI):
+        """
+        Args:
+            emoji_names (dict): grid index -> emoji text (usually ":name:")
+            background (int): grid index of the background emoji, what we trim
+            aliases (dict): optional name -> shorter alias (without colons, see EmojiAliasIndex.shortest_names)
+            trim_background (bool): drop background emojis at the end of rows, and background rows at the end,
+                                    only makes sense if the background emoji is invisible
+            fallback (str): text for indices that aren't in emoji_names
+        """
+        self.background = background
+        self.trim_background = trim_background
+        self.fallback = fallback
+        self.missing = set() # Indices we had to use the fallback for in the last export
+        self.emoji_names = {index: self._shorten(name, aliases) for index, name in emoji_names.items()}
+
+    @staticmethod
+    def _shorten(name, aliases):
+        if not aliases or not (len(name) > 2 and name.startswith(':') and name.endswith(':')):
+            return name
+        alias = aliases.get(name[1:-1])
+        return f":{alias}:" if alias and len(alias) < len(name) - 2 else name
+
+    def _emoji(self, index):
+        name = self.emoji_names.get(index)
+        if name is None:
+            self.missing.add(index)
+            return self.fallback
+        return name
+
+    def row_emojis(self, grid):
+        """
+        The emojis (text) of every row of the grid.
+        Background emojis at the end of a row get dropped, but a row never ends up empty,
+        an empty line is only as high as a line of text so everything below it would shift up.
+        Trailing background rows get dropped completely, there's nothing below them to shift.
+        """
+        self.missing = set()
+        grid = grid.tolist() if hasattr(grid, "tolist") else [list(row) for row in grid]
+        last_row = len(grid)
+        if self.trim_background:
+            while last_row > 1 and all(index == self.background for index in grid[last_row - 1]):
+                last_row -= 1
+
+        rows = []
+        for row in grid[:last_row]:
+            end = len(row)
+            if self.trim_background:
+                while end > 1 and row[end - 1] == self.background:
+                    end -= 1
+            rows.append([self._emoji(index) for index in row[:end]])
+        return rows
+
+    def rows(self, grid):
+        """Text of every row of the grid, see row_emojis"""
+        return ["".join(row) for row in self.row_emojis(grid)]
+
+    def export(self, grid):
+        """The whole grid as one message"""
+        return "\n".join(self.rows(grid))
+
+    @staticmethod
+    def message_length(rows):
+        """Exact length of the message these rows make, in characters"""
+        return sum(len(row) for row in rows) + max(0, len(rows) - 1)
+
+    def split(self, grid, limit):
+        """
+        The grid as a list of messages that each fit in limit characters, split between rows where possible.
+        A single row that's longer than the limit gets split between emojis.
+        """
+        messages = []
+        current = []
+        current_length = 0
+        for row in self.row_emojis(grid):
+            for part in self._split_row(row, limit):
+                added = len(part) + (1 if current else 0)
+                if current and current_length + added > limit:
+                    messages.append("\n".join(current))
+                    current, current_length, added = [], 0, len(part)
+                current.append(part)
+                current_length += added
+        if current:
+            messages.append("\n".join(current))
+        return messages
+
+    @staticmethod
+    def _split_row(emojis, limit):
+        """Row text cut in to pieces of at most limit characters, only ever between emojis"""
+        parts = []
+        part = []
+        length = 0
+        for emoji in emojis:
+            if part and length + len(emoji) > limit:
+                parts.append("".join(part))
+                part, length = [], 0
+            part.append(emoji)
+            length += len(emoji)
+        parts.append("".join(part))
+        return parts
@@ -0,0 +1,316 @@
+import io
+import numpy as np
+from PIL import Image
+
+from ColorSpace import rgb_to_match_features, srgb_to_oklab
+
+#
+#   Feature extraction for a single (possibly animated) emoji image
+#   Kept as plain module level functions (and out of EmojiPrecomputer) so they can run in worker processes,
+#   the workers only have to import this module and we only have to send them the raw image bytes (or a file path)
+#
+
+def hex_to_rgb(color):
+    """'#rrggbb' to an (r, g, b) tuple"""
+    return tuple(int(color[i:i+2], 16) for i in (1, 3, 5))
+
+KMEANS_CLUSTERS = 5 # Dominant colors we look for per emoji
+MIN_KMEANS_PIXELS = 16 # Emojis with less visible pixels than this just get their average color (low, emojis get downscaled)
+SAMPLE_SEED = 0 # Fixed so the same emoji always gets the same pixels sampled (and the same colors)
+MAX_FRAMES = 8 # Frames we look at for animated emojis, spread evenly over the animation
+MIN_FRAME_DURATION = 20 # ms, browsers show frames with a shorter (or no) duration for DEFAULT_FRAME_DURATION
+DEFAULT_FRAME_DURATION = 100
+SIGNATURE_GRID = 3 # The spatial signature is a SIGNATURE_GRID x SIGNATURE_GRID grid of mean colors
+SIGNATURE_SIZE = SIGNATURE_GRID * SIGNATURE_GRID * 3 + 1 # OKLab per cell, plus the alpha coverage
+
+def extract_emoji_colors_batch(items, background_rgb, analysis_size=None, max_samples=None, max_frames=MAX_FRAMES):
+    """
+    Decodes a whole chunk of emoji images and calculates their dominant colors, so we pay the inter process overhead
+    per chunk instead of per emoji (and the k-means runs for the whole chunk together),
+    results are returned as small arrays since those pickle a lot smaller than lists of tuples.
+    Args:
+        items (list): [(name, source), ...] with source the raw image bytes or a path to the image file
+        background_rgb (tuple): background the emojis are shown on, transparent pixels get blended with it
+        analysis_size (int): downscale emojis to fit in analysis_size x analysis_size first (None for full size)
+        max_samples (int): cluster at most this many (randomly picked) visible pixels (None for all of them)
+        max_frames (int): for animated emojis, look at at most this many frames
+    Returns:
+        list: [(name, colors, proportions, temporal_variance, signature, error), ...] colors is (k, 3) uint8,
+              proportions (k,) float32 and signature (SIGNATURE_SIZE,) float32 (see spatial_signature),
+              or all None and error a message if the emoji couldn't be processed
+    """
+    results = []
+    analyzed = []
+    for name, source in items:
+        try:
+            # Only the (downscaled, sampled) pixels are kept, so we never hold more than one decoded image
+            with Image.open(source if isinstance(source, str) else io.BytesIO(source)) as img:
+                analyzed.append((name, analyze_emoji(img, background_rgb, analysis_size, max_samples, max_frames)))
+        except Exception as e:
+            results.append((name, None, None, None, None, str(e)))
+
+    all_colors = dominant_colors_batch([(pixels, weights) for _, (pixels, weights, _, _) in analyzed], background_rgb)
+    for (name, (_, _, temporal_variance, signature)), colors in zip(analyzed, all_colors):
+        results.append((
+            name,
+            np.array([color for color, _ in colors], dtype=np.uint8).reshape(-1, 3),
+            np.array([proportion for _, proportion in colors], dtype=np.float32),
+            temporal_variance,
+            signature,
+            None
+        ))
+    return results
+
+def calculate_emoji_colors(img, background_rgb, analysis_size=None, max_samples=None, max_frames=MAX_FRAMES):
+    return calculate_emoji_colors_batch([img], background_rgb, analysis_size, max_samples, max_frames)[0]
+
+def calculate_emoji_colors_batch(images, background_rgb, analysis_size=None, max_samples=None, max_frames=MAX_FRAMES):
+    """
+    Dominant colors for a list of (possibly animated) PIL images, see extract_emoji_colors_batch.
+    Returns:
+        list: [(colors, temporal_variance, signature), ...] one per image
+    """
+    analyzed = [analyze_emoji(img, background_rgb, analysis_size, max_samples, max_frames) for img in images]
+    all_colors = dominant_colors_batch([(pixels, weights) for pixels, weights, _, _ in analyzed], background_rgb)
+    return [(colors, temporal_variance, signature)
+            for colors, (_, _, temporal_variance, signature) in zip(all_colors, analyzed)]
+
+def emoji_frames(img, max_frames=MAX_FRAMES):
+    """
+    Yields (RGBA frame, duration in ms) for up to max_frames frames spread evenly over the animation,
+    seeking straight to them and decoding one at a time. Still images yield a single frame.
+    """
+    frame_count = getattr(img, "n_frames", 1) if getattr(img, "is_animated", False) else 1
+    if frame_count <= 1 or max_frames is None or max_frames <= 1:
+        yield img.convert('RGBA'), float(DEFAULT_FRAME_DURATION)
+        return
+    for index in np.unique(np.linspace(0, frame_count - 1, min(frame_count, max_frames)).round().astype(int)).tolist():
+        img.seek(index)
+        duration = img.info.get("duration") or 0
+        yield img.convert('RGBA'), float(duration if duration >= MIN_FRAME_DURATION else DEFAULT_FRAME_DURATION)
+
+def analyze_emoji(img, background_rgb, analysis_size=None, max_samples=None, max_frames=MAX_FRAMES):
+    """
+    Everything we need from the image itself to calculate the emoji's features, frame by frame.
+    Returns:
+        (np.ndarray, np.ndarray, float, np.ndarray): (n, 3) visible pixels of all sampled frames, (n,) weight
+                                                     per pixel (the duration of its frame), the temporal variance
+                                                     and the duration weighted spatial signature
+    """
+    all_pixels = []
+    all_weights = []
+    appearances = []
+    signatures = []
+    durations = []
+    for frame, duration in emoji_frames(img, max_frames):
+        frame = downscale_for_analysis(frame, analysis_size)
+        signatures.append(spatial_signature(frame, background_rgb))
+        # The pixels and the appearance both come from the same blended colors, so we only blend once
+        blended, alpha = blend_with_background(frame, background_rgb)
+        pixels = blended[alpha > 0.001] # Only pixels with significant alpha (non-transparent) TODO: maybe use transparency aswell
+        all_pixels.append(pixels)
+        all_weights.append(np.full(len(pixels), duration, dtype=np.float32))
+        # How the frame looks as a whole: its average color over the background
+        appearances.append(rgb_to_match_features(np.rint(blended.mean(axis=0))))
+        durations.append(duration)
+        del frame # Don't hold on to the frame while we decode the next one
+
+    pixels = np.concatenate(all_pixels)
+    weights = np.concatenate(all_weights)
+    # Seeded per image so the result doesn't depend on which other emojis are in the same batch
+    keep = sample_indices(len(pixels), max_samples, np.random.default_rng(SAMPLE_SEED))
+    if keep is not None:
+        pixels = pixels[keep]
+        weights = weights[keep]
+    durations = np.array(durations)
+    signature = (durations / durations.sum()) @ np.array(signatures)
+    return pixels, weights, temporal_variance(np.array(appearances), durations), signature.astype(np.float32)
+
+def spatial_signature(frame, background_rgb):
+    """
+    Where the colors of a frame are: the frame split in a SIGNATURE_GRID x SIGNATURE_GRID grid, with the mean color
+    (over the background) of every cell in OKLab, followed by the alpha coverage (share of the frame that's opaque).
+    Source images get the same treatment per cell in block matching, so the two can be compared directly.
+    Returns:
+        np.ndarray: (SIGNATURE_SIZE,) float32, the cells row by row with L, a, b each and the coverage last
+    """
+    return block_signatures(frame, background_rgb, 1, 1).reshape(-1)
+
+def block_signatures(img, background_rgb, width, height):
+    """
+    Spatial signatures (see spatial_signature) for every block of an image cut in width x height blocks.
+    Areas are averaged premultiplied by alpha, like in downscale_for_analysis.
+    Returns:
+        np.ndarray: (height, width, SIGNATURE_SIZE) float32
+    """
+    if img.mode != 'RGBa':
+        img = img.convert('RGBa')
+    cells = np.asarray(img.resize((width * SIGNATURE_GRID, height * SIGNATURE_GRID), Image.BOX), dtype=np.float32)
+    alpha = cells[..., 3:] / 255.0
+    # Premultiplied, so the mean color over the background is just the color plus what's left of the background
+    blended = cells[..., :3] + np.array(background_rgb, dtype=np.float32) * (1 - alpha)
+    lab = srgb_to_oklab(np.clip(blended, 0, 255))
+
+    # (height * grid, width * grid, ...) -> (height, width, grid * grid, ...), cells of a block row by row
+    def per_block(values):
+        channels = values.shape[-1]
+        return values.reshape(height, SIGNATURE_GRID, width, SIGNATURE_GRID, channels).transpose(0, 2, 1, 3, 4) \
+                     .reshape(height, width, SIGNATURE_GRID * SIGNATURE_GRID * channels)
+
+    coverage = per_block(alpha).mean(axis=2, keepdims=True)
+    return np.concatenate([per_block(lab), coverage], axis=2).astype(np.float32)
+
+def temporal_variance(appearances, durations):
+    """Duration weighted variance of the frame appearances, 0 for a single frame, high for emojis that flicker"""
+    if len(appearances) <= 1:
+        return 0.0
+    weights = durations / durations.sum()
+    mean = weights @ appearances
+    return float(weights @ np.sum((appearances - mean) ** 2, axis=1))
+
+def downscale_for_analysis(img, analysis_size):
+    """
+    Shrinks an RGBA image to fit in analysis_size x analysis_size (keeping its aspect ratio) by averaging areas.
+    Colors are averaged premultiplied by alpha, so transparent pixels (whose color is often garbage) don't bleed in.
+    Returns:
+        PIL.Image: premultiplied ('RGBa') image, also when it didn't need shrinking
+    """
+    img = img.convert('RGBa')
+    if analysis_size is None or max(img.size) <= analysis_size:
+        return img
+    scale = analysis_size / max(img.size)
+    size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+    return img.resize(size, Image.BOX)
+
+def sample_indices(count, max_samples, rng):
+    """Sorted indices of at most max_samples out of count items, picked at random, None if we can keep everything"""
+    if max_samples is None or count <= max_samples:
+        return None
+    return np.sort(rng.choice(count, max_samples, replace=False))
+
+def blend_with_background(img, background_rgb):
+    """
+    Every pixel of a premultiplied ('RGBa') image blended with the background
+    Returns:
+        (np.ndarray, np.ndarray): (n, 3) float32 colors and (n,) float32 alpha (0-1)
+    """
+    img_array = np.asarray(img, dtype=np.float32).reshape(-1, 4)
+    alpha = img_array[:, 3] / 255.0
+    # Premultiplied, so it's just the color plus what's left of the background
+    blended = img_array[:, :3] + np.array(background_rgb, dtype=np.float32) * (1 - alpha)[:, None]
+    return np.clip(blended, 0, 255), alpha
+
+def dominant_colors_batch(pixel_sets, background_rgb):
+    """
+    Dominant colors for a list of (pixels, weights) as returned by analyze_emoji.
+    All sets with enough pixels are clustered together with one batched_kmeans call.
+    Returns:
+        list: [[(color, proportion), ...], ...] one list per set, biggest proportion first
+    """
+    results = [None] * len(pixel_sets)
+    clustered = []
+    for i, (pixels, weights) in enumerate(pixel_sets):
+        if len(pixels) == 0:
+            # Completely transparent image, use background color
+            results[i] = [(tuple(map(int, background_rgb)), 1.0)]
+        elif len(pixels) <= MIN_KMEANS_PIXELS:
+            # Fallback to simple average for small images
+            results[i] = [(tuple(map(int, np.rint(np.average(pixels, axis=0, weights=weights)))), 1.0)]
+        else:
+            clustered.append((i, pixels, weights))
+
+    if clustered:
+        # Pad every emoji to the same amount of pixels, padding gets a weight of 0 so it doesn't count
+        size = max(len(pixels) for _, pixels, _ in clustered)
+        stacked = np.zeros((len(clustered), size, 3), dtype=np.float32)
+        stacked_weights = np.zeros((len(clustered), size), dtype=np.float32)
+        for row, (_, pixels, weights) in enumerate(clustered):
+            stacked[row, :len(pixels)] = pixels
+            stacked_weights[row, :len(pixels)] = weights
+
+        # Calculate dominant colors using K-means for better representation
+        # E.g. for pixel art, dominant colors are more important than averages
+        centroids, proportions = batched_kmeans(stacked, stacked_weights, KMEANS_CLUSTERS)
+        for row, (i, _, _) in enumerate(clustered):
+            keep = proportions[row] > 0 # Emojis with less than k colors end up with some empty clusters
+            results[i] = [(tuple(map(int, color)), float(proportion))
+                          for color, proportion in zip(np.rint(centroids[row][keep]), proportions[row][keep])]
+    return results
+
+def batched_kmeans(pixels, weights, k=3, max_iter=20, tol=1e-2, seed=0):
+    """
+    K-means (with k-means++ initialization) for lots of pixel sets at once.
+    Args:
+        pixels (np.ndarray): (B, P, 3) one row of pixels per set, padded to the same length
+        weights (np.ndarray): (B, P) weight per pixel, 0 for padding (every row needs some weight)
+        k (int): clusters per set
+        max_iter (int): max iterations
+        tol (float): stop once no centroid moves more than this
+        seed (int): seed for the initialization, every set gets its own generator and stops iterating on its own,
+                    so the same image always gives the same colors no matter what else is in the batch
+    Returns:
+        (np.ndarray, np.ndarray): (B, k, 3) centroids and (B, k) proportions (share of the weight per cluster),
+                                  sorted from biggest to smallest cluster
+    """
+    pixels = np.asarray(pixels, dtype=np.float32)
+    weights = np.asarray(weights, dtype=np.float32)
+    batch = pixels.shape[0]
+    rngs = [np.random.default_rng(seed) for _ in range(batch)]
+    rows = np.arange(batch)
+
+    # K-means++ initialization, for all sets at once
+    centroids = np.empty((batch, k, 3), dtype=np.float32)
+    centroids[:, 0] = pixels[rows, _weighted_choice(rngs, weights)]
+    closest_sq = np.sum((pixels - centroids[:, None, 0]) ** 2, axis=2)
+    for i in range(1, k):
+        probs = weights * closest_sq
+        # Sets with less than i distinct colors can't pick a new one, they just get a duplicate (which ends up empty)
+        flat = probs.sum(axis=1) <= 0
+        probs[flat] = weights[flat]
+        centroids[:, i] = pixels[rows, _weighted_choice(rngs, probs)]
+        closest_sq = np.minimum(closest_sq, np.sum((pixels - centroids[:, None, i]) ** 2, axis=2))
+
+    # Everything needed to sum up the clusters with bincount, which is a lot faster than one hot masks
+    weighted_pixels = pixels * weights[..., None]
+    cluster_offsets = (rows * k)[:, None]
+    flat_weights = weights.ravel()
+    active = np.ones(batch, dtype=bool) # Sets that haven't converged yet
+    final_weight = np.zeros((batch, k), dtype=np.float64)
+    for _ in range(max_iter):
+        # Assign labels, |x - c|^2 = |x|^2 - 2x.c + |c|^2 and |x|^2 is the same for every centroid
+        # so we can leave it out (and the sqrt) and still get the closest one
+        centroid_sq = np.einsum('bkd,bkd->bk', centroids, centroids)
+        labels = np.argmin(centroid_sq[:, None, :] - 2.0 * (pixels @ centroids.transpose(0, 2, 1)), axis=2)
+
+        # Update centroids, weighted mean of the pixels in every cluster
+        flat_labels = (labels + cluster_offsets).ravel()
+        cluster_weight = np.bincount(flat_labels, flat_weights, minlength=batch * k).reshape(batch, k)
+        sums = np.stack([
+            np.bincount(flat_labels, weighted_pixels[..., channel].ravel(), minlength=batch * k) for channel in range(3)
+        ], axis=-1).reshape(batch, k, 3)
+        # Empty clusters keep their old centroid
+        new_centroids = np.where(cluster_weight[..., None] > 0,
+                                 sums / np.maximum(cluster_weight, 1e-12)[..., None], centroids).astype(np.float32)
+        # Sets that already converged stay exactly where they stopped
+        new_centroids = np.where(active[:, None, None], new_centroids, centroids)
+        final_weight = np.where(active[:, None], cluster_weight, final_weight)
+
+        # Check for convergence, per set
+        shift_sq = np.max(np.sum((new_centroids - centroids) ** 2, axis=2), axis=1)
+        centroids = new_centroids
+        active &= shift_sq >= tol * tol
+        if not active.any():
+            break
+
+    # Compute proportions, biggest cluster first
+    # (the total from the clusters, summing the padded weights directly rounds differently depending on the padding)
+    proportions = final_weight / final_weight.sum(axis=1)[:, None]
+    order = np.argsort(-proportions, axis=1, kind='stable')
+    return np.take_along_axis(centroids, order[..., None], axis=1), np.take_along_axis(proportions, order, axis=1)
+
+def _weighted_choice(rngs, weights):
+    """Picks one index per row of weights, with probability proportional to the weight, using one generator per row"""
+    cumulative = np.cumsum(weights, axis=1)
+    targets = np.array([rng.random() for rng in rngs]) * cumulative[:, -1]
+    # First index whose cumulative weight goes past the target (never one with a weight of 0)
+    return np.minimum(np.sum(cumulative <= targets[:, None], axis=1), weights.shape[1] - 1)
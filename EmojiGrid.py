@@ -0,0 +1,78 @@
+import numpy as np
+
+#
+#   The painting itself: a palette index for every cell, stored as one 2D uint16 array
+#   so resizing, re-indexing the palette and filling areas are single array operations instead of nested loops.
+#   Indexing works like the old list of lists (grid[r][c]) as well as numpy style (grid[r, c]).
+#
+
+class EmojiGrid:
+    def __init__(self, rows, cols, fill=0):
+        self.cells = np.full((rows, cols), fill, dtype=np.uint16)
+
+    @classmethod
+    def from_list(cls, rows):
+        """Grid from a list of rows of palette indices (e.g. from a save file or the image converter)"""
+        grid = cls(0, 0)
+        cells = np.array(rows, dtype=np.uint16)
+        grid.cells = cells.reshape(len(rows), -1) if cells.size else np.zeros((len(rows), 0), dtype=np.uint16)
+        return grid
+
+    def tolist(self):
+        """Plain list of rows of ints, what we save to disk"""
+        return self.cells.tolist()
+
+    @property
+    def rows(self):
+        return self.cells.shape[0]
+
+    @property
+    def cols(self):
+        return self.cells.shape[1]
+
+    @property
+    def shape(self):
+        return self.cells.shape
+
+    def __len__(self):
+        return self.rows
+
+    def __getitem__(self, key):
+        return self.cells[key]
+
+    def __setitem__(self, key, value):
+        self.cells[key] = value
+
+    def __iter__(self):
+        return iter(self.cells)
+
+    def copy(self):
+        grid = EmojiGrid(0, 0)
+        grid.cells = self.cells.copy()
+        return grid
+
+    def resize(self, rows, cols, fill=0):
+        """Changes the size, keeping whatever overlaps with the old grid (from the top left)"""
+        cells = np.full((rows, cols), fill, dtype=np.uint16)
+        keep_rows = min(rows, self.rows)
+        keep_cols = min(cols, self.cols)
+        cells[:keep_rows, :keep_cols] = self.cells[:keep_rows, :keep_cols]
+        self.cells = cells
+
+    def fill(self, value, top=0, left=0, bottom=None, right=None):
+        """Sets every cell in rows top..bottom and columns left..right (exclusive, whole grid by default) to value"""
+        self.cells[top:bottom, left:right] = value
+
+    def remap(self, lookup):
+        """Replaces every index i with lookup[i], all at once"""
+        self.cells = np.asarray(lookup, dtype=np.uint16)[self.cells]
+
+    def remove_index(self, index, replacement=0):
+        """
+        For when palette entry index gets removed: its cells become replacement
+        and every higher index moves down by one, like the palette itself
+        """
+        lookup = np.arange(max(int(self.cells.max(initial=0)), index) + 1, dtype=np.int64)
+        lookup[index + 1:] -= 1
+        lookup[index] = replacement
+        self.remap(lookup)
@@ -0,0 +1,219 @@
+import os
+import json
+import time
+import atexit
+import hashlib
+import threading
+import urllib.request
+import urllib.error
+
+#
+#   Local on disk cache for emoji images, shared by the precomputer and the paint app
+#   Files are stored by the hash of their url, entries older than max_age get revalidated with
+#   ETag/Last-Modified, and the least recently used files get evicted once we go over max_bytes
+#
+
+DEFAULT_CACHE_DIR = "emoji_image_cache"
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024   # 256MB
+DEFAULT_MAX_AGE = 7 * 24 * 60 * 60      # Revalidate entries once a week
+INDEX_FLUSH_INTERVAL = 5.0              # Seconds between index writes while we're adding lots of images
+
+class EmojiImageCache:
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES, max_age=DEFAULT_MAX_AGE):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.index_path = os.path.join(directory, "index.json")
+
+        self._lock = threading.RLock()
+        self._entries = {}      # key -> {"url", "size", "etag", "last_modified", "fetched", "last_used"}
+        self._total_bytes = 0
+        self._dirty = False
+        self._last_flush = 0.0
+
+        os.makedirs(directory, exist_ok=True)
+        self._load_index()
+        atexit.register(self.flush)
+
+    @classmethod
+    def shared(cls):
+        """The process wide cache everyone should use, so they all see each other's downloads"""
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    @staticmethod
+    def _key(url):
+        return hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def _load_index(self):
+        try:
+            with open(self.index_path, "r") as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            entries = {}
+        # Drop entries whose file went missing (e.g. someone cleaned the folder by hand)
+        self._entries = {key: entry for key, entry in entries.items() if os.path.exists(self._path(key))}
+        self._total_bytes = sum(entry["size"] for entry in self._entries.values())
+
+    def flush(self):
+        """Writes the index to disk if anything changed"""
+        with self._lock:
+            if not self._dirty:
+                return
+            tmp_path = self.index_path + ".tmp"
+            try:
+                with open(tmp_path, "w") as f:
+                    json.dump(self._entries, f)
+                os.replace(tmp_path, self.index_path)
+                self._dirty = False
+                self._last_flush = time.time()
+            except OSError as e:
+                print(f"Failed to save emoji image cache index: {e}")
+
+    def _mark_dirty(self):
+        self._dirty = True
+        if time.time() - self._last_flush > INDEX_FLUSH_INTERVAL:
+            self.flush()
+
+    def _is_fresh(self, entry):
+        return time.time() - entry["fetched"] <= self.max_age
+
+    def lookup(self, url, allow_stale=False):
+        """Cached bytes for this url, or None if we don't have it (or it needs revalidating)"""
+        key = self._key(url)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if not allow_stale and not self._is_fresh(entry):
+                return None
+            try:
+                with open(self._path(key), "rb") as f:
+                    data = f.read()
+            except OSError:
+                self._remove(key)
+                return None
+            entry["last_used"] = time.time()
+            self._mark_dirty()
+            return data
+
+    def cached_path(self, url):
+        """Path of the cached file for this url (so it can be read somewhere else, e.g. another process), or None"""
+        key = self._key(url)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or not self._is_fresh(entry) or not os.path.exists(self._path(key)):
+                return None
+            entry["last_used"] = time.time()
+            self._mark_dirty()
+            return os.path.abspath(self._path(key))
+
+    def conditional_headers(self, url):
+        """Headers for revalidating a (stale) entry, empty if we don't have it cached"""
+        with self._lock:
+            entry = self._entries.get(self._key(url))
+            headers = {}
+            if entry is not None:
+                if entry.get("etag"):
+                    headers["If-None-Match"] = entry["etag"]
+                if entry.get("last_modified"):
+                    headers["If-Modified-Since"] = entry["last_modified"]
+            return headers
+
+    def mark_revalidated(self, url):
+        """The server told us (304) our copy is still good, returns the cached bytes"""
+        key = self._key(url)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry["fetched"] = time.time()
+        return self.lookup(url)
+
+    def store(self, url, data, etag=None, last_modified=None):
+        key = self._key(url)
+        with self._lock:
+            tmp_path = self._path(key) + ".tmp"
+            try:
+                with open(tmp_path, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, self._path(key))
+            except OSError as e:
+                print(f"Failed to cache emoji image {url}: {e}")
+                return
+            old = self._entries.get(key)
+            if old is not None:
+                self._total_bytes -= old["size"]
+            now = time.time()
+            self._entries[key] = {
+                "url": url,
+                "size": len(data),
+                "etag": etag,
+                "last_modified": last_modified,
+                "fetched": now,
+                "last_used": now,
+            }
+            self._total_bytes += len(data)
+            self._evict()
+            self._mark_dirty()
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._total_bytes -= entry["size"]
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+            self._dirty = True
+
+    def _evict(self):
+        if self._total_bytes <= self.max_bytes:
+            return
+        # Least recently used first, and go a bit below the limit so we don't evict on every store
+        target = self.max_bytes * 0.9
+        for key in sorted(self._entries, key=lambda k: self._entries[k]["last_used"]):
+            if self._total_bytes <= target:
+                break
+            self._remove(key)
+
+    def get(self, url, headers=None, timeout=10, revalidate=False):
+        """
+        Emoji image bytes for this url, only hitting the network if we don't have it or it's due for revalidation.
+        Args:
+            url (str): image url
+            headers (dict): extra request headers (e.g. a User-Agent for discord)
+            timeout (float): request timeout in seconds
+            revalidate (bool): always check with the server if our copy is still up to date
+        Raises:
+            urllib.error.URLError (or anything urlopen raises) if we have to download and that fails
+        """
+        if not revalidate:
+            data = self.lookup(url)
+            if data is not None:
+                return data
+
+        request_headers = dict(headers or {})
+        request_headers.update(self.conditional_headers(url))
+        request = urllib.request.Request(url, headers=request_headers)
+        try:
+            with urllib.request.urlopen(request, timeout=timeout) as response:
+                data = response.read()
+                etag = response.headers.get("ETag")
+                last_modified = response.headers.get("Last-Modified")
+        except urllib.error.HTTPError as e:
+            if e.code == 304:
+                data = self.mark_revalidated(url)
+                if data is not None:
+                    return data
+            raise
+
+        self.store(url, data, etag, last_modified)
+        return data
@@ -1,144 +1,357 @@
 import time
 import numpy as np
 from PIL import Image
-import io
 import os
-try:
-    import aiohttp
-    HAS_AIOHTTP = True
-except ImportError:
-    HAS_AIOHTTP = False
 import asyncio
-import urllib.request
 from urllib.parse import urlparse
-import pickle
 import threading
 import concurrent.futures
-import math
+import json
+import glob
+import hashlib
 from collections import defaultdict, Counter
 
+from ColorSpace import to_distance_space, space_distance, srgb_to_oklab, DISTANCE_MODES, DISTANCE_SCALE
+from EmojiColorIndex import EmojiColorIndex
+from EmojiAliasIndex import EmojiAliasIndex
+from EmojiImageCache import EmojiImageCache
+from DownloadScheduler import DownloadScheduler
+from EmojiFeatures import (extract_emoji_colors_batch, calculate_emoji_colors, hex_to_rgb, MAX_FRAMES,
+                           SIGNATURE_GRID, SIGNATURE_SIZE)
+
+#
+#   Keeps the loaded emoji features around for the whole session, so converting another image
+#   (or opening the converter again, which creates a new EmojiPrecomputer) doesn't touch the disk at all
+#
+
+class EmojiFeatureStore:
+    # Only one set of features is kept, keyed by (emoji JSON version, background color, exclude_gifs)
+    _lock = threading.Lock()
+    _key = None
+    _features = None
+
+    @classmethod
+    def get(cls, key):
+        with cls._lock:
+            return cls._features if cls._features is not None and cls._key == key else None
+
+    @classmethod
+    def put(cls, key, features):
+        with cls._lock:
+            cls._key = key
+            cls._features = features
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            cls._key = None
+            cls._features = None
+
 #
 #   This class precomputes all emojis so it can we can create multiple images without having to recompute every time
-#   saved in emoji_feature_cache.pkl
+#   saved in emoji_feature_cache.npz
 #
 
+FEATURE_CACHE_FILE = "emoji_feature_cache.npz"
+FEATURE_CACHE_FORMAT = 7 # Bump whenever the layout of the feature cache (or the way we calculate features) changes
+PIPELINE_QUEUE_SIZE = 64 # Downloaded images waiting to be analyzed, bounds how many images we hold in memory
+CHECKPOINT_INTERVAL = 15.0 # Seconds between saving partial results while precomputing
+ANALYSIS_CHUNK_SIZE = 16 # Max emojis we send to a worker process at once
+FLICKER_CANDIDATES = 8 # Nearest emojis we compare when penalizing flicker, more only if all of them flicker
+CIEDE2000_CANDIDATES = 16 # Nearest emojis in CIELAB we re-rank with CIEDE2000
+SIGNATURE_COVERAGE_WEIGHT = 0.25 # How much a difference in alpha coverage counts compared to the OKLab cells
+COLOR_LUT_PREFIX = "emoji_color_lut" # Lookup tables are saved as emoji_color_lut_<hash of what they were built for>.npy
+MAX_COLOR_LUTS = 8 # Tables we keep on disk (e.g. one per distance mode), the least recently built ones get removed
+SIGNATURE_MATCH_CHUNK = 1024 # Blocks we compare against the whole palette at once in match_signatures
+
 class EmojiPrecomputer:
+    # Everything that gets shared through the EmojiFeatureStore
+    STORED_ATTRIBUTES = ("emoji_colors", "emoji_temporal_variance", "emoji_signatures", "emoji_clusters",
+                         "palette_names", "palette_rows", "palette_colors", "palette_features", "palette_spaces",
+                         "palette_temporal_variance", "palette_signatures", "color_index", "color_indices", "color_lut", "color_lut_key")
+
     def __init__(self, slack_emojis, slack_emojis_version, background_color, progress_callback):
         self.slack_emojis = slack_emojis
         self.slack_emojis_version = slack_emojis_version
         self.background_color = background_color
         self.exclude_gifs = False
         self.progress_callback = progress_callback
+
+        # Emojis can get downscaled to fit in analysis_size x analysis_size before we look for their dominant colors,
+        # and at most analysis_samples of their pixels get clustered (None to use the full image/every pixel)
+        # Sampling keeps every color exact while downscaling blends edges in to new ones, which changes a lot more
+        # of the matches (see bench_analysis.py), so by default we only sample
+        self.analysis_size = None
+        self.analysis_samples = 1024
+        # Animated emojis get analyzed over up to analysis_frames frames (1 to only use the first frame)
+        self.analysis_frames = MAX_FRAMES
         
         self.emoji_colors = {}      # Cache for emoji average colors
+        self.emoji_temporal_variance = {} # How much animated emojis change over time (missing/0 for still ones)
+        self.emoji_signatures = {}  # Spatial signature per emoji, see EmojiFeatures.spatial_signature
         #self.emoji_patterns = {}    # Cache for emoji patterns/textures
-        self.emoji_images = {}      # Cache for emoji PIL images
         
         self.processed_count = 0
         self.total_emojis = len(self.slack_emojis)
+        self._last_checkpoint = 0.0
+        self._checkpoint = None # Future of the checkpoint that's being written, see _save_checkpoint
+        self._pool = None # Worker pool while precomputing, see _analyze_batch
+        self._workers = 1
         
         self.color_to_emoji_cache = {} # Cache for color to emoji mapping # TODO: still used?
         self.emoji_clusters = {} # Cache for emoji clusters with similar visual properties
         
-        self.color_buckets = defaultdict(list) # TODO
+        # Flat arrays of every emoji's dominant color, used for vectorized matching
+        # (row i of palette_colors/palette_features belongs to palette_names[i])
+        self.palette_names = []
+        self.palette_rows = {}      # name -> row in the palette arrays
+        self.palette_colors = np.zeros((0, 3), dtype=np.uint8)
+        self.palette_features = np.zeros((0, 4), dtype=np.float32)
+        self.palette_spaces = {}    # distance mode -> palette_colors converted with ColorSpace.to_distance_space
+        self.palette_temporal_variance = np.zeros(0, dtype=np.float32)
+        self.palette_signatures = np.zeros((0, SIGNATURE_SIZE), dtype=np.float32) # Used for block matching
+        self.color_index = None # k-d tree over palette_features
+        self.color_indices = {} # distance mode -> k-d tree over palette_spaces[mode], built when first needed
+
+        # How colors get compared, one of ColorSpace.DISTANCE_MODES
+        self.distance_mode = "legacy"
+        # Flickery (animated) emojis get their temporal standard deviation times this added to their distance
+        self.flicker_penalty = 1.0
+
+        # Optional color -> emoji lookup table (see build_color_lut), lut_bits bits per channel
+        self.lut_bits = 6
+        self.color_lut = None
+        self.color_lut_key = None # _color_lut_key() the lookup table was built for
 
     def reset_cache(self):
         self.emoji_colors = {}
+        self.emoji_temporal_variance = {}
+        self.emoji_signatures = {}
         #self.emoji_patterns = {}
-        self.emoji_images = {}
         self.color_to_emoji_cache = {}
         self.emoji_clusters = {}
+        self.palette_names = []
+        self.palette_rows = {}
+        self.palette_colors = np.zeros((0, 3), dtype=np.uint8)
+        self.palette_features = np.zeros((0, 4), dtype=np.float32)
+        self.palette_spaces = {}
+        self.palette_temporal_variance = np.zeros(0, dtype=np.float32)
+        self.palette_signatures = np.zeros((0, SIGNATURE_SIZE), dtype=np.float32)
+        self.color_index = None
+        self.color_indices = {}
+        self.color_lut = None
+        self.color_lut_key = None
+
+    def _store_key(self):
+        return (self.slack_emojis_version, self.background_color, self.exclude_gifs, self._analysis_key())
+
+    def _analysis_key(self):
+        """Analysis settings as stored in the feature cache, features calculated with other settings can't be reused"""
+        return f"{self.analysis_size}/{self.analysis_samples}/{self.analysis_frames}"
+
+    def _analysis_args(self):
+        """Everything after the emojis themselves that extract_emoji_colors_batch needs"""
+        return (hex_to_rgb(self.background_color), self.analysis_size, self.analysis_samples, self.analysis_frames)
+
+    def _save_to_store(self):
+        EmojiFeatureStore.put(self._store_key(), {attr: getattr(self, attr) for attr in self.STORED_ATTRIBUTES})
+
+    def _restore_from_store(self):
+        features = EmojiFeatureStore.get(self._store_key())
+        if features is None:
+            return False
+        for attr, value in features.items():
+            setattr(self, attr, value)
+        # The lookup table might have been built with a different resolution or flicker penalty
+        if self.color_lut is not None and self.color_lut_key != self._color_lut_key():
+            self.color_lut = None
+        self.color_to_emoji_cache = {}
+        return True
+
+    async def _precompute_pending_async(self, pending):
+        """
+        Downloads (through the DownloadScheduler) and analyzes every emoji in pending as a pipeline:
+        images go through a bounded queue straight in to a process pool, so we never hold more than
+        PIPELINE_QUEUE_SIZE images in memory and the analysis runs while we're still waiting on the network
+        """
+        self.processed_count = 0
+        self.total_emojis = len(pending)
+        self._last_checkpoint = time.time()
+        image_cache = EmojiImageCache.shared()
+        queue = asyncio.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+        analysis_args = self._analysis_args()
+
+        # Emojis we already have locally don't need to go through the scheduler at all,
+        # for those we only send the file path to the workers and let them read it themselves
+        cached = []
+        to_download = {}
+        for name, url in pending.items():
+            parsed_url = urlparse(url)
+            if not parsed_url.scheme or not parsed_url.netloc:
+                print(f"Invalid URL for emoji {name}: {url}")
+                self.total_emojis -= 1
+                continue
+            path = image_cache.cached_path(url)
+            if path is not None:
+                cached.append((name, path))
+            else:
+                to_download[name] = url
 
-    def _download_emoji_image(self, name, url):
+        # No point in starting more processes than there are chunks to analyze (e.g. when only one emoji is new)
+        workers = max(1, min(os.cpu_count() or 1, -(-self.total_emojis // ANALYSIS_CHUNK_SIZE)))
+        self._workers = workers
+        self._pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
         try:
-            if name in self.emoji_images:
-                return self.emoji_images[name]
-            with urllib.request.urlopen(url, timeout=5) as response:
-                img_data = response.read()
-            img = Image.open(io.BytesIO(img_data)).convert('RGBA')
-            self.emoji_images[name] = img
-            return img
-        except Exception as e:
-            print(f"Failed to download emoji {name}: {e}")
-            return None
-
-    # All the async functions were an attempt at making the precomuting go faster before realizing slack is probably just ratelimiting us...
-    # however it does make it a bit faster at the cost of a additional library so leaving it but only using it if the library is already installed 
-    async def _download_emoji_image_async(self, name, url):
+            if not to_download:
+                # Everything is on disk already, no need for the queue, just hand out big chunks
+                await self._analyze_cached_async(cached, analysis_args, workers)
+                return
+
+            async def feed_cached():
+                for item in cached:
+                    await queue.put(item)
+
+            async def on_complete(name, url, result):
+                img_data = None
+                if result is not None and result.status == 304:
+                    img_data = image_cache.mark_revalidated(url)
+                elif result is not None:
+                    img_data = result.data
+                    image_cache.store(url, img_data, result.headers.get("etag"), result.headers.get("last-modified"))
+                if img_data is None:
+                    self._emojis_processed(1) # The scheduler already told us why
+                else:
+                    await queue.put((name, img_data))
+
+            async def feed_downloads():
+                scheduler = DownloadScheduler()
+                stats = await scheduler.download_all(to_download, on_complete, headers_for=image_cache.conditional_headers)
+                print(f"Emoji downloads: {stats.summary()}")
+
+            async def analyze():
+                finished = False
+                while not finished:
+                    item = await queue.get()
+                    if item is None:
+                        return
+                    # Grab whatever else is already waiting (up to a chunk) so we send it to the pool in one go
+                    batch = [item]
+                    while len(batch) < ANALYSIS_CHUNK_SIZE and not queue.empty():
+                        item = queue.get_nowait()
+                        if item is None:
+                            finished = True
+                            break
+                        batch.append(item)
+                    results = await self._analyze_batch(batch, analysis_args)
+                    del batch, item # Don't keep the images alive while we wait for the next ones
+                    self._store_analysis_results(results)
+
+            async def produce():
+                await asyncio.gather(feed_cached(), feed_downloads())
+                for _ in consumers:
+                    await queue.put(None)
+
+            # A few more consumers than workers so the pool never sits idle waiting for us
+            consumers = [asyncio.create_task(analyze()) for _ in range(workers + 2)]
+            tasks = [asyncio.create_task(produce())] + consumers
+            try:
+                # Fails as soon as any of them does, otherwise the producers would block forever on a
+                # full queue once every consumer died
+                await asyncio.gather(*tasks)
+            finally:
+                for task in tasks:
+                    task.cancel()
+                # Let the scheduler close its connections before we go on
+                await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            self._pool.shutdown()
+            self._pool = None
+
+    async def _analyze_cached_async(self, cached, analysis_args, workers):
+        """Analyzes emojis that are all in the local image cache, [(name, path), ...], spread evenly over the workers"""
+        # Small enough chunks that every worker gets a few (so one slow chunk doesn't hold up the end),
+        # big enough that the inter process overhead doesn't matter
+        chunk_size = max(1, min(ANALYSIS_CHUNK_SIZE * 4, len(cached) // (workers * 4)))
+        chunks = [cached[i:i + chunk_size] for i in range(0, len(cached), chunk_size)]
+        futures = [self._analyze_batch(chunk, analysis_args) for chunk in chunks]
+        for future in asyncio.as_completed(futures):
+            self._store_analysis_results(await future)
+
+    async def _analyze_batch(self, batch, analysis_args):
+        """
+        Runs extract_emoji_colors_batch on the worker pool. Process pools only find out they can't start
+        (or lost a worker) once we submit something, in that case we switch to threads and retry the batch there.
+        """
+        loop = asyncio.get_running_loop()
+        pool = self._pool
+        try:
+            return await loop.run_in_executor(pool, extract_emoji_colors_batch, batch, *analysis_args)
+        except (concurrent.futures.BrokenExecutor, OSError) as e:
+            if isinstance(pool, concurrent.futures.ThreadPoolExecutor):
+                raise
+            if self._pool is pool: # The first batch that notices switches, the others just retry
+                print(f"Couldn't use worker processes, analyzing emojis on threads instead: {e!r}")
+                self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=self._workers)
+                pool.shutdown(wait=False)
+            return await loop.run_in_executor(self._pool, extract_emoji_colors_batch, batch, *analysis_args)
+
+    def _store_analysis_results(self, results):
+        """Puts the results of extract_emoji_colors_batch in to emoji_colors, emoji_temporal_variance and emoji_signatures"""
+        for name, colors, proportions, temporal_variance, signature, error in results:
+            if error is not None:
+                print(f"Error processing {name}: {error}")
+                continue
+            self.emoji_colors[name] = list(zip(map(tuple, colors.tolist()), proportions.tolist()))
+            self.emoji_temporal_variance[name] = temporal_variance
+            self.emoji_signatures[name] = signature
+        self._emojis_processed(len(results))
+
+    def _emojis_processed(self, count):
+        previous_percent = int(100 * self.processed_count / max(1, self.total_emojis))
+        self.processed_count += count
+        percent = int(100 * self.processed_count / max(1, self.total_emojis))
+        if percent != previous_percent: # Only update when there's something to show
+            self.progress_callback(percent)
+        # Save what we have every now and then, if we get interrupted the next run only has to do the rest
+        if time.time() - self._last_checkpoint > CHECKPOINT_INTERVAL:
+            self._save_checkpoint()
+            self._last_checkpoint = time.time()
+
+    def _save_checkpoint(self):
+        """
+        Saves the partial results without blocking the event loop: the columns are collected right here
+        (the features only change on the loop), writing the file happens on a thread
+        """
+        if self._checkpoint is not None and not self._checkpoint.done():
+            return # Still writing the last one
+        cache_data = self._feature_cache_columns(complete=False)
+        self._checkpoint = asyncio.get_running_loop().run_in_executor(None, self._write_checkpoint, cache_data)
+
+    @staticmethod
+    def _write_checkpoint(cache_data):
         try:
-            # Add small delay to be nice to Slack's servers
-            #await asyncio.sleep(0.01)  # 10ms delay between requests
+            EmojiPrecomputer._write_feature_cache(cache_data)
+        except OSError as e:
+            print(f"Failed to save emoji feature checkpoint: {e}")
 
-            # Initialize session if needed
-            if self.session is None:
-                self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10))
-                
-            # Parse URL to check if it's valid
-            parsed_url = urlparse(url)
-            if not parsed_url.scheme or not parsed_url.netloc:
-                print(f"Invalid URL for emoji {name}: {url}")
-                return None
-                
-            async with self.session.get(url) as response:
-                if response.status != 200:
-                    print(f"Failed to download emoji {name}: HTTP {response.status}")
-                    return None
-                    
-                img_data = await response.read()
-                
-            # Process the image
-            img = Image.open(io.BytesIO(img_data)).convert('RGBA')
-            self.emoji_images[name] = img
-            return img
-        except asyncio.TimeoutError:
-            print(f"Timeout downloading emoji {name}")
-            return None
-        except Exception as e:
-            print(f"Failed to download emoji {name}: {e}")
-            return None
+    async def _wait_for_checkpoint(self):
+        # The final save writes the same file, so let a checkpoint that's still being written finish first
+        if self._checkpoint is not None:
+            await self._checkpoint
+            self._checkpoint = None
 
-    def _download_emoji_batch(self, emoji_batch):
-        #max_workers = min(os.cpu_count() * 2 or 8, 32)  # Increased workers for I/O bound task
-        # Reduced workers to avoid overwhelming Slack's servers
-        max_workers = min(8, len(emoji_batch))  # Max 10 concurrent downloads
-        
-        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-            future_to_emoji = {
-                executor.submit(self._download_emoji_image, name, url): name
-                for name, url in emoji_batch.items()
-            }
-            
-            # Process results as they complete
-            for future in concurrent.futures.as_completed(future_to_emoji):
-                name = future_to_emoji[future]
-                try:
-                    img = future.result()
-                    if img is not None:
-                        self._calculate_emoji_features(name, img)
-                except Exception as e:
-                    print(f"Error processing {name}: {e}")
-
-                self.processed_count += 1
-                if self.processed_count % 10 == 0: # We update in intervals
-                    self.progress_callback(int(100 * self.processed_count / self.total_emojis))
-
-    async def _download_emoji_batch_async(self, emoji_batch):
-        tasks = []
-        for name, url in emoji_batch.items():
-            tasks.append(self._download_emoji_image_async(name, url))
-            
-        results = await asyncio.gather(*tasks, return_exceptions=True)
-        
-        for (name, _), result in zip(emoji_batch.items(), results):
-            if isinstance(result, Exception):
-                print(f"Error downloading {name}: {result}")
-            elif result is not None:
-                self._calculate_emoji_features(name, result)
+    def _finish_precompute(self):
+        # Build index for faster lookup
+        if len(self.emoji_colors) > 0:
+            self._build_color_index()
+            self._build_emoji_clusters()
             
-            self.processed_count += 1
-            if self.processed_count % 10 == 0:  # Update progress less frequently
-                self.progress_callback(int(100 * self.processed_count / self.total_emojis))
-                        
+        # Save the result for this run
+        self.save_emoji_feature_cache()
+        EmojiImageCache.shared().flush()
+        # we reload so we can exclude gifs if wanted
+        self.load_emoji_feature_cache()
+
     def _calculate_emoji_features(self, name, img):
         self._calculate_emoji_color_kmeans(name, img)
         #self._calculate_emoji_color_freq(name, img)
@@ -198,187 +411,192 @@ class EmojiPrecomputer:
             self.emoji_colors[name] = [(tuple(bg[0, 0]), 1.0)]
 
     def _calculate_emoji_color_kmeans(self, name, img):
-        img_array = np.array(img).astype(np.float32)
-        
-        # Extract RGB and Alpha
-        rgb = img_array[..., :3]
-        alpha = img_array[..., 3] / 255.0
-        
-        # Background color (Slack dark mode)
-        #bg = np.array([34, 37, 41], dtype=np.float32)
-        # Turns hex in to rgb
-        bg = np.array([int(self.background_color[i:i+2], 16) for i in (1, 3, 5)], dtype=np.float32)
-        bg = np.broadcast_to(bg, rgb.shape)
-        
-        # Linear interpolation with alpha
-        alpha_expanded = alpha[..., None]
-        blended = rgb * alpha_expanded + bg * (1 - alpha_expanded)
-        
-        # Convert to Lab color space for better perceptual representation
-        # We use a simplified RGB to Lab conversion since we don't need full accuracy
-        # First, get only pixels with significant alpha (non-transparent)
-        significant_alpha = alpha > 0.001 # TODO: maybe use transparency aswell
-        if np.any(significant_alpha):
-            pixels = blended[significant_alpha].reshape(-1, 3)
-            
-            # Calculate dominant colors using K-means for better representation
-            # E.g. for pixel art, dominant colors are more important than averages
-            if len(pixels) > 100:  # Only if we have enough pixels
-                try:
-                    k = min(5, len(pixels) // 10)
-                    colors, labels = self.simple_kmeans(pixels, k)
-                    counts = np.bincount(labels)
-                    proportions = counts / len(pixels)
-                    
-                    # Store as a list of (color, proportion) tuples
-                    self.emoji_colors[name] = [(tuple(map(int, color)), prop) for color, prop in zip(colors, proportions)]
-                except:
-                    # Fallback to simple average
-                    avg_color = np.mean(pixels, axis=0)
-                    self.emoji_colors[name] = [(tuple(map(int, avg_color)), 1.0)]
-            else:
-                # Fallback to simple average for small images
-                avg_color = np.mean(pixels, axis=0)
-                self.emoji_colors[name] = [(tuple(map(int, avg_color)), 1.0)]
-        else:
-            # Completely transparent image, use background color
-            self.emoji_colors[name] = [(tuple(map(int, bg[0, 0])), 1.0)]
-    
-    def simple_kmeans(self, pixels, k=3, max_iter=20, tol=1e-4, seed=0):
-        np.random.seed(seed)
-        n_samples = pixels.shape[0]
-
-        # K-means++ initialization
-        centroids = [pixels[np.random.choice(n_samples)]]
-        for _ in range(1, k):
-            dists = np.min(np.linalg.norm(pixels[:, None] - np.array(centroids)[None, :], axis=2)**2, axis=1)
-            total = np.sum(dists)
-            if total == 0:
-                probs = np.ones_like(dists) / len(dists)
-            else:
-                probs = dists / total
-            centroids.append(pixels[np.random.choice(n_samples, p=probs)])
-        centroids = np.array(centroids)
-
-        for _ in range(max_iter):
-            # Assign labels
-            distances = np.linalg.norm(pixels[:, None] - centroids[None, :], axis=2)
-            labels = np.argmin(distances, axis=1)
-
-            # Update centroids
-            new_centroids = []
-            for i in range(k):
-                cluster_points = pixels[labels == i]
-                if len(cluster_points) > 0:
-                    centroid = cluster_points.mean(axis=0)
-                else:
-                    # Reinitialize empty cluster with a random pixel
-                    centroid = pixels[np.random.choice(n_samples)]
-                new_centroids.append(centroid)
-            new_centroids = np.array(new_centroids)
-
-
-            # Check for convergence
-            if np.linalg.norm(new_centroids - centroids) < tol:
-                break
-            centroids = new_centroids
-
-        # Compute proportions
-        counts = np.bincount(labels, minlength=k)
-        proportions = counts / n_samples
+        self.emoji_colors[name], self.emoji_temporal_variance[name], self.emoji_signatures[name] = \
+            calculate_emoji_colors(img, *self._analysis_args())
+
+    def save_emoji_feature_cache(self, filename=FEATURE_CACHE_FILE, complete=True):
+        """
+        Saves the features as flat columns (see FEATURE_CACHE_FORMAT):
+            version         emoji JSON version, empty for a partial save (complete=False) so it never counts
+                            as a full cache, _collect_pending_emojis still reuses its entries though
+            names           utf-8 blob of all emoji names joined by newlines
+            urls            same for the url every emoji was computed from, so we can reuse entries per emoji
+            color_offsets   (N + 1) int32, colors of emoji i are colors[color_offsets[i]:color_offsets[i + 1]]
+            colors          (T, 3) uint8 dominant colors
+            proportions     (T,) float32 share of the emoji each color covers
+            is_gif          (N,) bool
+            temporal_variance (N,) float32 how much the emoji changes over its animation (0 if it isn't animated)
+            signatures      (N, SIGNATURE_SIZE) float32 spatial signature (see EmojiFeatures.spatial_signature)
+            analysis        analysis settings the features were calculated with (see _analysis_key)
+            index_*         the k-d tree over the dominant colors (built for every emoji in names)
+        """
+        self._write_feature_cache(self._feature_cache_columns(complete), filename)
+
+    def _feature_cache_columns(self, complete=True):
+        """The columns save_emoji_feature_cache writes"""
+        names = list(self.emoji_colors.keys())
+        counts = np.array([len(self.emoji_colors[name]) for name in names], dtype=np.int32)
+        offsets = np.zeros(len(names) + 1, dtype=np.int32)
+        np.cumsum(counts, out=offsets[1:])
+        all_colors = [entry for name in names for entry in self.emoji_colors[name]]
 
-        return list(zip([tuple(map(int, c)) for c in centroids], proportions))
-
-    def save_emoji_feature_cache(self, filename="emoji_feature_cache.pkl"):
         cache_data = {
-            "version": self.slack_emojis_version,
-            "colors": self.emoji_colors,
-            "clusters": self.emoji_clusters, # TODO: check what else needs saving
-            "color_buckets": self.color_buckets,
+            "format": np.int32(FEATURE_CACHE_FORMAT),
+            "version": np.str_(str(self.slack_emojis_version) if complete else ""),
+            "background_color": np.str_(self.background_color),
+            "analysis": np.str_(self._analysis_key()),
+            "names": self._encode_strings(names),
+            "urls": self._encode_strings([self.slack_emojis[name] for name in names]),
+            "color_offsets": offsets,
+            "colors": np.array([color for color, _ in all_colors], dtype=np.uint8).reshape(-1, 3),
+            "proportions": np.array([proportion for _, proportion in all_colors], dtype=np.float32),
+            "is_gif": np.array([self.slack_emojis[name].lower().endswith('.gif') for name in names], dtype=bool),
+            "temporal_variance": np.array([self.emoji_temporal_variance.get(name, 0.0) for name in names], dtype=np.float32),
+            "signatures": self._stack_signatures(names),
             #"patterns": self.emoji_patterns,
-            "is_gif_flags": {
-                name: self.slack_emojis[name].lower().endswith('.gif')
-                for name in self.emoji_colors
-            }
         }
-        with open(filename, "wb") as f:
-            pickle.dump(cache_data, f)
-
-    def load_emoji_feature_cache(self, filename="emoji_feature_cache.pkl"):
-        if os.path.exists(filename):
-            with open(filename, "rb") as f:
-                cache_data = pickle.load(f)
-                version = cache_data.get("version", None)
-                if(version == None or version != self.slack_emojis_version):
-                    return False
-                all_colors = cache_data.get("colors", {})
-                #all_patterns = cache_data.get("patterns", {})
-                all_clusters = cache_data.get("clusters", {})
-                all_buckets = cache_data.get("color_buckets", {})
-                is_gif_flags = cache_data.get("is_gif_flags", {})
-
-                if self.exclude_gifs:
-                    # Filter out GIFs using the flag dictionary
-                    filtered_keys = [k for k in all_colors if not is_gif_flags.get(k, False)]
-                else:
-                    filtered_keys = list(all_colors.keys())
-
-                self.emoji_colors = {k: all_colors[k] for k in filtered_keys}
-                #self.emoji_patterns = {k: all_patterns.get(k, {}) for k in filtered_keys}
-                self.emoji_clusters = {
-                    cluster_key: filtered_emojis
-                    for cluster_key, emoji_list in all_clusters.items()
-                    if (filtered_emojis := [e for e in emoji_list if e in filtered_keys])
-                }
-                self.color_buckets = {
-                    bucket_key: filtered_emojis
-                    for bucket_key, emoji_list in all_buckets.items()
-                    if (filtered_emojis := [e for e in emoji_list if e in filtered_keys])
+        if complete and self.color_index is not None and self.palette_names == names:
+            cache_data.update({f"index_{key}": value for key, value in self.color_index.to_dict().items()})
+        cache_data.update(self.get_alias_index().to_columns())
+        return cache_data
+
+    @staticmethod
+    def _write_feature_cache(cache_data, filename=FEATURE_CACHE_FILE):
+        # np.savez would add .npz to the name itself if it's missing, writing through a file object prevents that
+        # and writing to a temporary file first means we never leave a half written cache behind
+        tmp_filename = filename + ".tmp"
+        with open(tmp_filename, "wb") as f:
+            np.savez(f, **cache_data)
+        os.replace(tmp_filename, filename)
+
+    @staticmethod
+    def _encode_strings(strings):
+        return np.frombuffer("\n".join(strings).encode("utf-8"), dtype=np.uint8)
+
+    @staticmethod
+    def _decode_strings(blob):
+        text = blob.tobytes().decode("utf-8")
+        return text.split("\n") if text else []
+
+    def _read_feature_cache(self, filename=FEATURE_CACHE_FILE):
+        """Reads the raw columns of the feature cache, returns None if there's no usable cache"""
+        if not os.path.exists(filename):
+            return None
+        try:
+            with np.load(filename, allow_pickle=False) as cache_data:
+                if int(cache_data["format"]) != FEATURE_CACHE_FORMAT:
+                    return None
+                return {
+                    "version": str(cache_data["version"]),
+                    "background_color": str(cache_data["background_color"]),
+                    "analysis": str(cache_data["analysis"]),
+                    "names": self._decode_strings(cache_data["names"]),
+                    "urls": self._decode_strings(cache_data["urls"]),
+                    "color_offsets": cache_data["color_offsets"],
+                    "colors": cache_data["colors"],
+                    "proportions": cache_data["proportions"],
+                    "is_gif": cache_data["is_gif"],
+                    "temporal_variance": cache_data["temporal_variance"],
+                    "signatures": cache_data["signatures"],
+                    "index": {key[len("index_"):]: cache_data[key] for key in cache_data.files if key.startswith("index_")},
                 }
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Failed to load emoji feature cache: {e}")
+            return None
 
+    @staticmethod
+    def _unpack_emoji_colors(cache, rows):
+        """Turns the flat color columns back in to {name: [(color, proportion), ...]} for the given rows"""
+        names = cache["names"]
+        color_list = [tuple(color) for color in cache["colors"].tolist()]
+        proportion_list = cache["proportions"].tolist()
+        offsets = cache["color_offsets"].tolist()
+        return {
+            names[i]: list(zip(color_list[offsets[i]:offsets[i + 1]], proportion_list[offsets[i]:offsets[i + 1]]))
+            for i in rows
+        }
 
-                if self.emoji_colors:
-                    self._build_color_index()
-                    print(f"Loaded {len(self.emoji_colors)} emoji features from cache.")
-                    return True
+    @staticmethod
+    def _unpack_temporal_variance(cache, rows):
+        names = cache["names"]
+        variance = cache["temporal_variance"].tolist()
+        return {names[i]: variance[i] for i in rows if variance[i] > 0}
+
+    @staticmethod
+    def _unpack_signatures(cache, rows):
+        names = cache["names"]
+        signatures = cache["signatures"]
+        return {names[i]: signatures[i] for i in rows}
+
+    def _stack_signatures(self, names):
+        """(len(names), SIGNATURE_SIZE) float32 signatures, emojis without one get a flat, opaque one of their dominant color"""
+        signatures = np.empty((len(names), SIGNATURE_SIZE), dtype=np.float32)
+        for i, name in enumerate(names):
+            signature = self.emoji_signatures.get(name)
+            if signature is None:
+                lab = srgb_to_oklab(np.array(self.emoji_colors[name][0][0], dtype=np.float32))
+                signature = np.append(np.tile(lab, SIGNATURE_GRID * SIGNATURE_GRID), 1.0)
+            signatures[i] = signature
+        return signatures
+
+    def load_emoji_feature_cache(self, filename=FEATURE_CACHE_FILE):
+        cache = self._read_feature_cache(filename)
+        if cache is None or cache["version"] != str(self.slack_emojis_version) or not self._cache_settings_match(cache):
+            return False
+
+        # Filter out GIFs with a mask instead of going through every name
+        keep = ~cache["is_gif"] if self.exclude_gifs else np.ones(len(cache["names"]), dtype=bool)
+        rows = np.flatnonzero(keep).tolist()
+        self.emoji_colors = self._unpack_emoji_colors(cache, rows)
+        self.emoji_temporal_variance = self._unpack_temporal_variance(cache, rows)
+        self.emoji_signatures = self._unpack_signatures(cache, rows)
+        #self.emoji_patterns = {k: all_patterns.get(k, {}) for k in filtered_keys}
+
+        if self.emoji_colors:
+            self._build_emoji_clusters()
+            saved_index = cache["index"]
+            if saved_index:
+                saved_index["names"] = cache["names"]
+            self._build_color_index(saved_index or None)
+            self._save_to_store()
+            print(f"Loaded {len(self.emoji_colors)} emoji features from cache.")
+            return True
         return False
 
-    def precompute_all_emoji_colors(self):  # Reduced batch size
+    def _cache_settings_match(self, cache):
+        # Features are blended with the background, so they can only be reused for the same background
+        # (and the same analysis settings)
+        return cache["background_color"] == self.background_color and cache["analysis"] == self._analysis_key()
+
+    def _collect_pending_emojis(self, filename=FEATURE_CACHE_FILE):
+        """
+        Reuses every cached feature whose emoji still points to the same image (even if the JSON itself changed)
+        and returns the emojis that still need to be downloaded, emojis that got removed are simply dropped
+        """
+        self.emoji_colors = {}
+        self.emoji_temporal_variance = {}
+        self.emoji_signatures = {}
+        cache = self._read_feature_cache(filename)
+        if cache is not None and self._cache_settings_match(cache):
+            rows = [i for i, (name, url) in enumerate(zip(cache["names"], cache["urls"]))
+                    if self.slack_emojis.get(name) == url]
+            self.emoji_colors = self._unpack_emoji_colors(cache, rows)
+            self.emoji_temporal_variance = self._unpack_temporal_variance(cache, rows)
+            self.emoji_signatures = self._unpack_signatures(cache, rows)
+            if rows:
+                print(f"Reusing {len(rows)} cached emoji features.")
+        return {name: url for name, url in self.slack_emojis.items() if name not in self.emoji_colors}
+
+    def precompute_all_emoji_colors(self):
         start_time = time.time()
+        if self._restore_from_store():
+            return  # Already loaded earlier this session
         if self.load_emoji_feature_cache():
             return  # Skip download if loaded from cache
-        
-        #batch_size=500
-        batch_size = math.ceil(self.total_emojis / 8)
 
-        # techniqually we check load_emoji_feature_cache in the cahce function aswell,
+        # techniqually we check load_emoji_feature_cache in the async function aswell,
         # but no point in unessesarly starting asyncio
-        if HAS_AIOHTTP:
-            asyncio.run(self.precompute_all_emoji_colors_async(batch_size))
-            print(f"Precomputeing all emojis completed in {time.time() - start_time:.2f} seconds")
-            return
-            
-        self.processed_count = 0
-        self.total_emojis = len(self.slack_emojis)
-        
-        # Process emojis in smaller batches to avoid overwhelming Slack
-        emoji_items = list(self.slack_emojis.items())
-        for i in range(0, self.total_emojis, batch_size):
-            batch = dict(emoji_items[i:i+batch_size])
-            self._download_emoji_batch(batch)
-            
-            # Add a small delay between batches to be extra nice to Slack
-            #time.sleep(0.1)  # 100ms delay between batches
-            
-        # Build index for faster lookup
-        if len(self.emoji_colors) > 0:
-            self._build_color_index()
-            self._build_emoji_clusters()
-            
-        # Save the result for this run
-        self.save_emoji_feature_cache()
-        # we reload so we can exclude gifs if wanted
-        self.load_emoji_feature_cache()
+        asyncio.run(self.precompute_all_emoji_colors_async())
         print(f"Precomputeing all emojis completed in {time.time() - start_time:.2f} seconds")
 
     def _build_emoji_clusters(self):
@@ -402,70 +620,218 @@ class EmojiPrecomputer:
         # Store the clusters
         self.emoji_clusters = dict(color_groups)
     
-    def _build_color_index(self):
-        """Build a color to emoji lookup structure for faster matching"""
-        # Quantize colors to reduce search space
-        self.color_buckets = defaultdict(list)
-        
-        for name, colors in self.emoji_colors.items():
-            if not colors:
-                continue
-                
-            # Use the first (dominant) color for indexing
-            dominant_color, proportion = colors[0]
-            quantized = (dominant_color[0] // 4, dominant_color[1] // 4, dominant_color[2] // 4)
-            self.color_buckets[quantized].append((name, dominant_color))
+    def _build_color_index(self, saved_index=None):
+        """Build a k-d tree over the dominant emoji colors for fast (and exact) nearest emoji lookups"""
+        self._build_palette_arrays()
+        self.color_lut = None # Palette changed so any lookup table we had is stale
+        self.color_indices = {}
+        if not self.palette_names:
+            self.color_index = None
+            return
+
+        # The saved index is built over every emoji, so we can only reuse it if nothing got filtered out (e.g. gifs)
+        if saved_index is not None and saved_index["names"] == self.palette_names:
+            self.color_index = EmojiColorIndex.from_dict(saved_index)
+        else:
+            self.color_index = EmojiColorIndex(self.palette_features)
+        self.color_indices["legacy"] = self.color_index
+
+    def _build_palette_arrays(self):
+        """Stack the dominant color of every emoji so we can match whole images with array math"""
+        self.palette_names = [name for name, colors in self.emoji_colors.items() if colors]
+        self.palette_rows = {name: i for i, name in enumerate(self.palette_names)}
+        self.palette_colors = np.array(
+            [self.emoji_colors[name][0][0] for name in self.palette_names], dtype=np.uint8
+        ).reshape(-1, 3)
+        # The dominant colors converted to the space of every distance mode, so we never have to convert them again
+        self.palette_spaces = {mode: to_distance_space(self.palette_colors, mode) for mode in DISTANCE_MODES}
+        self.palette_features = self.palette_spaces["legacy"]
+        self.palette_temporal_variance = np.array(
+            [self.emoji_temporal_variance.get(name, 0.0) for name in self.palette_names], dtype=np.float32
+        )
+        self.palette_signatures = self._stack_signatures(self.palette_names)
+
+    def get_alias_index(self):
+        """Shortest names for every emoji image (see EmojiAliasIndex), shared with everything else that loaded this JSON"""
+        return EmojiAliasIndex.for_emojis(self.slack_emojis, FEATURE_CACHE_FILE)
+
+    def get_color_index(self, mode=None):
+        """k-d tree over the palette in the space of the given distance mode (distance_mode by default)"""
+        mode = mode or self.distance_mode
+        if mode not in self.color_indices:
+            self.color_indices[mode] = EmojiColorIndex(self.palette_spaces[mode])
+        return self.color_indices[mode]
+
+    def match_rgb(self, colors):
+        """
+        Best emoji for every color using distance_mode, the closest one by dominant color unless that one
+        flickers too much.
+        Args:
+            colors (np.ndarray): (N, 3) uint8 RGB colors
+        Returns:
+            np.ndarray: (N,) indices in to palette_names
+        """
+        mode = self.distance_mode
+        features = to_distance_space(np.asarray(colors, dtype=np.uint8).reshape(-1, 3), mode)
+        index = self.get_color_index(mode)
+        flicker = self.flicker_penalty * np.sqrt(self.palette_temporal_variance)
+
+        if mode == "ciede2000":
+            # There's no tree for CIEDE2000, so take the closest candidates in CIELAB and pick between those
+            _, candidates = index.query(features, k=CIEDE2000_CANDIDATES)
+            cost = space_distance(features[:, None, :], self.palette_spaces[mode][candidates], mode)
+            if self.flicker_penalty > 0:
+                cost = cost + flicker[candidates]
+            return candidates[np.arange(len(features)), np.argmin(cost, axis=1)]
+
+        if self.flicker_penalty <= 0 or not np.any(self.palette_temporal_variance > 0):
+            _, nearest = index.query(features, k=1)
+            return nearest[:, 0]
+
+        scale = DISTANCE_SCALE[mode]
+        best = np.empty(len(features), dtype=np.int64)
+        rows = np.arange(len(features))
+        k = FLICKER_CANDIDATES
+        while len(rows):
+            distances, candidates = index.query(features[rows], k=k)
+            distances = distances * scale
+            cost = distances + flicker[candidates]
+            pick = np.argmin(cost, axis=1)
+            best[rows] = candidates[np.arange(len(rows)), pick]
+            # Anything we didn't look at is at least as far away as the k-th candidate (and the penalty only adds),
+            # so the pick is exact unless all candidates flickered so much that the k-th distance is still lower
+            unsure = cost[np.arange(len(rows)), pick] > distances[:, -1]
+            if k >= len(self.palette_names) or not np.any(unsure):
+                break
+            rows = rows[unsure]
+            k = min(k * 4, len(self.palette_names))
+        return best
+
+    @staticmethod
+    def _signature_space(signatures):
+        """
+        Weights the signatures so the plain euclidean distance between them is the root mean square OKLab distance
+        of their cells (plus the weighted coverage difference), scaled like the other distance modes
+        """
+        weights = np.full(SIGNATURE_SIZE, 1.0 / SIGNATURE_GRID, dtype=np.float32) # 1 / sqrt(cells)
+        weights[-1] = SIGNATURE_COVERAGE_WEIGHT
+        return np.asarray(signatures, dtype=np.float32) * (weights * DISTANCE_SCALE["oklab"])
+
+    def match_signatures(self, signatures):
+        """
+        Best emoji for every block of a source image by spatial signature (see EmojiFeatures.block_signatures),
+        so an emoji that's light on top and dark at the bottom goes where the source is too.
+        Compares every block against the whole palette with one matrix product per chunk of blocks,
+        |q - p|^2 = |q|^2 - 2q.p + |p|^2 where |q|^2 doesn't change which emoji is closest.
+        Args:
+            signatures (np.ndarray): (N, SIGNATURE_SIZE) block signatures
+        Returns:
+            np.ndarray: (N,) indices in to palette_names
+        """
+        queries = self._signature_space(np.asarray(signatures).reshape(-1, SIGNATURE_SIZE))
+        palette = self._signature_space(self.palette_signatures)
+        palette_sq = np.einsum('nd,nd->n', palette, palette)
+        flicker = self.flicker_penalty * np.sqrt(self.palette_temporal_variance) \
+            if self.flicker_penalty > 0 and np.any(self.palette_temporal_variance > 0) else None
+
+        best = np.empty(len(queries), dtype=np.int64)
+        for start in range(0, len(queries), SIGNATURE_MATCH_CHUNK):
+            chunk = queries[start:start + SIGNATURE_MATCH_CHUNK]
+            cost = palette_sq - 2.0 * (chunk @ palette.T)
+            if flicker is not None:
+                # The penalty is added to the distance itself, so we do need the full distances here
+                cost = np.sqrt(np.maximum(cost + np.einsum('nd,nd->n', chunk, chunk)[:, None], 0)) + flicker
+            best[start:start + SIGNATURE_MATCH_CHUNK] = np.argmin(cost, axis=1)
+        return best
+
+    def _color_lut_key(self):
+        """Everything the lookup table depends on, if any of this changes the table needs rebuilding"""
+        return {
+            "version": str(self.slack_emojis_version),
+            "background_color": self.background_color,
+            "bits": self.lut_bits,
+            "analysis": self._analysis_key(),
+            "flicker_penalty": self.flicker_penalty,
+            "distance_mode": self.distance_mode,
+            # Covers the emoji set itself and things like exclude_gifs
+            "palette": hashlib.sha1("\n".join(self.palette_names).encode("utf-8")).hexdigest(),
+        }
+
+    def get_color_lut(self, prefix=COLOR_LUT_PREFIX):
+        """
+        Lookup table mapping every (quantized) RGB color to its closest emoji,
+        lut[r >> shift, g >> shift, b >> shift] is an index in to palette_names (shift = 8 - lut_bits).
+        Loaded (memory mapped) from disk if we already built it for these settings, built and saved otherwise.
+        """
+        # Also when e.g. the distance mode or flicker penalty changed since we got the one we have
+        key = self._color_lut_key()
+        if self.color_lut is None or self.color_lut_key != key:
+            filename = self._color_lut_filename(prefix)
+            if not self.load_color_lut(filename):
+                self.build_color_lut()
+                self.save_color_lut(filename, prefix)
+            self.color_lut_key = key
+            self._save_to_store()
+        return self.color_lut
+
+    def color_lut_ready(self):
+        """If get_color_lut can return the table right away, without loading or building it"""
+        return self.color_lut is not None and self.color_lut_key == self._color_lut_key()
+
+    def _color_lut_filename(self, prefix=COLOR_LUT_PREFIX):
+        """
+        Every table gets its own file named after a hash of _color_lut_key, so building a new one
+        never has to overwrite a file that's still memory mapped (which Windows doesn't allow)
+        """
+        key = json.dumps(self._color_lut_key(), sort_keys=True)
+        return f"{prefix}_{hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]}.npy"
+
+    def build_color_lut(self):
+        if self.color_index is None:
+            raise ValueError("Can't build a color lookup table without emoji features")
+        levels = 1 << self.lut_bits
+        shift = 8 - self.lut_bits
+        # Use the center of every quantization bin as its representative color
+        values = (np.arange(levels, dtype=np.uint16) << shift) + ((1 << shift) >> 1)
+        r, g, b = np.meshgrid(values, values, values, indexing="ij")
+        colors = np.stack([r, g, b], axis=-1).reshape(-1, 3)
+
+        nearest = self.match_rgb(colors)
+        dtype = np.uint16 if len(self.palette_names) <= np.iinfo(np.uint16).max else np.uint32
+        self.color_lut = nearest.astype(dtype).reshape(levels, levels, levels)
+
+    def save_color_lut(self, filename, prefix=COLOR_LUT_PREFIX):
+        # Temporary file first, so a crash never leaves a half written table behind under a valid name
+        tmp_filename = filename + ".tmp"
+        with open(tmp_filename, "wb") as f:
+            np.save(f, self.color_lut)
+        os.replace(tmp_filename, filename)
+
+        # Only keep the newest few tables, one that's still memory mapped somewhere just stays until next time
+        tables = sorted(glob.glob(f"{glob.escape(prefix)}_*.npy"), key=os.path.getmtime, reverse=True)
+        for old in tables[MAX_COLOR_LUTS:]:
+            try:
+                os.remove(old)
+            except OSError:
+                pass
+
+    def load_color_lut(self, filename):
+        if not os.path.exists(filename):
+            return False
+        try:
+            self.color_lut = np.load(filename, mmap_mode="r")
+        except (OSError, ValueError) as e:
+            print(f"Failed to load color lookup table: {e}")
+            return False
+        return True
 
-    async def precompute_all_emoji_colors_async(self, batch_size=100):
+    async def precompute_all_emoji_colors_async(self):
         """Precompute features for all emojis using async IO"""
-        if self.load_emoji_feature_cache():
+        if self._restore_from_store() or self.load_emoji_feature_cache():
             return  # Skip download if loaded from cache
-            
-        self.processed_count = 0
-        self.total_emojis = len(self.slack_emojis)
-        
-        # Limit concurrent downloads to avoid Slack rate limiting
-        semaphore = asyncio.Semaphore(10)  # Only 10 concurrent downloads
-        
-        async def download_with_semaphore(name, url):
-            async with semaphore:
-                return await self._download_emoji_image_async(name, url)
-        
-        # Create connector with conservative limits for Slack's rate limiting
-        connector = aiohttp.TCPConnector(limit=20, limit_per_host=10)
-        
-        # Create a single session for all requests
-        async with aiohttp.ClientSession(
-            connector=connector, 
-            timeout=aiohttp.ClientTimeout(total=10)
-        ) as session:
-            self.session = session
-            
-            # Create tasks for all emojis with semaphore limiting
-            tasks = []
-            for name, url in self.slack_emojis.items():
-                tasks.append(download_with_semaphore(name, url))
-            
-            # Process all images concurrently (but limited by semaphore)
-            results = await asyncio.gather(*tasks, return_exceptions=True)
-            
-            # Process results and update progress
-            for (name, _), result in zip(self.slack_emojis.items(), results):
-                if isinstance(result, Exception):
-                    print(f"Error downloading {name}: {result}")
-                elif result is not None:
-                    self._calculate_emoji_features(name, result)
-                
-                self.processed_count += 1
-                if self.processed_count % 50 == 0:  # Update progress every 50 images
-                    self.progress_callback(int(100 * self.processed_count / self.total_emojis))
-                
-        # Build index for faster lookup
-        if len(self.emoji_colors) > 0:
-            self._build_color_index()
-            self._build_emoji_clusters()
-            
-        # Save the result for this run
-        self.save_emoji_feature_cache()
-        # we reload so we can exclude gifs if wanted
-        self.load_emoji_feature_cache()
+
+        # Only download what changed since the last time we saved the cache
+        pending = self._collect_pending_emojis()
+        await self._precompute_pending_async(pending)
+        await self._wait_for_checkpoint()
+        self._finish_precompute()
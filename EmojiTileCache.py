@@ -0,0 +1,118 @@
+import threading
+from io import BytesIO
+from collections import OrderedDict
+from PIL import Image, ImageTk
+
+#
+#   Emoji images for the paint app, decoded once and drawn at whatever cell size the canvas is zoomed to
+#   Every emoji keeps its original image plus a mip chain of half sized copies (made on demand), a tile of any size
+#   is resampled from the smallest level that's still at least as big, so zooming never downloads or
+#   resamples the full original again. The tiles and their PhotoImages are both kept in a bounded LRU.
+#
+
+DEFAULT_MAX_TILES = 1024 # Decoded emojis we keep around, more than a full palette (MAX_EMOJIS in SlackPaint) needs
+DEFAULT_MAX_PHOTOS = 2048 # PhotoImages we keep around (all emojis * all zoom levels we recently showed)
+MAX_SOURCE_SIZE = 256 # Originals bigger than this get scaled down when decoded, emojis are drawn way smaller anyway
+
+class EmojiTile:
+    """An emoji image in the palette, ask it for a PhotoImage of the size you need"""
+    def __init__(self, image, source=None):
+        """
+        Args:
+            image (PIL.Image): decoded emoji (first frame of animated ones)
+            source (str): url or path it came from, None if it was made up
+        """
+        image = image.convert("RGBA")
+        if max(image.size) > MAX_SOURCE_SIZE:
+            image.thumbnail((MAX_SOURCE_SIZE, MAX_SOURCE_SIZE), Image.Resampling.LANCZOS)
+        self.source = source
+        self.levels = [image] # Mip chain, every level half the size of the one before it
+
+    @classmethod
+    def from_bytes(cls, img_data, source=None):
+        return cls(Image.open(BytesIO(img_data)), source)
+
+    @classmethod
+    def from_file(cls, path):
+        return cls(Image.open(path), path)
+
+    @property
+    def original(self):
+        return self.levels[0]
+
+    def image(self, size):
+        """RGBA PIL image of size x size"""
+        # Walk down the mip chain while the next level is still big enough to resample from
+        level = 0
+        while True:
+            width, height = self.levels[level].size
+            if width // 2 < size or height // 2 < size:
+                break
+            if level + 1 == len(self.levels):
+                self.levels.append(self.levels[level].reduce(2))
+            level += 1
+        image = self.levels[level]
+        if image.size == (size, size):
+            return image.copy()
+        return image.resize((size, size), Image.Resampling.LANCZOS)
+
+    def photo(self, size):
+        """PhotoImage of size x size, from the shared cache (main thread only, it's Tk)"""
+        return EmojiTileCache.shared().photo(self, size)
+
+class EmojiTileCache:
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, max_tiles=DEFAULT_MAX_TILES, max_photos=DEFAULT_MAX_PHOTOS):
+        self.max_tiles = max_tiles
+        self.max_photos = max_photos
+        self._lock = threading.Lock()
+        self._tiles = OrderedDict()     # source -> EmojiTile, so every emoji gets decoded once, least recently used first
+        self._photos = OrderedDict()    # (tile id, size) -> (tile, PhotoImage), least recently used first
+
+    @classmethod
+    def shared(cls):
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    def tile(self, source, load_data, replace=False):
+        """
+        The tile for an emoji, only loads and decodes it if we didn't have it yet (safe to call from worker threads)
+        Args:
+            source (str): url (or path) of the emoji
+            load_data (callable): returns its image file as bytes, only called when we have to decode it
+            replace (bool): load it again even if we have it, for when the image changed
+        """
+        with self._lock:
+            tile = self._tiles.get(source)
+            if tile is not None and not replace:
+                self._tiles.move_to_end(source)
+                return tile
+        tile = EmojiTile.from_bytes(load_data(), source)
+        with self._lock:
+            if replace or source not in self._tiles:
+                self._tiles[source] = tile
+            self._tiles.move_to_end(source)
+            while len(self._tiles) > self.max_tiles:
+                # Palette entries that still use an evicted tile keep their own reference, it just gets decoded again
+                # the next time someone asks for it
+                self._tiles.popitem(last=False)
+            return self._tiles[source]
+
+    def photo(self, tile, size):
+        """PhotoImage of tile at size x size, made the first time it's asked for"""
+        key = (id(tile), size)
+        entry = self._photos.get(key)
+        if entry is not None:
+            self._photos.move_to_end(key)
+            return entry[1]
+        photo = ImageTk.PhotoImage(tile.image(size))
+        # Keep the tile in the entry too, otherwise its id could get reused by a new tile
+        self._photos[key] = (tile, photo)
+        while len(self._photos) > self.max_photos:
+            # Whoever still shows an evicted PhotoImage keeps its own reference, we just stop handing it out
+            self._photos.popitem(last=False)
+        return photo
@@ -0,0 +1,278 @@
+import numpy as np
+import tkinter as tk
+from PIL import Image, ImageColor, ImageTk
+
+#
+#   Draws an EmojiGrid on a tk.Canvas
+#   Remembers what every cell currently shows and only touches the cells that actually changed (a different index,
+#   or an index whose color/image changed). Two ways to draw them:
+#       CanvasGridRenderer  a rectangle (+ image) canvas item per visible cell, reused with itemconfig, and when the
+#                           canvas scrolls handed over to the cells that scroll in to view
+#       BitmapGridRenderer  the whole grid is one image on the canvas, changed cells get their tile copied in to it,
+#                           for big grids where rows * cols canvas items would make Tk crawl
+#
+
+MISSING_EMOJI = (":?", "black") # What cells show when their index isn't in the palette
+GRID_LINE_COLOR = "gray"
+BITMAP_BAND_ROWS = 16 # The bitmap renderer composes this many grid rows at once when a lot changed
+BITMAP_BAND_REDRAW = 0.25 # Part of a band that has to be dirty before we recompose the whole band instead of per cell
+
+def _same_value(a, b):
+    # Colors are strings, images (EmojiTiles) only count as the same if they're the same object
+    return a is b or (isinstance(a, str) and isinstance(b, str) and a == b)
+
+class GridRenderer:
+    """What both renderers share: keeping track of what's on screen and working out which cells are dirty"""
+    def __init__(self, canvas, cell_size):
+        self.canvas = canvas
+        self.cell_size = cell_size
+        self.shown = np.full((0, 0), -1, dtype=np.int32) # Palette index every cell shows right now, -1 for nothing yet
+        self.shown_values = {} # Palette index -> the color/image it was drawn with
+        self.background = None # Color behind image cells
+        self.viewport = None # (top, left, bottom, right) cells that can be seen, None for the whole grid
+
+    def set_viewport(self, viewport):
+        """
+        Tells the renderer which cells can be seen (e.g. after scrolling), cells outside of it don't have to be drawn.
+        Args:
+            viewport (tuple): (top, left, bottom, right) rows/columns, bottom/right exclusive, None for the whole grid
+        Returns:
+            bool: if cells that weren't drawn can be seen now, they get drawn on the next update
+        """
+        return False # Renderers that draw the whole grid anyway don't care
+
+    def _window(self):
+        """(top, left, bottom, right) of the cells we actually draw, the viewport clamped to the grid"""
+        rows, cols = self.shown.shape
+        if self.viewport is None:
+            return 0, 0, rows, cols
+        top, left, bottom, right = self.viewport
+        top, left = min(max(top, 0), rows), min(max(left, 0), cols)
+        return top, left, max(top, min(bottom, rows)), max(left, min(right, cols))
+
+    def clear(self):
+        """Removes every cell from the canvas, the next update draws everything again"""
+        self.canvas.delete("cell")
+        self.shown = np.full((0, 0), -1, dtype=np.int32)
+        self.shown_values = {}
+
+    def resize(self, rows, cols):
+        """Adds/removes cells, the ones that stay keep what they show"""
+        shown = np.full((rows, cols), -1, dtype=np.int32)
+        keep_rows, keep_cols = min(rows, self.shown.shape[0]), min(cols, self.shown.shape[1])
+        shown[:keep_rows, :keep_cols] = self.shown[:keep_rows, :keep_cols]
+        self.shown = shown
+
+    def update(self, grid, palette, background):
+        """
+        Redraws every cell that doesn't show what it should anymore.
+        Args:
+            grid (EmojiGrid): what to show
+            palette (dict): index -> (name, color string or EmojiTile)
+            background (str): color behind image cells
+        Returns:
+            int: cells that got redrawn
+        """
+        if self.shown.shape != grid.shape:
+            self.resize(*grid.shape)
+
+        # Palette entries that changed since we last drew them, every cell showing one of those needs redrawing too
+        changed = [index for index, value in self.shown_values.items()
+                   if not _same_value(value, palette.get(index, MISSING_EMOJI)[1])]
+        changed += [index for index in palette if index not in self.shown_values]
+        if background != self.background:
+            changed += [index for index, (_, value) in palette.items() if not isinstance(value, str)]
+            self.background = background
+
+        top, left, bottom, right = self._window()
+        cells = grid.cells[top:bottom, left:right]
+        dirty = cells != self.shown[top:bottom, left:right]
+        if changed:
+            dirty |= np.isin(cells, changed)
+        self.shown_values = {index: value for index, (_, value) in palette.items()}
+        return self._draw_dirty(grid, palette, dirty, top, left)
+
+    def _draw_dirty(self, grid, palette, dirty, top=0, left=0):
+        """Draws the dirty cells, dirty is a mask of the part of the grid starting at row top and column left"""
+        rows, cols = np.nonzero(dirty)
+        rows += top
+        cols += left
+        cells = grid.cells[rows, cols].tolist()
+        for r, c, index in zip(rows.tolist(), cols.tolist(), cells):
+            self._draw(r, c, index, palette.get(index, MISSING_EMOJI)[1])
+        return len(cells)
+
+    def _draw(self, row, col, index, value):
+        raise NotImplementedError
+
+class CanvasGridRenderer(GridRenderer):
+    def __init__(self, canvas, cell_size):
+        super().__init__(canvas, cell_size)
+        self.rects = {}     # (row, col) -> rectangle item, every cell we draw has one
+        self.images = {}    # (row, col) -> image item, created the first time a cell shows an image, hidden when it doesn't
+        self.pool = []      # (rectangle, image or None) items of cells that scrolled out of view, hidden until reused
+        self.photos = {}    # Palette index -> (value, PhotoImage at our cell size), also keeps the PhotoImages alive
+
+    def clear(self):
+        super().clear()
+        self.rects.clear()
+        self.images.clear()
+        self.pool.clear()
+        self.photos.clear()
+
+    def _photo(self, index, value):
+        photo = self.photos.get(index)
+        if photo is None or photo[0] is not value:
+            photo = (value, value.photo(self.cell_size))
+            self.photos[index] = photo
+        return photo[1]
+
+    def set_viewport(self, viewport):
+        self.viewport = viewport
+        return self._sync_items()
+
+    def resize(self, rows, cols):
+        super().resize(rows, cols)
+        self._sync_items()
+
+    def _sync_items(self):
+        """
+        Gives every cell in the window canvas items, taking them from cells that aren't in it anymore (or the pool),
+        only creates new items when there's nothing left to reuse
+        Returns:
+            bool: if any cell got items (and still has to be drawn)
+        """
+        top, left, bottom, right = self._window()
+        for key in [key for key in self.rects if not (top <= key[0] < bottom and left <= key[1] < right)]:
+            rect = self.rects.pop(key)
+            image = self.images.pop(key, None)
+            self.canvas.itemconfig(rect, state="hidden")
+            if image is not None:
+                self.canvas.itemconfig(image, state="hidden")
+            self.pool.append((rect, image))
+            if key[0] < self.shown.shape[0] and key[1] < self.shown.shape[1]:
+                self.shown[key] = -1
+
+        size = self.cell_size
+        added = False
+        for r in range(top, bottom):
+            for c in range(left, right):
+                if (r, c) in self.rects:
+                    continue
+                x0, y0, x1, y1 = c * size, r * size, (c + 1) * size, (r + 1) * size
+                if self.pool:
+                    rect, image = self.pool.pop()
+                    self.canvas.coords(rect, x0, y0, x1, y1)
+                    self.canvas.itemconfig(rect, state="normal")
+                    if image is not None:
+                        self.canvas.coords(image, x0, y0)
+                        self.images[(r, c)] = image
+                else:
+                    rect = self.canvas.create_rectangle(x0, y0, x1, y1, fill="", outline=GRID_LINE_COLOR, tags="cell")
+                self.rects[(r, c)] = rect
+                self.shown[r, c] = -1
+                added = True
+        return added
+
+    def _draw(self, row, col, index, value):
+        key = (row, col)
+        image = self.images.get(key)
+        if isinstance(value, str):
+            self.canvas.itemconfig(self.rects[key], fill=value)
+            if image is not None:
+                self.canvas.itemconfig(image, state="hidden")
+        else:
+            photo = self._photo(index, value)
+            self.canvas.itemconfig(self.rects[key], fill=self.background)
+            if image is None:
+                self.images[key] = self.canvas.create_image(col * self.cell_size, row * self.cell_size, anchor="nw",
+                                                            image=photo, tags="cell")
+            else:
+                self.canvas.itemconfig(image, image=photo, state="normal")
+        self.shown[row, col] = index
+
+class BitmapGridRenderer(GridRenderer):
+    def __init__(self, canvas, cell_size):
+        super().__init__(canvas, cell_size)
+        self.photo = None   # The one image the whole grid is drawn in to
+        self.item = None    # Canvas item showing it
+        self.tiles = {}     # Palette index -> (value, background, (size, size, 3) uint8 pixels, PhotoImage of them)
+
+    def clear(self):
+        super().clear()
+        self.item = None
+        self.photo = None
+        self.tiles.clear()
+
+    def resize(self, rows, cols):
+        size = self.cell_size
+        if self.photo is None:
+            self.photo = tk.PhotoImage(master=self.canvas, width=cols * size, height=rows * size)
+            self.item = self.canvas.create_image(0, 0, anchor="nw", image=self.photo, tags="cell")
+        else:
+            # Resizing a Tk photo keeps its pixels (from the top left), just like the grid
+            self.photo.configure(width=cols * size, height=rows * size)
+        super().resize(rows, cols)
+
+    def _tile(self, index, value):
+        """Pixels (and a PhotoImage) of one cell showing value, made once per palette entry"""
+        tile = self.tiles.get(index)
+        if tile is not None and _same_value(tile[0], value) and tile[1] == self.background:
+            return tile
+
+        size = self.cell_size
+        if isinstance(value, str):
+            img = Image.new("RGB", (size, size), self._rgb(value))
+            pixels = np.array(img)
+            # Same grid lines the canvas renderer draws around color cells
+            pixels[0, :] = pixels[:, 0] = self._rgb(GRID_LINE_COLOR)
+        else:
+            emoji = value.image(size)
+            img = Image.new("RGBA", (size, size), self._rgb(self.background) + (255,))
+            img.alpha_composite(emoji)
+            pixels = np.array(img.convert("RGB"))
+        tile = (value, self.background, pixels, ImageTk.PhotoImage(Image.fromarray(pixels), master=self.canvas))
+        self.tiles[index] = tile
+        return tile
+
+    def _rgb(self, color):
+        try:
+            return ImageColor.getrgb(color)[:3]
+        except (ValueError, AttributeError):
+            # Some color name only Tk knows
+            return tuple(channel >> 8 for channel in self.canvas.winfo_rgb(color))
+
+    def _draw_dirty(self, grid, palette, dirty, top=0, left=0):
+        # The bitmap always covers the whole grid (it's a single item, there's nothing to cull), so top/left are 0
+        total = 0
+        for band_top in range(0, grid.rows, BITMAP_BAND_ROWS):
+            band = dirty[band_top:band_top + BITMAP_BAND_ROWS]
+            count = int(np.count_nonzero(band))
+            if count == 0:
+                continue
+            if count >= band.size * BITMAP_BAND_REDRAW:
+                self._draw_band(grid, palette, band_top, band_top + band.shape[0])
+            else:
+                rows, cols = np.nonzero(band)
+                cells = grid.cells[rows + band_top, cols].tolist()
+                for r, c, index in zip(rows.tolist(), cols.tolist(), cells):
+                    self._draw(r + band_top, c, index, palette.get(index, MISSING_EMOJI)[1])
+            total += count
+        return total
+
+    def _draw_band(self, grid, palette, top, bottom):
+        """Composes grid rows top..bottom as one image with array indexing, and copies that in to the bitmap"""
+        cells = grid.cells[top:bottom]
+        indices, inverse = np.unique(cells, return_inverse=True)
+        tiles = np.stack([self._tile(index, palette.get(index, MISSING_EMOJI)[1])[2] for index in indices.tolist()])
+        size = self.cell_size
+        rows, cols = cells.shape
+        pixels = tiles[inverse.reshape(rows, cols)].transpose(0, 2, 1, 3, 4).reshape(rows * size, cols * size, 3)
+        band = ImageTk.PhotoImage(Image.fromarray(pixels), master=self.canvas)
+        self.canvas.tk.call(str(self.photo), "copy", str(band), "-to", 0, top * size)
+        self.shown[top:bottom] = cells
+
+    def _draw(self, row, col, index, value):
+        tile = self._tile(index, value)[3]
+        self.canvas.tk.call(str(self.photo), "copy", str(tile), "-to", col * self.cell_size, row * self.cell_size)
+        self.shown[row, col] = index
@@ -1,12 +1,26 @@
 import numpy as np
 from PIL import Image, ImageFilter
-import math
 import time
 #
 #   Class to convert an image to a grid of emojis
 #
 
 from EmojiPrecomputer import EmojiPrecomputer
+from EmojiBudgetSolver import EmojiBudgetSolver
+from ColorSpace import pack_rgb, unpack_rgb, to_distance_space, space_distance, DISTANCE_SCALE
+from EmojiFeatures import block_signatures, hex_to_rgb
+
+# Error diffusion kernels, (dy, dx, share of the error) for the neighbours that haven't been matched yet
+DIFFUSION_KERNELS = {
+    "floyd-steinberg": ((0, 1, 7 / 16), (1, -1, 3 / 16), (1, 0, 5 / 16), (1, 1, 1 / 16)),
+    # Only passes on 6/8 of the error, which keeps more contrast (and loses some detail in very dark/light areas)
+    "atkinson": ((0, 1, 1 / 8), (0, 2, 1 / 8), (1, -1, 1 / 8), (1, 0, 1 / 8), (1, 1, 1 / 8), (2, 0, 1 / 8)),
+}
+BAYER_MATRIX = np.array([[0, 8, 2, 10],
+                         [12, 4, 14, 6],
+                         [3, 11, 1, 9],
+                         [15, 7, 13, 5]], dtype=np.float32)
+DITHER_CANDIDATES = 16 # Nearest emojis to the original color that error diffusion picks from
 
 class ImageToEmojiConverter:
     
@@ -21,6 +35,14 @@ class ImageToEmojiConverter:
         self.edge_detection_threshold = 20  # Default threshold for edge detection
         #self.disable_edge_detection = False 
         self.resampling_mode = Image.Resampling.NEAREST
+        self.use_color_lut = False  # Match through the precomputed (quantized) color lookup table
+        self.block_matching = False  # Match the layout of every emoji to its block of the full size image
+        self.dither_mode = None  # None, "floyd-steinberg", "atkinson" or "bayer"
+        self.bayer_strength = 32  # How far (in 0-255 RGB) ordered dithering nudges colors at most
+        self.char_budget = None  # Max message length in characters (None for no limit)
+        self.max_distinct_emojis = None  # Max different emojis in the grid (None for no limit)
+        self.budget_solver = None  # Solver of the last conversion with a budget, can re-solve for a new budget fast
+        self.message_length = None  # Message length of the last conversion with a budget
 
         self.emoji_precomputer = EmojiPrecomputer(slack_emojis, slack_emojis_version, background_color, self.progress_callback)
         
@@ -82,37 +104,124 @@ class ImageToEmojiConverter:
 
         return edges
 
-    # TODO: come back to this and tweak
-    def _color_distance(self, color1, color2):
-        r1, g1, b1 = [int(c) for c in color1]
-        r2, g2, b2 = [int(c) for c in color2]
-        
-        r1, g1, b1 = r1/255.0, g1/255.0, b1/255.0
-        r2, g2, b2 = r2/255.0, g2/255.0, b2/255.0
-        
-        # Apply gamma correction
-        r1 = ((r1 + 0.055) / 1.055) ** 2.4 if r1 > 0.04045 else r1 / 12.92
-        g1 = ((g1 + 0.055) / 1.055) ** 2.4 if g1 > 0.04045 else g1 / 12.92
-        b1 = ((b1 + 0.055) / 1.055) ** 2.4 if b1 > 0.04045 else b1 / 12.92
-        
-        r2 = ((r2 + 0.055) / 1.055) ** 2.4 if r2 > 0.04045 else r2 / 12.92
-        g2 = ((g2 + 0.055) / 1.055) ** 2.4 if g2 > 0.04045 else g2 / 12.92
-        b2 = ((b2 + 0.055) / 1.055) ** 2.4 if b2 > 0.04045 else b2 / 12.92
-        
-        # Simple perceptual distance
-        l1 = 0.2126 * r1 + 0.7152 * g1 + 0.0722 * b1
-        l2 = 0.2126 * r2 + 0.7152 * g2 + 0.0722 * b2
-        
-        # Calculate Luminance difference
-        lumDiff = (l1 - l2) * 3  # Emphasize luminance differences
-        
-        # Calculate color differences
-        rDiff = r1 - r2
-        gDiff = g1 - g2
-        bDiff = b1 - b2
-        
-        # Combine for final distance (weighted for human perception)
-        return math.sqrt(lumDiff**2 + rDiff**2 + gDiff**2 + bDiff**2)
+    def set_distance_mode(self, distance_mode):
+        if(distance_mode == "Legacy"):
+            self.emoji_precomputer.distance_mode = "legacy"
+        elif(distance_mode == "OKLab"):
+            self.emoji_precomputer.distance_mode = "oklab"
+        elif(distance_mode == "CIEDE2000"):
+            self.emoji_precomputer.distance_mode = "ciede2000"
+
+    def set_dither_mode(self, dither_mode):
+        if(dither_mode == "None"):
+            self.dither_mode = None
+        elif(dither_mode == "Floyd-Steinberg"):
+            self.dither_mode = "floyd-steinberg"
+        elif(dither_mode == "Atkinson"):
+            self.dither_mode = "atkinson"
+        elif(dither_mode == "Bayer"):
+            self.dither_mode = "bayer"
+
+    def dither_colors(self, img_array):
+        """
+        Matches an image with dithering, so gradients turn in to a mix of emojis instead of bands.
+        Args:
+            img_array (np.ndarray): (H, W, 3+) uint8 image
+        Returns:
+            np.ndarray: (H, W) indices in to emoji_precomputer.palette_names
+        """
+        height, width = img_array.shape[:2]
+        pixels = np.ascontiguousarray(img_array[..., :3]).reshape(-1, 3)
+        if self.dither_mode == "bayer":
+            # Ordered dithering: nudge every pixel by its threshold in the tiled matrix and match as usual
+            thresholds = (BAYER_MATRIX + 0.5) / BAYER_MATRIX.size - 0.5
+            tiled = np.tile(thresholds, (height // 4 + 1, width // 4 + 1))[:height, :width].reshape(-1, 1)
+            nudged = np.clip(np.rint(pixels + tiled * self.bayer_strength), 0, 255).astype(np.uint8)
+            return self.match_colors(nudged).reshape(height, width)
+        return self.diffuse_errors(pixels.reshape(height, width, 3), DIFFUSION_KERNELS[self.dither_mode])
+
+    def diffuse_errors(self, rgb, kernel):
+        """
+        Error diffusion: every pixel gets the emoji closest to its color plus the error its already matched neighbours
+        passed on, and passes on the difference to that emoji's dominant color in turn.
+        Everything happens in the space of the distance mode (linear RGB for legacy, OKLab, CIELAB for ciede2000),
+        where the error adds up properly. Each pixel only picks from the DITHER_CANDIDATES emojis nearest to its
+        original color (found up front, all at once), the diffused error rarely moves a color past those.
+        A pixel only needs the error of pixels to its left and in the rows above, so instead of going pixel by pixel
+        we go over diagonal lines (x + slope * y) where no pixel depends on another one of the same line:
+        every line is matched (and passes on its error) at once, only the lines themselves are serial.
+        Args:
+            rgb (np.ndarray): (H, W, 3) uint8 image
+            kernel (tuple): ((dy, dx, weight), ...) see DIFFUSION_KERNELS
+        Returns:
+            np.ndarray: (H, W) indices in to emoji_precomputer.palette_names
+        """
+        precomputer = self.emoji_precomputer
+        if precomputer.color_index is None:
+            raise ValueError("No emoji features calculated yet something must have gone really wrong!")
+        height, width = rgb.shape[:2]
+        mode = precomputer.distance_mode
+        palette = precomputer.palette_spaces[mode].astype(np.float32)
+
+        # Candidates per unique color, the same color gets the same candidates wherever it is
+        keys, inverse = np.unique(pack_rgb(rgb.reshape(-1, 3)), return_inverse=True)
+        features = to_distance_space(unpack_rgb(keys), mode)
+        k = min(DITHER_CANDIDATES, len(palette))
+        _, candidates = precomputer.get_color_index(mode).query(features, k=k)
+        candidates = candidates.reshape(-1, k)
+        candidate_features = palette[candidates]
+        flicker = precomputer.flicker_penalty * np.sqrt(precomputer.palette_temporal_variance) / DISTANCE_SCALE[mode]
+        candidate_flicker = flicker[candidates] if precomputer.flicker_penalty > 0 and np.any(flicker > 0) else None
+
+        # Lines have to be steep enough that every pixel the kernel passes error on to is on a later line
+        slope = max([1] + [-dx // dy + 1 for dy, dx, _ in kernel if dy > 0])
+        # Error buffer with enough padding that the kernel never has to check the borders
+        pad = max(abs(dx) for _, dx, _ in kernel)
+        errors = np.zeros((height + max(dy for dy, _, _ in kernel), width + 2 * pad, palette.shape[1]), dtype=np.float32)
+        pixel_features = features[inverse.reshape(-1)].reshape(height, width, -1)
+        pixel_candidates = inverse.reshape(height, width)
+        result = np.empty((height, width), dtype=np.int64)
+        lines = width + slope * (height - 1)
+        progress = 0
+        for line in range(lines):
+            # Pixels on this line, one per row at most, so they never pass error on to the same pixel
+            ys = np.arange(max(0, -(-(line - width + 1) // slope)), min(height - 1, line // slope) + 1)
+            xs = line - slope * ys
+            target = pixel_features[ys, xs] + errors[ys, xs + pad]
+            rows = pixel_candidates[ys, xs]
+            difference = candidate_features[rows] - target[:, None]
+            cost = np.einsum('nkd,nkd->nk', difference, difference)
+            if candidate_flicker is not None:
+                cost = np.sqrt(cost) + candidate_flicker[rows]
+            picks = np.argmin(cost, axis=1)
+            result[ys, xs] = candidates[rows, picks]
+            error = -difference[np.arange(len(ys)), picks]
+            for dy, dx, weight in kernel:
+                errors[ys + dy, xs + pad + dx] += error * weight
+            if 100 * (line + 1) // lines != progress:
+                progress = 100 * (line + 1) // lines
+                self.progress_callback(progress)
+        return result
+
+    def match_blocks(self, img, width, height):
+        """
+        Matches the spatial signature of every emoji against the matching block of the (full size) image,
+        instead of only the dominant color against the resized image.
+        Returns:
+            np.ndarray: (height, width) indices in to emoji_precomputer.palette_names
+        """
+        if self.emoji_precomputer.color_index is None:
+            raise ValueError("No emoji features calculated yet something must have gone really wrong!")
+        background_rgb = hex_to_rgb(self.emoji_precomputer.background_color)
+        signatures = block_signatures(img, background_rgb, width, height)
+        return self.emoji_precomputer.match_signatures(signatures.reshape(width * height, -1)).reshape(height, width)
+
+    def _emoji_distance(self, emoji1, emoji2):
+        """Scaled distance between the dominant colors of two emojis in the selected mode, from the precomputed palette"""
+        mode = self.emoji_precomputer.distance_mode
+        space = self.emoji_precomputer.palette_spaces[mode]
+        rows = self.emoji_precomputer.palette_rows
+        return float(space_distance(space[rows[emoji1]], space[rows[emoji2]], mode))
         
     def find_closest_emoji(self, color, neighbors=None):
         """Find the emoji that best matches a given color (and optionally, context via neighbors)."""
@@ -133,40 +242,9 @@ class ImageToEmojiConverter:
         elif color_key in self.emoji_precomputer.color_to_emoji_cache:
             return self.emoji_precomputer.color_to_emoji_cache[color_key]
 
-        # Quantize the input color 
-        # (The int here is quite important because color is num py uint8 
-        # and we'll go our of bounds in the next section if we dont cast to int)
-        quantized = tuple(int(c) // 4 for c in color)
-
-        # Search nearby color buckets
-        buckets_to_check = []
-        for i in range(-1, 2):
-            for j in range(-1, 2):
-                for k in range(-1, 2):
-                    r = max(0, quantized[0] + i)
-                    g = max(0, quantized[1] + j)
-                    b = max(0, quantized[2] + k)
-                    buckets_to_check.append((r, g, b))
-
-        candidates = []
-        for bucket in buckets_to_check:
-            if bucket in self.emoji_precomputer.color_buckets:
-                candidates.extend(self.emoji_precomputer.color_buckets[bucket])
-
-        # Fallback to all emojis if no candidates found
-        if not candidates:
-            for name, colors in self.emoji_precomputer.emoji_colors.items():
-                if colors:
-                    candidates.append((name, colors[0][0]))  # use top dominant color
-
-        # Find the best match by color distance
-        best_emoji = None
-        min_distance = float('inf')
-        for name, emoji_color in candidates:
-            dist = self._color_distance(color, emoji_color)
-            if dist < min_distance:
-                min_distance = dist
-                best_emoji = name
+        # Exact nearest emoji from the k-d tree over all dominant colors (penalizing flickery animated ones)
+        nearest = self.emoji_precomputer.match_rgb(color_key)
+        best_emoji = self.emoji_precomputer.palette_names[nearest[0]]
 
         # Cache the result using color key or full context key
         if context_key is not None:
@@ -176,26 +254,33 @@ class ImageToEmojiConverter:
 
         return best_emoji
     
-    def _get_neighbor_colors(self, img_array, x, y, size=3):
-        height, width = img_array.shape[:2]
-        neighbors = []
-        
-        half = size // 2
-        for dy in range(-half, half + 1):
-            for dx in range(-half, half + 1):
-                nx = x + dx
-                ny = y + dy
-                if (dx != 0 or dy != 0) and 0 <= nx < width and 0 <= ny < height:
-                    neighbors.append(tuple(img_array[ny, nx]))
-                    
-        return neighbors
-    
+    def match_colors(self, pixels):
+        """
+        Batched version of find_closest_emoji, matches every color at once.
+        Args:
+            pixels (np.ndarray): (N, 3) uint8 RGB colors
+        Returns:
+            np.ndarray: (N,) indices in to emoji_precomputer.palette_names
+        """
+        color_index = self.emoji_precomputer.color_index
+        if color_index is None:
+            raise ValueError("No emoji features calculated yet something must have gone really wrong!")
+
+        if self.use_color_lut:
+            lut = self.emoji_precomputer.get_color_lut()
+            quantized = np.asarray(pixels, dtype=np.uint8) >> (8 - self.emoji_precomputer.lut_bits)
+            return lut[quantized[:, 0], quantized[:, 1], quantized[:, 2]].astype(np.int64)
+
+        # Images usually have way less unique colors than pixels, so only match those
+        keys, inverse = np.unique(pack_rgb(pixels), return_inverse=True)
+        nearest = self.emoji_precomputer.match_rgb(unpack_rgb(keys))
+
+        return nearest[inverse.reshape(-1)]
+
     def process_image(self, img, width_percentage=None, height_percentage=None):
         """Convert an image to a grid of emoji names"""
         start_time = time.time()
 
-        self.emoji_precomputer.reset_cache()
-        
         # Open and resize the image
         # img = Image.open(image_path).convert('RGB')
         
@@ -225,6 +310,9 @@ class ImageToEmojiConverter:
         target_width = min(target_width, self.max_width)
         target_height = min(target_height, self.max_height)
         
+        # Block matching looks at the full size image
+        source_img = img
+
         # For pixel art mode, use nearest neighbor resampling and sharpen image
         if self.edge_detection_mode:
             img = img.resize((target_width, target_height), Image.Resampling.NEAREST)
@@ -249,43 +337,36 @@ class ImageToEmojiConverter:
             #edge_map = self.simple_edge_detection(gray)
         
         print("Processing image...")
-        emoji_grid = []
-        
         image_size = target_height * target_width
 
-        # Find unique colors in the image to reduce redundant calculations
-        unique_contexts = {}
-        
-        # First pass - process color mapping with context
-        # TODO: optimize
-        self.status_label_callback("Process color mapping with context...")
-        processed_pixels = 0
-        for y in range(target_height):
-            row = []
-            for x in range(target_width):
-                processed_pixels += 1
-                self.progress_callback(int(100 * processed_pixels / image_size))
-                pixel = tuple(img_array[y, x])
-                
-                # Get local context for better matching
-                #local_pattern = local_patterns.get((x, y)) if self.pattern_weight > 0 else None
-                neighbors = self._get_neighbor_colors(img_array, x, y) if self.edge_detection_mode else None
-                
-                # Create a context key
-                context_key = (pixel, hash(tuple(sorted(neighbors))) if neighbors else None)
-                
-                # Check if we've already processed this context
-                if context_key not in unique_contexts:
-                    #emoji_name = self.find_closest_emoji(pixel, local_pattern, neighbors)
-                    emoji_name = self.find_closest_emoji(pixel, neighbors)
-                    unique_contexts[context_key] = emoji_name
-                
-                row.append(unique_contexts[context_key])
-            emoji_grid.append(row)
+        # First pass - match every pixel at once
+        if self.use_color_lut and not self.block_matching and not self.emoji_precomputer.color_lut_ready():
+            self.status_label_callback("Loading color lookup table... (This can take a few seconds the first time)")
+        else:
+            self.status_label_callback("Matching colors to emojis...")
+        use_budget = self.char_budget is not None or self.max_distinct_emojis is not None
+        if use_budget:
+            self.status_label_callback("Fitting emojis in the character budget...")
+            self.budget_solver = EmojiBudgetSolver(self.emoji_precomputer, img_array[..., :3].reshape(-1, 3), target_height)
+            indices, self.message_length = self.budget_solver.solve(self.char_budget, self.max_distinct_emojis)
+            index_grid = indices.reshape(target_height, target_width)
+            if self.char_budget is not None and self.message_length > self.char_budget:
+                print(f"Couldn't fit the image in {self.char_budget} characters, the shortest we got is {self.message_length}")
+        elif self.block_matching:
+            index_grid = self.match_blocks(source_img, target_width, target_height)
+        elif self.dither_mode is not None:
+            index_grid = self.dither_colors(img_array)
+        else:
+            pixels = img_array[..., :3].reshape(-1, 3)
+            index_grid = self.match_colors(pixels).reshape(target_height, target_width)
+        names = self.emoji_precomputer.palette_names
+        emoji_grid = [[names[i] for i in row] for row in index_grid.tolist()]
+        self.progress_callback(100)
         
         # For edge detection mode, perform a second pass to ensure edge contrast
         # TODO: clean up this nested if mess...
-        if self.edge_detection_mode and edge_map is not None:
+        # (not with a budget, swapping emojis could push us over it)
+        if self.edge_detection_mode and edge_map is not None and not use_budget:
             self.status_label_callback("Ensure edge coherence...")
             processed_pixels = 0
             # Second pass - ensure edges are preserved
@@ -308,15 +389,13 @@ class ImageToEmojiConverter:
                                     # If neighbor is on the other side of edge, ensure contrast
                                     if not edge_map[ny, nx]:
                                         # Get current and neighbor emoji colors
-                                        if curr_emoji in self.emoji_precomputer.emoji_colors and self.emoji_precomputer.emoji_colors[curr_emoji]:
-                                            curr_color = self.emoji_precomputer.emoji_colors[curr_emoji][0][0]
-                                            
+                                        if curr_emoji in self.emoji_precomputer.palette_rows:
                                             neighbor_emoji = emoji_grid[ny][nx]
-                                            if neighbor_emoji in self.emoji_precomputer.emoji_colors and self.emoji_precomputer.emoji_colors[neighbor_emoji]:
+                                            if neighbor_emoji in self.emoji_precomputer.palette_rows:
                                                 neighbor_color = self.emoji_precomputer.emoji_colors[neighbor_emoji][0][0]
                                                 
                                                 # Calculate contrast ratio
-                                                contrast = self._color_distance(curr_color, neighbor_color)
+                                                contrast = self._emoji_distance(curr_emoji, neighbor_emoji)
                                                 
                                                 # If contrast is too low, try to find a better emoji
                                                 if contrast < 0.2:  # Threshold for minimum contrast
@@ -333,11 +412,26 @@ class ImageToEmojiConverter:
         print(f"Image processing completed in {time.time() - start_time:.2f} seconds")
         return emoji_grid
     
+    def resolve_budget(self, char_budget=None, max_distinct=None):
+        """
+        Fits the last conversion in a new budget, reusing its solver so we don't have to convert the image again
+        Args:
+            char_budget (int): max message length, None for no limit
+            max_distinct (int): max different emojis, None for no limit
+        Returns:
+            (list, dict): display grid and emoji mapping, same as emoji_grid_to_display
+        """
+        if self.budget_solver is None:
+            raise ValueError("Only conversions with a character or emoji limit can be fit in a new one")
+        self.char_budget = char_budget
+        self.max_distinct_emojis = max_distinct
+        indices, self.message_length = self.budget_solver.solve(char_budget, max_distinct)
+        names = self.emoji_precomputer.palette_names
+        emoji_grid = [[names[i] for i in row] for row in indices.reshape(self.budget_solver.rows, -1).tolist()]
+        return self.emoji_grid_to_display(emoji_grid)
+
     def _find_contrasting_emoji(self, target_color, avoid_color, current_emoji):
         """Find an emoji with good contrast against avoid_color while staying close to target_color"""
-        best_emoji = current_emoji
-        best_score = -float('inf')
-        
         # Get potential candidates
         quantized = (int(target_color[0]) // 16, int(target_color[1]) // 16, int(target_color[2]) // 16)
         candidates = []
@@ -357,25 +451,22 @@ class ImageToEmojiConverter:
                         if adj_bucket in self.emoji_precomputer.emoji_clusters:
                             candidates.extend(self.emoji_precomputer.emoji_clusters[adj_bucket])
         
-        # Evaluate each candidate
-        for name in candidates:
-            if name not in self.emoji_precomputer.emoji_colors or not self.emoji_precomputer.emoji_colors[name]:
-                continue
-                
-            emoji_color = self.emoji_precomputer.emoji_colors[name][0][0]
-            
-            # Score based on color similarity to target and contrast with avoid_color
-            color_similarity = 1.0 / (1.0 + self._color_distance(target_color, emoji_color))
-            contrast = self._color_distance(emoji_color, avoid_color)
+        # Evaluate all candidates at once against the precomputed palette
+        candidates = [name for name in candidates if name in self.emoji_precomputer.palette_rows]
+        if not candidates:
+            return current_emoji
+        mode = self.emoji_precomputer.distance_mode
+        emoji_features = self.emoji_precomputer.palette_spaces[mode][[self.emoji_precomputer.palette_rows[name] for name in candidates]]
+        target_features = to_distance_space(np.array(target_color[:3], dtype=np.uint8), mode)
+        avoid_features = to_distance_space(np.array(avoid_color[:3], dtype=np.uint8), mode)
             
-            # Combined score (prefer high contrast while staying reasonably close to target color) TODO: tweak values
-            score = contrast * 0.6 + color_similarity * 0.4
+        # Score based on color similarity to target and contrast with avoid_color
+        color_similarity = 1.0 / (1.0 + space_distance(target_features, emoji_features, mode))
+        contrast = space_distance(emoji_features, avoid_features, mode)
             
-            if score > best_score:
-                best_score = score
-                best_emoji = name
-        
-        return best_emoji
+        # Combined score (prefer high contrast while staying reasonably close to target color) TODO: tweak values
+        score = contrast * 0.6 + color_similarity * 0.4
+        return candidates[int(np.argmax(score))]
 
     def emoji_grid_to_display(self, emoji_grid):
         """Convert an emoji grid to a format suitable for our UI."""
@@ -386,6 +477,9 @@ class ImageToEmojiConverter:
         if ":_:" not in emoji_to_index:
             emoji_to_index[":_:"] = 0
 
+        # Emojis with several names for the same image get the shortest one, it's the same emoji in a shorter message
+        aliases = self.emoji_precomputer.get_alias_index()
+
         display_grid = []
         processed_count = 0
         for row in emoji_grid:
@@ -394,7 +488,7 @@ class ImageToEmojiConverter:
                 self.progress_callback(int(100 * processed_count / len(emoji_grid)))
 
                 # Add colon prefix/suffix if not already present
-                full_name = emoji_name
+                full_name = aliases.shortest(emoji_name)
                 if not full_name.startswith(':'):
                     full_name = ':' + full_name
                 if not full_name.endswith(':'):
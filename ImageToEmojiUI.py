@@ -10,6 +10,10 @@ import queue
 import urllib.request
 
 from ImageToEmojiConverter import ImageToEmojiConverter
+from EmojiGrid import EmojiGrid
+from EmojiTileCache import EmojiTile
+
+RESOLVE_DELAY = 400 # ms after the last change to a limit before we fit the converted grid in it again
 
 class ImageToEmojiUI:
     def __init__(self, parent, app):
@@ -20,7 +24,9 @@ class ImageToEmojiUI:
         """
         self.parent = parent
         self.app = app
-        self.converter = None
+        self.converter = None # Kept after a conversion, with a budget it can re-fit the grid when the limits change
+        self._resolve_job = None
+        self._resolve_generation = 0 # Bumped on every re-fit, so a slow one never overwrites a newer one
         self.create_ui()
         
     def create_ui(self):
@@ -76,6 +82,38 @@ class ImageToEmojiUI:
         exclude_gifs_check = tk.Checkbutton(self.main_frame, text="Exclude gif's", variable=self.exclude_gifs_var)
         exclude_gifs_check.pack(anchor="w", pady=0)
         self.exclude_gifs_var.check_widget = exclude_gifs_check
+
+        # Use color lookup table
+        lut_frame = tk.Frame(self.main_frame)
+        lut_frame.pack(anchor="w", pady=0)
+        self.use_color_lut_var = tk.BooleanVar(value=False)
+        tk.Checkbutton(lut_frame, text="Fast color lookup", variable=self.use_color_lut_var).pack(side="left", pady=0)
+
+        lut_help_icon = tk.Label(lut_frame, text="?", font=("Arial", 8), 
+                            bg="#4a7a8c", fg="white", width=1, height=1,
+                            relief="raised", cursor="question_arrow")
+        lut_help_icon.pack(side="left", pady=0)
+
+        lut_help_text = ("Precomputes the closest emoji for every color once (saved in emoji_color_lut_*.npy), "
+                         "which makes repeated conversions with the same emojis a lot faster. "
+                         "Colors are slightly rounded so results can differ a tiny bit.")
+        ImageToEmojiUI.create_tooltip(lut_help_icon, lut_help_text)
+
+        # Match emoji layouts instead of single colors
+        block_frame = tk.Frame(self.main_frame)
+        block_frame.pack(anchor="w", pady=0)
+        self.block_matching_var = tk.BooleanVar(value=False)
+        tk.Checkbutton(block_frame, text="Match emoji layout", variable=self.block_matching_var).pack(side="left", pady=0)
+
+        block_help_icon = tk.Label(block_frame, text="?", font=("Arial", 8), 
+                            bg="#4a7a8c", fg="white", width=1, height=1,
+                            relief="raised", cursor="question_arrow")
+        block_help_icon.pack(side="left", pady=0)
+
+        block_help_text = ("Compares a 3x3 grid of colors of every emoji with the same area of the original image, "
+                           "instead of only its main color, so details inside a cell get picked up. "
+                           "Ignores the resampling mode, color distance and fast color lookup.")
+        ImageToEmojiUI.create_tooltip(block_help_icon, block_help_text)
         
         # Create a frame for the Edge detection mode and its help icon
         edge_detec_frame = tk.Frame(self.main_frame)
@@ -128,6 +166,79 @@ class ImageToEmojiUI:
                                     values=["Nearest", "Box", "Bilinear", "Hamming", "Bicubic", "Lanczos"])
         resampling_combo.pack(side="left", padx=5)
         resampling_combo.state(['readonly'])
+
+        tk.Label(options_frame, text="Color distance:").pack(side="left")
+        self.distance_var = tk.StringVar(value="Legacy")
+
+        distance_combo = ttk.Combobox(options_frame, textvariable=self.distance_var, width=10,
+                                    values=["Legacy", "OKLab", "CIEDE2000"])
+        distance_combo.pack(side="left", padx=5)
+        distance_combo.state(['readonly'])
+
+        distance_help_icon = tk.Label(options_frame, text="?", font=("Arial", 8),
+                            bg="#4a7a8c", fg="white", width=1, height=1,
+                            relief="raised", cursor="question_arrow")
+        distance_help_icon.pack(side="left", pady=0)
+
+        distance_help_text = ("How colors get compared when picking emojis.\n"
+                              "Legacy: weighted RGB, what older versions used.\n"
+                              "OKLab: perceptual color space, usually picks closer looking emojis.\n"
+                              "CIEDE2000: the most accurate (and slowest) perceptual color difference.")
+        ImageToEmojiUI.create_tooltip(distance_help_icon, distance_help_text)
+
+        # Dithering options
+        dither_frame = tk.Frame(self.main_frame)
+        dither_frame.pack(fill="x", pady=(0, 5))
+
+        tk.Label(dither_frame, text="Dithering:").pack(side="left")
+        self.dither_var = tk.StringVar(value="None")
+
+        dither_combo = ttk.Combobox(dither_frame, textvariable=self.dither_var, width=15,
+                                    values=["None", "Floyd-Steinberg", "Atkinson", "Bayer"])
+        dither_combo.pack(side="left", padx=5)
+        dither_combo.state(['readonly'])
+
+        dither_help_icon = tk.Label(dither_frame, text="?", font=("Arial", 8),
+                            bg="#4a7a8c", fg="white", width=1, height=1,
+                            relief="raised", cursor="question_arrow")
+        dither_help_icon.pack(side="left", pady=0)
+
+        dither_help_text = ("Mixes emojis so smooth gradients don't turn in to flat bands.\n"
+                            "Floyd-Steinberg: passes the color error of every emoji on to its neighbours.\n"
+                            "Atkinson: same, but only passes on part of the error, keeps more contrast.\n"
+                            "Bayer: regular pattern, faster and more even but looks more like a grid.")
+        ImageToEmojiUI.create_tooltip(dither_help_icon, dither_help_text)
+
+        # Message length budget
+        budget_frame = tk.Frame(self.main_frame)
+        budget_frame.pack(fill="x", pady=(0, 5))
+
+        tk.Label(budget_frame, text="Character limit:").pack(side="left")
+        self.char_budget_var = tk.StringVar(value="")
+        self.char_budget_entry = tk.Entry(budget_frame, textvariable=self.char_budget_var, width=7)
+        self.char_budget_entry.pack(side="left", padx=5)
+
+        tk.Label(budget_frame, text="Max different emojis:").pack(side="left")
+        self.max_distinct_var = tk.StringVar(value="")
+        self.max_distinct_entry = tk.Entry(budget_frame, textvariable=self.max_distinct_var, width=5)
+        self.max_distinct_entry.pack(side="left", padx=5)
+
+        # After a conversion with limits, changing them re-fits the grid right away (way faster than converting again)
+        self.char_budget_var.trace_add("write", self.schedule_resolve_budget)
+        self.max_distinct_var.trace_add("write", self.schedule_resolve_budget)
+
+        budget_help_icon = tk.Label(budget_frame, text="?", font=("Arial", 8),
+                            bg="#4a7a8c", fg="white", width=1, height=1,
+                            relief="raised", cursor="question_arrow")
+        budget_help_icon.pack(side="left", pady=0)
+
+        budget_help_text = ("Leave empty for no limit.\n"
+                            "Character limit: picks emojis with shorter names where that costs the least color accuracy, "
+                            "until the whole message fits in this many characters (e.g. 4000 for Slack, 2000 for Discord).\n"
+                            "Max different emojis: only uses this many different emojis.\n"
+                            "After converting with a limit, changing the limits updates the grid without converting again.\n"
+                            "Both ignore dithering, emoji layout matching and edge detection.")
+        ImageToEmojiUI.create_tooltip(budget_help_icon, budget_help_text)
         
         # Progress bar
         progress_frame = tk.Frame(self.main_frame)
@@ -299,17 +410,129 @@ class ImageToEmojiUI:
             messagebox.showerror("Invalid dimensions", "Width and height must be integers.")
             return None, None
             
+    def get_budget_limits(self, show_errors=True):
+        """Character limit and max different emojis from the entries (None if empty), (False, False) if invalid"""
+        try:
+            char_budget = self.char_budget_var.get().strip()
+            max_distinct = self.max_distinct_var.get().strip()
+            char_budget = max(1, int(char_budget)) if char_budget else None
+            max_distinct = max(1, int(max_distinct)) if max_distinct else None
+            return char_budget, max_distinct
+        except ValueError:
+            if show_errors:
+                messagebox.showerror("Invalid limits", "Character limit and max different emojis must be integers (or empty).")
+            return False, False
+
+    def schedule_resolve_budget(self, *args):
+        """Re-fits the last conversion in the limits once they stop changing for a bit (they change on every key press)"""
+        if self.converter is None or self.converter.budget_solver is None:
+            return
+        if self._resolve_job is not None:
+            self.dialog.after_cancel(self._resolve_job)
+        self._resolve_job = self.dialog.after(RESOLVE_DELAY, self.resolve_budget)
+
+    def resolve_budget(self):
+        self._resolve_job = None
+        char_budget, max_distinct = self.get_budget_limits(show_errors=False)
+        if char_budget is False:
+            return # Still typing, we'll try again on the next change
+        try:
+            display_grid, emoji_mapping = self.converter.resolve_budget(char_budget, max_distinct)
+        except Exception as e:
+            self.handle_error(str(e))
+            return
+        self._resolve_generation += 1
+        generation = self._resolve_generation
+        message = f"Updated, the message is {self.converter.message_length} characters"
+        if char_budget is not None and self.converter.message_length > char_budget:
+            message = (f"Couldn't fit it in {char_budget} characters, "
+                       f"the shortest we got is {self.converter.message_length}")
+
+        # Only emojis that aren't in the palette yet have to be loaded, off the main thread so typing doesn't stutter
+        palette_names = {name for name, _ in self.app.emoji_mappings.values()}
+        missing = [name for name, index in emoji_mapping.items() if index != 0 and name not in palette_names]
+        if not missing:
+            self.apply_resolved(generation, display_grid, emoji_mapping, {}, message)
+            return
+
+        def load_missing():
+            tiles = {}
+            for name in missing:
+                url = self.app.slack_emojis.get(name.strip(':'))
+                if url is not None:
+                    tiles[name] = self.app.add_slack_emoji_to_palette_parallel(name.strip(':'), url)[1]
+            self.parent.after(0, lambda: self.apply_resolved(generation, display_grid, emoji_mapping, tiles, message))
+
+        self.status_var.set(f"Loading {len(missing)} emojis...")
+        threading.Thread(target=load_missing, daemon=True).start()
+
+    def apply_resolved(self, generation, display_grid, emoji_mapping, tiles, message):
+        """
+        Shows a re-fit grid in the app without rebuilding its palette: emojis that are still used keep their index,
+        new ones take the place of ones that aren't used anymore (or get added), and only the cells that changed
+        get redrawn
+        Args:
+            display_grid (list): rows of indices in to emoji_mapping, see ImageToEmojiConverter.resolve_budget
+            emoji_mapping (dict): emoji name -> index in display_grid
+            tiles (dict): emoji name -> EmojiTile (or None if it failed to load) for the emojis not in the palette
+        """
+        if generation != self._resolve_generation:
+            return # A newer re-fit already replaced this one
+        app = self.app
+        if (len(display_grid), len(display_grid[0]) if display_grid else 0) != app.grid.shape:
+            # Grid size changed since the conversion, go the long way
+            self.apply_to_app(display_grid, emoji_mapping)
+            self.status_var.set(message)
+            return
+
+        palette_indices = {name: index for index, (name, _) in app.emoji_mappings.items()}
+        unused = [index for index, (name, _) in sorted(app.emoji_mappings.items())
+                  if index != 0 and name not in emoji_mapping]
+        lookup = np.zeros(len(emoji_mapping), dtype=np.int64) # Index in display_grid -> palette index
+        added = False
+        for name, index in emoji_mapping.items():
+            if index == 0:
+                continue # The background always stays at index 0, like apply_to_app leaves it
+            if name in palette_indices:
+                lookup[index] = palette_indices[name]
+                continue
+            tile = tiles.get(name)
+            if tile is None:
+                # Create a fallback image (debug purple)
+                tile = EmojiTile(Image.new('RGB', (25, 25), color=(255, 0, 255)))
+            if unused:
+                palette_index = unused.pop(0)
+            else:
+                palette_index = app.emoji_count
+                app.emoji_count += 1
+                added = True
+            app.set_palette_entry(palette_index, name, tile)
+            app.slack_emoji_indices.add(palette_index)
+            lookup[index] = palette_index
+
+        grid = EmojiGrid.from_list(display_grid)
+        grid.remap(lookup)
+        app.grid = grid
+        if added:
+            app.build_emoji_entries()
+        app.refresh_grid_colors()
+        self.status_var.set(message)
+
     def disable_controls(self):
         self.convert_button.config(state=tk.DISABLED)
         self.image_path_entry.config(state=tk.DISABLED)
         self.width_entry.config(state=tk.DISABLED)
         self.height_entry.config(state=tk.DISABLED)
+        self.char_budget_entry.config(state=tk.DISABLED)
+        self.max_distinct_entry.config(state=tk.DISABLED)
         
     def enable_controls(self):
         self.convert_button.config(state=tk.NORMAL)
         self.image_path_entry.config(state=tk.NORMAL)
         self.width_entry.config(state=tk.NORMAL)
         self.height_entry.config(state=tk.NORMAL)
+        self.char_budget_entry.config(state=tk.NORMAL)
+        self.max_distinct_entry.config(state=tk.NORMAL)
         
     def start_conversion(self):
         # Check if Slack emojis are available
@@ -321,6 +544,10 @@ class ImageToEmojiUI:
         if target_width is None or target_height is None:
             return
 
+        char_budget, max_distinct = self.get_budget_limits()
+        if char_budget is False:
+            return
+
         # Try to retrieve the image from the appropriate source
         image = None
         source = self.image_path_var.get().strip()
@@ -367,7 +594,13 @@ class ImageToEmojiUI:
         )
 
         self.converter.set_resampling_mode(self.resampling_var.get())
+        self.converter.set_distance_mode(self.distance_var.get())
+        self.converter.set_dither_mode(self.dither_var.get())
         self.converter.emoji_precomputer.exclude_gifs = self.exclude_gifs_var.get()
+        self.converter.use_color_lut = self.use_color_lut_var.get()
+        self.converter.block_matching = self.block_matching_var.get()
+        self.converter.char_budget = char_budget
+        self.converter.max_distinct_emojis = max_distinct
 
         # Set edge detection options if enabled
         edge_detection_enabled = self.edge_detection_mode.get()
@@ -423,9 +656,15 @@ class ImageToEmojiUI:
         try:
             # Update the main application's grid with our new emoji grid
             self.apply_to_app(display_grid, emoji_mapping)
-            self.status_var.set("Conversion complete!")
             self.enable_controls()
-            
+
+            if self.converter.budget_solver is not None:
+                # Stay open so the limits can still be changed
+                self.status_var.set(f"Conversion complete! The message is {self.converter.message_length} characters, "
+                                    "change the limits to update the grid")
+                return
+
+            self.status_var.set("Conversion complete!")
             # Close dialog if successful
             self.dialog.destroy()
             
@@ -470,7 +709,7 @@ class ImageToEmojiUI:
                     self.app.add_slack_emoji_to_palette(name_without_colons, url)
         
         # Update the grid with emoji indices
-        self.app.grid = display_grid
+        self.app.grid = EmojiGrid.from_list(display_grid)
         
         # Rebuild the UI
         self.app.build_emoji_entries()
@@ -560,7 +799,7 @@ class ImageToEmojiUI:
             self.app.finalize_add_slack_emoji_to_palette(img, name_without_colons)
 
         # Update the grid with emoji indices
-        self.app.grid = display_grid
+        self.app.grid = EmojiGrid.from_list(display_grid)
         
         # Rebuild the UI components
         self.app.build_emoji_entries()
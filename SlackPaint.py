@@ -3,16 +3,24 @@ import tkinter as tk
 from tkinter import filedialog, messagebox, ttk
 from tkinter.colorchooser import askcolor
 import webbrowser
-from PIL import Image, ImageTk
+from PIL import Image
 import random
 import os
+import multiprocessing
+from urllib.parse import urlparse
 
 from Updater import Updater
 from ImageToEmojiUI import ImageToEmojiUI
+from EmojiImageCache import EmojiImageCache
+from EmojiTileCache import EmojiTile, EmojiTileCache
+from EmojiExporter import EmojiExporter
+from EmojiGrid import EmojiGrid
+from EmojiBrush import EmojiBrush, BRUSH_SIZES
+from GridRenderer import CanvasGridRenderer, BitmapGridRenderer
+from EmojiAliasIndex import EmojiAliasIndex
+from EmojiPrecomputer import FEATURE_CACHE_FILE
 
 import json
-from io import BytesIO
-import urllib.request
 
 __version__ = "v0.2.5-beta"
 
@@ -24,6 +32,19 @@ MAX_EMOJIS = 999#10
 DEFAULT_ROWS = 20
 DEFAULT_COLS = 20
 CELL_SIZE = 25
+ZOOM_LEVELS = (0.5, 0.75, 1.0, 1.5, 2.0, 3.0) # Canvas zoom steps, cells are CELL_SIZE * zoom pixels
+VIEWPORT_MARGIN = 4 # Cells around the visible part of a scrolled canvas that get drawn too, so scrolling a bit doesn't show gaps
+BITMAP_RENDER_CELLS = 2500 # In "Auto" render mode grids with more cells than this are drawn as a single bitmap
+MAX_BITMAP_PIXELS = 4096 * 4096 # Grids bigger than this (in pixels, at the current zoom) never get drawn as a single bitmap
+BLANK_EMOJIS = (":_:",) # Index 0 emojis that are invisible in a message, only those get trimmed from exports
+DISCORD_HOSTS = ("discordapp.com", "discordapp.net", "discord.com") # Emoji urls on these come from a discord json
+BROWSER_USER_AGENT = ("Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+                      "(KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36")
+
+def is_discord_url(url):
+    """If url points at discord's cdn (checked on the host, so it also works for images we have cached)"""
+    host = (urlparse(url).hostname or "").lower()
+    return any(host == discord_host or host.endswith("." + discord_host) for discord_host in DISCORD_HOSTS)
 
 emoji_palette = {
     0: (":_:", "#ffffff"),
@@ -40,10 +61,9 @@ class EmojiGridApp:
         self.rows = DEFAULT_ROWS
         self.cols = DEFAULT_COLS
         self.cell_size = CELL_SIZE
+        self.zoom_index = ZOOM_LEVELS.index(1.0)
         self.current_color = 1
-        self.grid = []
-        self.rects = {}
-        self.canvas_images = {}  # Track image objects separately
+        self.grid = EmojiGrid(0, 0)
         self.image_mode = False
 
         self.emoji_mappings = emoji_palette.copy()
@@ -53,6 +73,7 @@ class EmojiGridApp:
 
         self.slack_emojis_version = None # To store the last modified date of the file used to load slack emojis, used to check the "version"
         self.slack_emojis = None  # To store the loaded Slack emoji mapping
+        self.emoji_aliases = None  # EmojiAliasIndex of slack_emojis, shortest name for every emoji image
 
         self.canvas_container = tk.Frame(root)
         self.canvas_container.pack(fill="both", expand=True)
@@ -67,6 +88,12 @@ class EmojiGridApp:
         )
         self.toggle_canvas_button.pack(side="left")
 
+        # --- Zoom ---
+        tk.Button(self.top_bar, text="-", width=2, command=lambda: self.set_zoom(self.zoom_index - 1)).pack(side="left", padx=(5, 0))
+        self.zoom_label = tk.Label(self.top_bar, text="100%", width=5)
+        self.zoom_label.pack(side="left")
+        tk.Button(self.top_bar, text="+", width=2, command=lambda: self.set_zoom(self.zoom_index + 1)).pack(side="left")
+
         # --- Background colour section ---
         self.bg_color_entry = tk.Entry(self.top_bar, width=12)
         self.bg_color_entry.insert(0, "#1a1d21")  # Default value
@@ -80,7 +107,7 @@ class EmojiGridApp:
         help_icon.pack(side="right", padx=1)
         
         help_text = ("This allows you to set the background colour of emojis, the image to emoji feature will use this so it knows what to intrepret transparency as, currently set to slack dark mode backgound color\
-                     \n\nNOTE!: this will only have a effect on the image generation if you run for the first time or delete your cache (emoji_feature_cache.pkl)")
+                     \n\nNOTE!: changing this means the emoji colors have to be recomputed the next time you convert an image (they are cached in emoji_feature_cache.npz)")
         ImageToEmojiUI.create_tooltip(help_icon, help_text)
 
         # -- Canvas scrolling --
@@ -97,14 +124,20 @@ class EmojiGridApp:
         self.h_scroll = ttk.Scrollbar(self.canvas_frame, orient="horizontal", command=self.canvas.xview)
 
         # Attach canvas to scrollbars
-        self.canvas.configure(yscrollcommand=self.v_scroll.set, xscrollcommand=self.h_scroll.set)
+        self.canvas.configure(yscrollcommand=self.on_canvas_yscroll, xscrollcommand=self.on_canvas_xscroll)
 
         # Pack canvas
         self.canvas.pack(fill="both", expand=True)
+        self.render_mode = "Auto"
+        self.renderer = None
+        self.viewport = None # Cells that can be seen when the canvas is scrolled, None when everything can be seen
+        self.viewport_after_id = None
         
         self.is_scrollable = False
 
         self.active_button = None
+        self.brush = EmojiBrush()
+        self.render_after_id = None
         
         self.approxNonCanvasWidth = 0
         self.approxNonCanvasHeight = 0
@@ -211,6 +244,39 @@ class EmojiGridApp:
 
         self.is_scrollable = False
 
+    def on_canvas_yscroll(self, first, last):
+        self.v_scroll.set(first, last)
+        self.schedule_viewport_update()
+
+    def on_canvas_xscroll(self, first, last):
+        self.h_scroll.set(first, last)
+        self.schedule_viewport_update()
+
+    def schedule_viewport_update(self):
+        # Scrolling calls both scroll commands (often several times), only work out the viewport once they're done
+        if self.viewport_after_id is None:
+            self.viewport_after_id = self.root.after_idle(self.update_viewport)
+
+    def visible_cells(self):
+        """(top, left, bottom, right) cells that can be seen (plus a margin), None if the canvas isn't scrolled"""
+        if not self.is_scrollable:
+            return None
+        size = self.cell_size
+        left = int(self.canvas.canvasx(0) // size)
+        top = int(self.canvas.canvasy(0) // size)
+        right = int(self.canvas.canvasx(self.canvas.winfo_width()) // size) + 1
+        bottom = int(self.canvas.canvasy(self.canvas.winfo_height()) // size) + 1
+        return (top - VIEWPORT_MARGIN, left - VIEWPORT_MARGIN, bottom + VIEWPORT_MARGIN, right + VIEWPORT_MARGIN)
+
+    def update_viewport(self):
+        """Lets the renderer know which cells can be seen, so only those (plus a margin) need canvas items"""
+        self.viewport_after_id = None
+        viewport = self.visible_cells()
+        if viewport != self.viewport:
+            self.viewport = viewport
+            if self.renderer.set_viewport(viewport):
+                self.refresh_grid_colors()
+
     def on_canvas_mousewheel(self, event):
         """Handle vertical scrolling with mouse wheel"""
         if self.is_scrollable:
@@ -221,6 +287,32 @@ class EmojiGridApp:
         if self.is_scrollable:
             self.canvas.xview_scroll(int(-1 * (event.delta / 120)), "units")
 
+    def on_canvas_ctrl_mousewheel(self, event):
+        """Zoom with Ctrl+mouse wheel"""
+        self.set_zoom(self.zoom_index + (1 if event.delta > 0 else -1))
+
+    def set_zoom(self, zoom_index):
+        """
+        Changes the size cells are drawn at, emojis get their tiles at the new size from the EmojiTileCache
+        (nothing gets downloaded or decoded again)
+        """
+        zoom_index = min(max(zoom_index, 0), len(ZOOM_LEVELS) - 1)
+        if zoom_index == self.zoom_index:
+            return
+        self.zoom_index = zoom_index
+        self.cell_size = max(1, round(CELL_SIZE * ZOOM_LEVELS[zoom_index]))
+        self.zoom_label.config(text=f"{round(ZOOM_LEVELS[zoom_index] * 100)}%")
+
+        # Renderers draw at one cell size, the next refresh makes a new one
+        self.renderer.clear()
+        self.renderer = None
+        if self.is_scrollable:
+            self.canvas.config(scrollregion=(0, 0, self.cols * self.cell_size, self.rows * self.cell_size))
+        # Right away, zoomed in big grids get canvas items and those shouldn't be made for the whole grid first
+        self.viewport = self.visible_cells()
+        self.reset_grid()
+        self.schedule_viewport_update()
+
     def toggle_canvas(self):
         if self.canvas_frame.winfo_ismapped():
             self.canvas_frame.pack_forget()
@@ -250,6 +342,27 @@ class EmojiGridApp:
         grid_buttons_frame.pack(pady=2.5)
         tk.Button(grid_buttons_frame, text="Clear Emoji Entries", command=self.comfirm_reset_emoji_entries).pack(side="left", padx=2.5)
 
+        tk.Label(grid_buttons_frame, text="Rendering:").pack(side="left", padx=(5, 0))
+        self.render_mode_var = tk.StringVar(value=self.render_mode)
+        render_mode_combo = ttk.Combobox(grid_buttons_frame, textvariable=self.render_mode_var, width=12,
+                                    values=["Auto", "Canvas items", "Single bitmap"])
+        render_mode_combo.pack(side="left", padx=2.5)
+        render_mode_combo.state(['readonly'])
+        render_mode_combo.bind("<<ComboboxSelected>>", lambda e: self.set_render_mode(self.render_mode_var.get()))
+
+        render_help_icon = tk.Label(grid_buttons_frame, text="?", font=("Arial", 8), 
+                            bg="#4a7a8c", fg="white", width=1, height=1,
+                            relief="raised", cursor="question_arrow")
+        render_help_icon.pack(side="left", padx=1)
+        render_help_text = ("How the grid gets drawn.\n"
+                            "Canvas items: every cell is its own canvas item, fine for small grids.\n"
+                            "Single bitmap: the whole grid is one image and painting only updates the cells that changed, "
+                            "much faster (and less memory) for big grids e.g. converted images.\n"
+                            f"Auto: single bitmap for grids with more than {BITMAP_RENDER_CELLS} cells.\n"
+                            "Grids that would make a huge bitmap (big and zoomed in) always use canvas items, "
+                            "only for the cells you can see.")
+        ImageToEmojiUI.create_tooltip(render_help_icon, render_help_text)
+
         # --- Scrollable emoji mapping panel ---
         self.mapping_container = tk.Frame(self.settings_frame)
         self.mapping_container.pack()
@@ -330,6 +443,29 @@ class EmojiGridApp:
         tk.Button(button_frame2, text="Save", command=self.save).pack(side="left", padx=2)
         tk.Button(button_frame2, text="Load", command=self.load).pack(side="left", padx=2)
 
+        # --- Export options ---
+        export_frame = tk.Frame(self.settings_frame)
+        export_frame.pack()
+        tk.Label(export_frame, text="Message limit").pack(side="left")
+        self.message_limit_entry = tk.Entry(export_frame, width=6)
+        self.message_limit_entry.pack(side="left", padx=2)
+        self.trim_background_var = tk.BooleanVar(value=True)
+        tk.Checkbutton(export_frame, text="Trim blanks", variable=self.trim_background_var).pack(side="left")
+        self.shortest_names_var = tk.BooleanVar(value=True)
+        tk.Checkbutton(export_frame, text="Shortest names", variable=self.shortest_names_var).pack(side="left")
+
+        export_help_icon = tk.Label(export_frame, text="?", font=("Arial", 8), 
+                            bg="#4a7a8c", fg="white", width=1, height=1,
+                            relief="raised", cursor="question_arrow")
+        export_help_icon.pack(side="left", padx=1)
+        export_help_text = ("Message limit: max characters per message (e.g. 4000 for Slack, 2000 for Discord), "
+                            "if the drawing doesn't fit Copy splits it in to several messages. Leave empty for no limit.\n"
+                            "Trim blanks: leaves out emoji index 0 at the end of rows (and empty rows at the bottom) "
+                            "when it's the blank :_: emoji, it's invisible there anyway. Any other emoji at index 0 "
+                            "(e.g. :black_large_square: for Discord) is part of the picture so it's always kept.\n"
+                            "Shortest names: uses the shortest name of emojis that have several names for the same image.")
+        ImageToEmojiUI.create_tooltip(export_help_icon, export_help_text)
+
         # Create a frame for Image to Emoji button
         convert_img_frame = tk.Frame(self.settings_frame)
         convert_img_frame.pack()
@@ -356,6 +492,16 @@ class EmojiGridApp:
         self.add_image_button = tk.Button(legacy_inner_frame, text="Add Image", command=self.add_image)
         self.add_image_button.pack(pady=2)
 
+        brush_frame = tk.Frame(self.settings_frame)
+        brush_frame.pack()
+        tk.Label(brush_frame, text="Brush size:").pack(side="left")
+        self.brush_size_var = tk.StringVar(value=str(self.brush.size))
+        brush_size_combo = ttk.Combobox(brush_frame, textvariable=self.brush_size_var, width=3,
+                                    values=[str(size) for size in BRUSH_SIZES])
+        brush_size_combo.pack(side="left", padx=5)
+        brush_size_combo.state(['readonly'])
+        brush_size_combo.bind("<<ComboboxSelected>>", lambda e: self.set_brush_size(self.brush_size_var.get()))
+
         tk.Label(self.settings_frame, text="Use left mouse to draw right to remove (idx 0).").pack()
         tk.Label(self.settings_frame, text="Press 0-9 to select emoji index. Or click on the label.").pack()
 
@@ -392,7 +538,7 @@ class EmojiGridApp:
             self.slack_emoji_indices.clear()
 
             # Clear the grid to idx 0
-            self.grid = [[0 for _ in range(self.cols)] for _ in range(self.rows)]
+            self.grid.fill(0)
 
             # # Rebuild UI and visuals
             self.build_emoji_entries()
@@ -434,8 +580,9 @@ class EmojiGridApp:
             if isinstance(value, str) and value.startswith("#"):
                 color_box = tk.Label(frame, bg=value, width=3, relief="raised")
             else:
-                color_box = tk.Label(frame, image=value, width=25, height=25, relief="raised")
-                color_box.image = value  # Prevent GC
+                photo = value.photo(CELL_SIZE) if isinstance(value, EmojiTile) else value
+                color_box = tk.Label(frame, image=photo, width=25, height=25, relief="raised")
+                color_box.image = photo  # Prevent GC
 
             color_box.pack(side="left", padx=6)
 
@@ -467,12 +614,9 @@ class EmojiGridApp:
                         filetypes=[("Image Files", "*.png;*.jpg;*.jpeg;*.gif"), ("Any", ".*")]
                     )
                     if path:
-                        from PIL import Image, ImageTk
-                        img = Image.open(path)
-                        size = CELL_SIZE
-                        img = img.resize((size, size), Image.Resampling.LANCZOS)
-                        tk_img = ImageTk.PhotoImage(img)
-                        self.emoji_mappings[i] = (self.emoji_entries[i][0].get(), tk_img)
+                        tile = EmojiTile.from_file(path)
+                        tk_img = tile.photo(CELL_SIZE)
+                        self.emoji_mappings[i] = (self.emoji_entries[i][0].get(), tile)
                         color_box.config(image=tk_img)
                         color_box.image = tk_img
                         self.refresh_grid_colors()
@@ -615,12 +759,11 @@ class EmojiGridApp:
 
             url = self.slack_emojis[name_clean]
             try:
-                with urllib.request.urlopen(url) as response:
-                    img_data = response.read()
-                img = Image.open(BytesIO(img_data)).resize((self.cell_size, self.cell_size), Image.Resampling.LANCZOS)
-                tk_img = ImageTk.PhotoImage(img)
+                # Reloading is the one place where we really want to check if the image changed
+                tile = EmojiTileCache.shared().tile(url, lambda: EmojiImageCache.shared().get(url, revalidate=True), replace=True)
+                tk_img = tile.photo(CELL_SIZE)
 
-                self.emoji_mappings[i] = (emoji_name, tk_img)
+                self.emoji_mappings[i] = (emoji_name, tile)
 
                 # Update preview image in the UI
                 _, color_box = self.emoji_entries[i]
@@ -635,27 +778,32 @@ class EmojiGridApp:
     # New method to update an existing slack emoji
     def update_slack_emoji(self, index, name, url, color_box):
         try:
-            with urllib.request.urlopen(url) as response:
-                img_data = response.read()
-            img = Image.open(BytesIO(img_data)).resize((self.cell_size, self.cell_size), Image.Resampling.LANCZOS)
-            tk_img = ImageTk.PhotoImage(img)
-            
-            # Update the emoji mapping
-            emoji_name = f":{name}:"
-            self.emoji_mappings[index] = (emoji_name, tk_img)
-            
-            # Update the UI
-            self.emoji_entries[index][0].delete(0, tk.END)
-            self.emoji_entries[index][0].insert(0, emoji_name)
-            color_box.config(image=tk_img)
-            color_box.image = tk_img  # Keep a reference
-            
+            tile = EmojiTileCache.shared().tile(url, lambda: EmojiImageCache.shared().get(url))
+            # Update the emoji mapping and its entry
+            self.set_palette_entry(index, f":{name}:", tile)
+
             # Refresh the grid
             self.refresh_grid_colors()
             self.canvas.focus_set()
         except Exception as e:
             messagebox.showerror("Error", f"Failed to load emoji image: {url}\n{e} (the emoji might have been removed from the server)")
 
+    def set_palette_entry(self, index, name, value):
+        """Changes what palette index shows, and its entry in the list if it has one (doesn't redraw the grid)"""
+        self.emoji_mappings[index] = (name, value)
+        if index not in self.emoji_entries:
+            return
+        emoji_entry, color_box = self.emoji_entries[index]
+        emoji_entry.delete(0, tk.END)
+        emoji_entry.insert(0, name)
+        if isinstance(value, str):
+            color_box.config(bg=value, image="")
+            color_box.image = None
+        else:
+            tk_img = value.photo(CELL_SIZE)
+            color_box.config(image=tk_img)
+            color_box.image = tk_img  # Keep a reference
+
     def update_selection_highlight(self):
         for i, frame in self.emoji_frames.items():
             if i == self.current_color:
@@ -671,19 +819,11 @@ class EmojiGridApp:
         path = filedialog.askopenfilename(initialdir="/", title="Select An Image", filetypes=[("Image Files", "*.png;*.jpg;*.jpeg;*.gif"),("Any", ".*")])
         if not path:
             return
-        img = Image.open(path)
-        img = self.prepare_image(img)
-        tk_img = ImageTk.PhotoImage(img)
-        self.emoji_mappings[self.emoji_count] = (os.path.basename(path), tk_img)
+        self.emoji_mappings[self.emoji_count] = (os.path.basename(path), EmojiTile.from_file(path))
         self.emoji_count += 1
         self.build_emoji_entries()
         self.canvas.focus_set()
 
-    def prepare_image(self, img):
-        size = self.cell_size
-        img = img.resize((size, size), Image.LANCZOS)
-        return img
-
     def add_slack_emoji(self):
         if self.slack_emojis is None:
             path = filedialog.askopenfilename(title="Select Slack Emoji JSON", filetypes=[("JSON files", "*.json")])
@@ -693,6 +833,7 @@ class EmojiGridApp:
             self.slack_emojis_version = datetime.datetime.fromtimestamp(timestamp)
             with open(path, "r") as f:
                 self.slack_emojis = json.load(f)
+            self.emoji_aliases = EmojiAliasIndex.for_emojis(self.slack_emojis, FEATURE_CACHE_FILE)
             messagebox.showinfo("Loaded", f"{len(self.slack_emojis)} Slack emojis loaded.")
             return
 
@@ -799,30 +940,25 @@ class EmojiGridApp:
         if self.emoji_count >= MAX_EMOJIS:
             messagebox.showinfo("Limit reached", f"Maximum of {MAX_EMOJIS} emojis allowed.")
             return False
-        try:
-            # First try normal fetch
-            with urllib.request.urlopen(url) as response:
-                img_data = response.read()
-        except Exception as e1:
+        discord = is_discord_url(url)
+        if discord:
+            # Emojis from a discord json, so we'll change the default 0 emoji to a black square
+            # (decided on the url and not on how the download went, cached images never get downloaded again)
+            self.emoji_mappings[0] = (":black_large_square:", "#ffffff")
+        def fetch():
+            # Discord gives a forbidden error without a browser User-Agent
+            if discord:
+                return EmojiImageCache.shared().get(url, headers={"User-Agent": BROWSER_USER_AGENT})
             try:
-                # If normal fetch fails, try with User-Agent header
-                # to try and get pasts discord forrbiden error
-                req = urllib.request.Request(url, headers={
-                    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
-                                "(KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36"
-                })
-                with urllib.request.urlopen(req) as response:
-                    img_data = response.read()
-                # When were in this code path were most likeley using a discord json 
-                # so well change the default 0 emoji to a black square
-                self.emoji_mappings[0] = (":black_large_square:", "#ffffff")
-            except Exception as e2:
-                messagebox.showerror("Error", f"Failed to load emoji image: {url}\n{e2}")
-                return False
+                # First try normal fetch (or straight from the local image cache)
+                return EmojiImageCache.shared().get(url)
+            except Exception:
+                # If normal fetch fails, try with User-Agent header, some other hosts don't like us either
+                return EmojiImageCache.shared().get(url, headers={"User-Agent": BROWSER_USER_AGENT})
         try:
-            img = Image.open(BytesIO(img_data)).resize((self.cell_size, self.cell_size), Image.Resampling.LANCZOS)
-            tk_img = ImageTk.PhotoImage(img)
-            self.emoji_mappings[self.emoji_count] = (f":{name}:", tk_img)
+            # Only fetches (and decodes) the emoji if we haven't already
+            tile = EmojiTileCache.shared().tile(url, fetch)
+            self.emoji_mappings[self.emoji_count] = (f":{name}:", tile)
             # Mark this as a Slack emoji
             self.slack_emoji_indices.add(self.emoji_count)
             self.emoji_count += 1
@@ -835,20 +971,18 @@ class EmojiGridApp:
         
     def add_slack_emoji_to_palette_parallel(self, name, url):
         try:
-            with urllib.request.urlopen(url) as response:
-                img_data = response.read()
-            img = Image.open(BytesIO(img_data)).resize((self.cell_size, self.cell_size), Image.Resampling.LANCZOS)
-            return name, img
+            # Decoding is fine on a worker thread, only the PhotoImages have to be made on the main thread
+            tile = EmojiTileCache.shared().tile(url, lambda: EmojiImageCache.shared().get(url))
+            return name, tile
         except Exception as e:
             #messagebox.showerror("Error", f"Failed to load emoji image: {url}\n{e}")
             return name, None
 
-    def finalize_add_slack_emoji_to_palette(self, img, name):
-        if img is None:
+    def finalize_add_slack_emoji_to_palette(self, tile, name):
+        if tile is None:
             # Create a fallback image (debug purple)
-            img = Image.new('RGB', (25, 25), color=(255, 0, 255)) 
-        tk_img = ImageTk.PhotoImage(img)
-        self.emoji_mappings[self.emoji_count] = (f":{name}:", tk_img)
+            tile = EmojiTile(Image.new('RGB', (25, 25), color=(255, 0, 255)))
+        self.emoji_mappings[self.emoji_count] = (f":{name}:", tile)
         # Mark this as a Slack emoji
         self.slack_emoji_indices.add(self.emoji_count)
         self.emoji_count += 1
@@ -858,13 +992,8 @@ class EmojiGridApp:
             messagebox.showinfo("Cannot remove", "Cannot remove the default emoji.")
             return
 
-        # Step 1: Clear the index from the grid
-        for r in range(self.rows):
-            for c in range(self.cols):
-                if self.grid[r][c] == index:
-                    self.grid[r][c] = 0
-                elif self.grid[r][c] > index:
-                    self.grid[r][c] -= 1
+        # Step 1: Clear the index from the grid (and move the higher ones down)
+        self.grid.remove_index(index)
 
         # Step 2: Delete the mapping and re-index
         del self.emoji_mappings[index]
@@ -890,7 +1019,7 @@ class EmojiGridApp:
 
     def remove_all_emojis(self):
         # Prevent removing the default emoji at index 0
-        self.grid = [[0 for _ in range(self.cols)] for _ in range(self.rows)]
+        self.grid = EmojiGrid(self.rows, self.cols)
 
         # Reset emoji mappings and related state
         self.emoji_mappings.clear()
@@ -927,23 +1056,31 @@ class EmojiGridApp:
         if changed:
             self.refresh_grid_colors()
 
+    def set_render_mode(self, render_mode):
+        self.render_mode = render_mode
+        self.refresh_grid_colors()
+
+    def update_renderer(self):
+        """Swaps the renderer if the render mode (or in "Auto" the grid size) asks for a different one"""
+        if self.render_mode == "Canvas items":
+            renderer_class = CanvasGridRenderer
+        elif self.render_mode == "Single bitmap":
+            renderer_class = BitmapGridRenderer
+        else:
+            renderer_class = BitmapGridRenderer if self.grid.cells.size > BITMAP_RENDER_CELLS else CanvasGridRenderer
+        # e.g. 200x200 at 300% would be a 15000x15000 bitmap, canvas items only get made for the visible cells
+        if renderer_class is BitmapGridRenderer and self.grid.cells.size * self.cell_size ** 2 > MAX_BITMAP_PIXELS:
+            renderer_class = CanvasGridRenderer
+        if type(self.renderer) is not renderer_class:
+            if self.renderer is not None:
+                self.renderer.clear()
+            self.renderer = renderer_class(self.canvas, self.cell_size)
+            self.renderer.set_viewport(self.viewport)
+
     def refresh_grid_colors(self):
-        for r in range(self.rows):
-            for c in range(self.cols):
-                idx = self.grid[r][c]
-                fill = self.emoji_mappings.get(idx, (":?", "black"))[1]
-
-                # Remove previous image if it exists
-                if (r, c) in self.canvas_images:
-                    self.canvas.delete(self.canvas_images[(r, c)])
-                    del self.canvas_images[(r, c)]
-
-                if isinstance(fill, str):
-                    self.canvas.itemconfig(self.rects[(r, c)], fill=fill)
-                else:
-                    self.canvas.itemconfig(self.rects[(r, c)], fill=self.bg_color_entry.get())
-                    img_id = self.canvas.create_image(c * self.cell_size, r * self.cell_size, anchor="nw", image=fill)
-                    self.canvas_images[(r, c)] = img_id
+        # Only redraws the cells whose emoji (or whose emoji's color/image) changed
+        self.update_renderer()
+        self.renderer.update(self.grid, self.emoji_mappings, self.bg_color_entry.get())
 
     def set_grid_size(self, new_rows, new_cols):
         if new_rows <= 0 or new_cols <= 0:
@@ -965,44 +1102,43 @@ class EmojiGridApp:
             messagebox.showerror("Invalid input", "Grid size must be positive integers.")
 
     def reset_grid(self, initialize=False):
-        old = self.grid if not initialize else []
-        self.grid = [[old[r][c] if r < len(old) and c < len(old[0]) else 0 for c in range(self.cols)] for r in range(self.rows)]
+        if initialize:
+            self.grid = EmojiGrid(self.rows, self.cols)
+        else:
+            self.grid.resize(self.rows, self.cols)
         self.canvas.config(width=self.cols * self.cell_size, height=self.rows * self.cell_size)
-        self.canvas.delete("all")
-        self.rects.clear()
-        self.canvas_images.clear()  # Clear image references
-        for r in range(self.rows):
-            for c in range(self.cols):
-                x1, y1 = c * self.cell_size, r * self.cell_size
-                x2, y2 = x1 + self.cell_size, y1 + self.cell_size
-                color = self.emoji_mappings.get(self.grid[r][c], (":?", "black"))[1]
-                if isinstance(color, str):
-                    rect = self.canvas.create_rectangle(x1, y1, x2, y2, fill=color, outline="gray")
-                else:
-                    rect = self.canvas.create_rectangle(x1, y1, x2, y2, fill=self.bg_color_entry.get(), outline="gray")
-                    img_id = self.canvas.create_image(x1, y1, anchor="nw", image=color)
-                    self.canvas_images[(r, c)] = img_id
-                self.rects[(r, c)] = rect
+        self.refresh_grid_colors()
 
     def setup_bindings(self):
         self.canvas.bind("<Button-1>", self.on_left_click)
         self.canvas.bind("<B1-Motion>", self.on_mouse_drag)
         self.canvas.bind("<Button-3>", self.on_right_click)
         self.canvas.bind("<B3-Motion>", self.on_mouse_drag)
+        self.canvas.bind("<ButtonRelease-1>", self.on_mouse_release)
+        self.canvas.bind("<ButtonRelease-3>", self.on_mouse_release)
+        self.canvas.bind("<Control-MouseWheel>", self.on_canvas_ctrl_mousewheel)
         self.root.bind("<Key>", self.handle_keypress)
         #self.setup_canvas_bindings()
 
     def on_left_click(self, event):
         self.active_button = 1
+        self.brush.end_stroke()
         self.paint_at(event)
 
     def on_right_click(self, event):
         self.active_button = 3
+        self.brush.end_stroke()
         self.paint_at(event)
 
     def on_mouse_drag(self, event):
         self.paint_at(event)
 
+    def on_mouse_release(self, event):
+        self.brush.end_stroke()
+
+    def set_brush_size(self, brush_size):
+        self.brush.size = int(brush_size)
+
     def refocus_canvas(self, event):
         widget = self.root.winfo_containing(event.x_root, event.y_root)
         if not isinstance(widget, tk.Entry):
@@ -1020,28 +1156,26 @@ class EmojiGridApp:
         col = int(canvas_x // self.cell_size)
         row = int(canvas_y // self.cell_size)
         
-        if 0 <= row < self.rows and 0 <= col < self.cols:
-            if self.active_button == 1:  # Left click = paint
-                new_idx = self.current_color
-            elif self.active_button == 3:  # Right click = erase
-                new_idx = 0
-            else:
-                return
+        if self.active_button == 1:  # Left click = paint
+            new_idx = self.current_color
+        elif self.active_button == 3:  # Right click = erase
+            new_idx = 0
+        else:
+            return
 
-            self.grid[row][col] = new_idx
+        # The brush connects this cell to the last one of the stroke (and clips whatever is outside of the grid)
+        if self.brush.stroke_to(self.grid, row, col, new_idx):
+            self.schedule_render()
 
-            # Remove existing image if present
-            if (row, col) in self.canvas_images:
-                self.canvas.delete(self.canvas_images[(row, col)])
-                del self.canvas_images[(row, col)]
+    def schedule_render(self):
+        # Motion events come in faster than we can draw, so the grid only gets redrawn once Tk is idle,
+        # one update for everything painted since then
+        if self.render_after_id is None:
+            self.render_after_id = self.root.after_idle(self.render_pending)
 
-            fill = self.emoji_mappings.get(new_idx, (":?", "black"))[1]
-            if isinstance(fill, str):
-                self.canvas.itemconfig(self.rects[(row, col)], fill=fill)
-            else:
-                self.canvas.itemconfig(self.rects[(row, col)], fill=self.bg_color_entry.get())
-                img_id = self.canvas.create_image(col * self.cell_size, row * self.cell_size, anchor="nw", image=fill)
-                self.canvas_images[(row, col)] = img_id
+    def render_pending(self):
+        self.render_after_id = None
+        self.refresh_grid_colors()
 
     def handle_keypress(self, event):
         if isinstance(self.root.focus_get(), tk.Entry):
@@ -1054,28 +1188,60 @@ class EmojiGridApp:
 
     def export(self):
         self.update_palette()
-        fallback_emoji = "⬛"
-        missing_keys = set()
-        output = "\n".join(
-            "".join(
-                self.emoji_mappings[cell][0]
-                if cell in self.emoji_mappings
-                else (missing_keys.add(cell) or fallback_emoji)
-                for cell in row
-            )
-            for row in self.grid
+        try:
+            limit = self.message_limit_entry.get().strip()
+            limit = int(limit) if limit else None
+            if limit is not None and limit <= 0:
+                raise ValueError
+        except ValueError:
+            messagebox.showerror("Invalid input", "Message limit must be a positive integer (or empty).")
+            return
+
+        aliases = self.emoji_aliases.shortest_names if self.shortest_names_var.get() and self.emoji_aliases else None
+        # Trimming a visible emoji would make rows ragged and change the picture
+        background_name = self.emoji_mappings[0][0] if 0 in self.emoji_mappings else None
+        exporter = EmojiExporter(
+            {index: name for index, (name, _) in self.emoji_mappings.items()},
+            background=0,
+            aliases=aliases,
+            trim_background=self.trim_background_var.get() and background_name in BLANK_EMOJIS
         )
+        messages = exporter.split(self.grid, limit) if limit is not None else [exporter.export(self.grid)]
         # Log missing keys if any
-        if missing_keys:
-            print(f"[Export Warning] Missing emoji mappings for cells: {sorted(missing_keys)}")
+        if exporter.missing:
+            print(f"[Export Warning] Missing emoji mappings for cells: {sorted(exporter.missing)}")
+
+        if len(messages) > 1:
+            self.show_export_messages(messages, limit)
+            return
         self.root.clipboard_clear()
-        self.root.clipboard_append(output)
+        self.root.clipboard_append(messages[0])
         # --- Export confirmation message ---
         self.export_msg = tk.Label(self.settings_frame, text="", fg="green")
-        self.export_msg.config(text="Copied to clipboard!")
+        self.export_msg.config(text=f"Copied to clipboard! ({len(messages[0])} characters)")
         self.export_msg.pack()
         self.root.after(2000, lambda: self.export_msg.pack_forget()) #self.export_msg.config(text="")
 
+    def show_export_messages(self, messages, limit):
+        """For drawings that don't fit in one message, a button to copy every part separately"""
+        window = tk.Toplevel(self.root)
+        window.title("Copy messages")
+        window.resizable(False, False)
+        window.transient(self.root)
+        tk.Label(window, text=f"Doesn't fit in one message of {limit} characters,\n"
+                              f"send these {len(messages)} messages one after the other:").pack(padx=10, pady=5)
+        status = tk.Label(window, text="", fg="green")
+
+        def copy_message(i):
+            self.root.clipboard_clear()
+            self.root.clipboard_append(messages[i])
+            status.config(text=f"Message {i + 1} copied to clipboard!")
+
+        for i, message in enumerate(messages):
+            tk.Button(window, text=f"Copy message {i + 1} ({len(message)} characters)",
+                      command=lambda i=i: copy_message(i)).pack(fill="x", padx=10, pady=1)
+        status.pack(pady=5)
+
     def save(self):
         self.update_palette()
         path = filedialog.asksaveasfilename(defaultextension=".emojigrid")
@@ -1088,7 +1254,7 @@ class EmojiGridApp:
                     "cols": self.cols
                 },
                 "emoji_mappings": {},
-                "grid": self.grid,
+                "grid": self.grid.tolist(),
                 "slack_emoji_json": self.slack_emojis  # Save the entire Slack emoji JSON
             }
 
@@ -1132,6 +1298,7 @@ class EmojiGridApp:
 
             # Restore Slack emojis JSON if present
             self.slack_emojis = save_data.get("slack_emoji_json", None)
+            self.emoji_aliases = EmojiAliasIndex.for_emojis(self.slack_emojis, FEATURE_CACHE_FILE) if self.slack_emojis else None
 
             # Restore grid size
             self.set_grid_size(save_data["grid_size"]["rows"], save_data["grid_size"]["cols"])
@@ -1153,12 +1320,9 @@ class EmojiGridApp:
                     if self.slack_emojis and name in self.slack_emojis:
                         url = self.slack_emojis[name]
                         try:
-                            with urllib.request.urlopen(url) as response:
-                                img_data = response.read()
-                            img = Image.open(BytesIO(img_data)).resize((self.cell_size, self.cell_size), Image.Resampling.LANCZOS)
-                            tk_img = ImageTk.PhotoImage(img)
+                            tile = EmojiTileCache.shared().tile(url, lambda: EmojiImageCache.shared().get(url))
                             
-                            self.emoji_mappings[idx] = (emoji_data["name"], tk_img)
+                            self.emoji_mappings[idx] = (emoji_data["name"], tile)
                             self.slack_emoji_indices.add(idx)
                             self.emoji_count = max(self.emoji_count, idx + 1)
                         except Exception as e:
@@ -1179,7 +1343,7 @@ class EmojiGridApp:
                     self.emoji_count = max(self.emoji_count, idx + 1)
 
             # Restore grid
-            self.grid = save_data["grid"]
+            self.grid = EmojiGrid.from_list(save_data["grid"])
 
             # Rebuild UI and refresh grid
             self.build_emoji_entries()
@@ -1190,6 +1354,8 @@ class EmojiGridApp:
             messagebox.showerror("Load Error", f"Failed to load file: {e}")
 
 if __name__ == "__main__":
+    # Needed for the emoji precomputer's worker processes when we're packaged as an exe
+    multiprocessing.freeze_support()
     root = tk.Tk()
     check_for_update()
     root.lift() # Bring window to top
@@ -0,0 +1,119 @@
+import sys
+import time
+import numpy as np
+from io import BytesIO
+from functools import partial
+from PIL import Image, ImageDraw
+
+import EmojiFeatures
+from ColorSpace import srgb_to_oklab
+from EmojiFeatures import extract_emoji_colors_batch
+from EmojiPrecomputer import ANALYSIS_CHUNK_SIZE
+
+#
+#   Benchmark for the emoji analysis settings (EmojiPrecomputer.analysis_size / analysis_samples)
+#   Makes a bunch of synthetic emojis (a few random shapes on a transparent background) and analyzes them at full
+#   size with every pixel as reference, then with every setting. Per setting it prints:
+#       ms/emoji    analysis time, in chunks of ANALYSIS_CHUNK_SIZE like the precomputer sends them to its workers
+#       drift       mean OKLab distance of the dominant colors to the closest reference ones (raw feature change)
+#       changed     share of random colors that get matched to a different emoji than with the reference features
+#       regret      how much further (mean OKLab distance, measured on the reference colors) the emoji we match is
+#                   from the color than the one the reference features match, what actually ends up in the picture
+#   The "full, seed 1" row is the reference again with another k-means seed, matches flip between emojis with
+#   similar colors just from that, so anything around it is noise.
+#   Usage: python bench_analysis.py [emoji count] [emoji size] [query colors]
+#
+
+BACKGROUND_RGB = (26, 29, 33) # Default dark theme background
+SETTINGS = [ # (label, analysis_size, analysis_samples), None for full size/every pixel
+    ("full, seed 1", None, None),
+    ("full/2048", None, 2048),
+    ("full/1024", None, 1024), # EmojiPrecomputer's default
+    ("full/512", None, 512),
+    ("64", 64, None),
+    ("64/1024", 64, 1024),
+    ("32", 32, None),
+    ("32/512", 32, 512),
+    ("32/256", 32, 256),
+    ("16", 16, None),
+    ("16/128", 16, 128),
+]
+MATCH_CHUNK = 4096 # Query colors we match at once
+
+def make_emoji(rng, size):
+    """PNG bytes of a random emoji, a few ellipses/rectangles/lines in random colors"""
+    img = Image.new("RGBA", (size, size), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(img)
+    for _ in range(int(rng.integers(2, 7))):
+        x0, y0 = (int(v) for v in rng.integers(0, size * 3 // 4, 2))
+        x1, y1 = (int(v) for v in rng.integers(size // 8, size // 2, 2) + (x0, y0))
+        color = tuple(int(c) for c in rng.integers(0, 256, 3)) + (int(rng.choice([128, 255, 255, 255])),)
+        shape = rng.integers(0, 3)
+        if shape == 0:
+            draw.ellipse((x0, y0, x1, y1), fill=color)
+        elif shape == 1:
+            draw.rectangle((x0, y0, x1, y1), fill=color)
+        else:
+            draw.line((x0, y0, x1, y1), fill=color, width=max(1, size // 16))
+    buffer = BytesIO()
+    img.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+def color_drift(colors, proportions, reference):
+    """
+    How far off colors are from the reference colors, the OKLab distance from every color to the closest
+    reference color, weighted by how much of the emoji it covers (0 when every color is in the reference too)
+    """
+    lab = srgb_to_oklab(colors.astype(np.float32))
+    reference_lab = srgb_to_oklab(reference.astype(np.float32))
+    distances = np.linalg.norm(lab[:, None] - reference_lab[None], axis=-1).min(axis=1)
+    return float(distances @ proportions / max(float(proportions.sum()), 1e-6))
+
+def nearest(queries, palette):
+    """Index of the closest palette color (both OKLab) for every query"""
+    return np.concatenate([
+        np.argmin(np.sum((queries[start:start + MATCH_CHUNK, None] - palette[None]) ** 2, axis=2), axis=1)
+        for start in range(0, len(queries), MATCH_CHUNK)
+    ])
+
+def run(items, analysis_size, analysis_samples):
+    start = time.perf_counter()
+    results = []
+    for chunk in range(0, len(items), ANALYSIS_CHUNK_SIZE):
+        results += extract_emoji_colors_batch(items[chunk:chunk + ANALYSIS_CHUNK_SIZE], BACKGROUND_RGB,
+                                              analysis_size, analysis_samples)
+    return time.perf_counter() - start, {name: (colors, proportions) for name, colors, proportions, *_ in results}
+
+def main(count=512, size=128, query_count=20000):
+    rng = np.random.default_rng(0)
+    items = [(f"emoji_{i}", make_emoji(rng, size)) for i in range(count)]
+    names = [name for name, _ in items]
+    # Matching uses the dominant (first) color of every emoji
+    queries = srgb_to_oklab(rng.integers(0, 256, (query_count, 3)).astype(np.float32))
+
+    reference_seconds, reference = run(items, None, None)
+    reference_palette = srgb_to_oklab(np.array([reference[name][0][0] for name in names], dtype=np.float32))
+    reference_match = nearest(queries, reference_palette)
+    reference_distance = np.linalg.norm(queries - reference_palette[reference_match], axis=1)
+
+    print(f"{count} synthetic {size}x{size} emojis, {query_count} random colors to match")
+    print(f"{'setting':>13} {'ms/emoji':>9} {'speedup':>8} {'drift':>7} {'changed':>8} {'regret':>8}")
+    print(f"{'full':>13} {1000 * reference_seconds / count:>9.2f} {1.0:>7.1f}x {0:>7.4f} {0:>7.1%} {0:>8.5f}")
+    kmeans = EmojiFeatures.batched_kmeans
+    for label, analysis_size, analysis_samples in SETTINGS:
+        if label == "full, seed 1":
+            EmojiFeatures.batched_kmeans = partial(kmeans, seed=1)
+        try:
+            seconds, results = run(items, analysis_size, analysis_samples)
+        finally:
+            EmojiFeatures.batched_kmeans = kmeans
+        drift = np.mean([color_drift(*results[name], reference[name][0]) for name in names])
+        palette = srgb_to_oklab(np.array([results[name][0][0] for name in names], dtype=np.float32))
+        match = nearest(queries, palette)
+        # Distance to the emoji as it really looks (the reference colors), compared to the best we could have had
+        regret = np.linalg.norm(queries - reference_palette[match], axis=1) - reference_distance
+        print(f"{label:>13} {1000 * seconds / count:>9.2f} {reference_seconds / seconds:>7.1f}x {drift:>7.4f} "
+              f"{np.mean(match != reference_match):>7.1%} {regret.mean():>8.5f}")
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:4]))
@@ -0,0 +1,176 @@
+import time
+import asyncio
+import threading
+import unittest
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from DownloadScheduler import DownloadScheduler
+
+#
+#   DownloadScheduler against a local stand-in for the emoji CDN
+#   The server answers every path with its own bytes, except for the statuses queued up for it in responses
+#
+
+class StandInServer:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.responses = {}     # path -> [(status, headers), ...] returned (in order) before it finally gives a 200
+        self.requests = []      # (time, path, status) of every request
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with server.lock:
+                    queued = server.responses.get(self.path)
+                    status, headers = queued.pop(0) if queued else (200, {})
+                    server.requests.append((time.monotonic(), self.path, status))
+                body = self.path.encode("utf-8") if status == 200 else b""
+                self.send_response(status)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def url(self, path):
+        return f"http://127.0.0.1:{self.httpd.server_address[1]}{path}"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+def download(scheduler, urls):
+    results = {}
+    def on_complete(name, url, result):
+        assert name not in results, f"{name} completed twice"
+        results[name] = result
+    stats = asyncio.run(scheduler.download_all(urls, on_complete))
+    return results, stats
+
+class DownloadSchedulerServerTest(unittest.TestCase):
+    def test_retries_rate_limited_and_failing_urls_until_they_download(self):
+        with StandInServer() as server:
+            urls = {f"emoji_{i}": server.url(f"/emoji_{i}.png") for i in range(40)}
+            for i in range(0, 40, 4):
+                server.responses[f"/emoji_{i}.png"] = [(429, {"Retry-After": "0.1"})]
+            for i in range(1, 40, 4):
+                server.responses[f"/emoji_{i}.png"] = [(503, {}), (503, {})]
+
+            scheduler = DownloadScheduler(initial_concurrency=4, max_concurrency=8, base_backoff=0.01, max_backoff=0.05)
+            results, stats = download(scheduler, urls)
+
+        self.assertEqual(set(results), set(urls))
+        for name, result in results.items():
+            self.assertIsNotNone(result, name)
+            self.assertEqual(result.status, 200)
+            self.assertEqual(result.data, f"/{name}.png".encode("utf-8"))
+        self.assertEqual(stats.succeeded, 40)
+        self.assertEqual(stats.failed, 0)
+        self.assertEqual(stats.rate_limited, 10)
+        self.assertEqual(stats.server_errors, 20)
+        self.assertEqual(stats.retries, 30)
+
+    def test_retry_after_pauses_every_request(self):
+        with StandInServer() as server:
+            urls = {f"emoji_{i}": server.url(f"/emoji_{i}.png") for i in range(6)}
+            server.responses["/emoji_0.png"] = [(429, {"Retry-After": "0.5"})]
+
+            # One request at a time, so every request after the 429 was sent after we saw it
+            scheduler = DownloadScheduler(initial_concurrency=1, max_concurrency=1, base_backoff=0.01, max_backoff=0.01)
+            results, _ = download(scheduler, urls)
+            requests = list(server.requests)
+
+        self.assertTrue(all(result is not None for result in results.values()))
+        limited_at = next(when for when, _, status in requests if status == 429)
+        after = [when for when, _, _ in requests if when > limited_at]
+        self.assertEqual(len(after), 6)
+        self.assertGreaterEqual(min(after) - limited_at, 0.45)
+
+    def test_gives_up_after_max_retries(self):
+        with StandInServer() as server:
+            urls = {"gone": server.url("/gone.png"), "broken": server.url("/broken.png"), "fine": server.url("/fine.png")}
+            server.responses["/gone.png"] = [(404, {})]
+            server.responses["/broken.png"] = [(500, {})] * 10
+
+            scheduler = DownloadScheduler(max_retries=2, base_backoff=0.01, max_backoff=0.01)
+            results, stats = download(scheduler, urls)
+            requests = list(server.requests)
+
+        self.assertIsNone(results["gone"])
+        self.assertIsNone(results["broken"])
+        self.assertEqual(results["fine"].status, 200)
+        # 404 isn't worth retrying, 500 is (but only max_retries times)
+        self.assertEqual(sum(1 for _, path, _ in requests if path == "/gone.png"), 1)
+        self.assertEqual(sum(1 for _, path, _ in requests if path == "/broken.png"), 3)
+        self.assertEqual(stats.failed, 2)
+
+class FakeLoop:
+    def __init__(self):
+        self.now = 100.0
+
+    def time(self):
+        return self.now
+
+class DownloadSchedulerAimdTest(unittest.TestCase):
+    def make_scheduler(self, **kwargs):
+        scheduler = DownloadScheduler(**kwargs)
+        scheduler._loop = FakeLoop()
+        scheduler._last_decrease = 0.0
+        scheduler._successes_in_window = 0
+        scheduler._pause_until = 0.0
+        scheduler._slot_freed = asyncio.Event()
+        return scheduler
+
+    def test_one_more_slot_per_window_of_successes(self):
+        scheduler = self.make_scheduler(initial_concurrency=4, max_concurrency=6)
+        for _ in range(3):
+            scheduler._on_success()
+        self.assertEqual(scheduler.concurrency, 4)
+        scheduler._on_success()
+        self.assertEqual(scheduler.concurrency, 5)
+        for _ in range(5 + 6 + 6):
+            scheduler._on_success()
+        self.assertEqual(scheduler.concurrency, 6)
+
+    def test_congestion_halves_once_per_burst(self):
+        scheduler = self.make_scheduler(initial_concurrency=16, min_concurrency=3)
+        scheduler._on_congestion(None)
+        self.assertEqual(scheduler.concurrency, 8)
+        # The rest of the burst (requests that were already in flight) doesn't halve it again
+        scheduler._loop.now += 0.5
+        scheduler._on_congestion(None)
+        self.assertEqual(scheduler.concurrency, 8)
+        scheduler._loop.now += 1.0
+        scheduler._on_congestion(None)
+        self.assertEqual(scheduler.concurrency, 4)
+        scheduler._loop.now += 1.5
+        scheduler._on_congestion(None)
+        self.assertEqual(scheduler.concurrency, 3)
+
+    def test_retry_after_sets_the_pause(self):
+        scheduler = self.make_scheduler()
+        scheduler._on_congestion(2.0)
+        self.assertEqual(scheduler._pause_until, 102.0)
+        # A shorter Retry-After never cuts an existing pause short
+        scheduler._on_congestion(1.0)
+        self.assertEqual(scheduler._pause_until, 102.0)
+
+    def test_parse_retry_after(self):
+        self.assertEqual(DownloadScheduler.parse_retry_after("3"), 3.0)
+        self.assertEqual(DownloadScheduler.parse_retry_after("-1"), 0.0)
+        self.assertIsNone(DownloadScheduler.parse_retry_after(None))
+        self.assertIsNone(DownloadScheduler.parse_retry_after("soon"))
+        self.assertEqual(DownloadScheduler.parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT"), 0.0)
+
+if __name__ == "__main__":
+    unittest.main()
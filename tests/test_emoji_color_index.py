@@ -0,0 +1,56 @@
+import unittest
+import numpy as np
+
+from EmojiColorIndex import EmojiColorIndex
+from ColorSpace import rgb_to_match_features, srgb_to_oklab
+
+def brute_force(points, queries, k):
+    distances = np.linalg.norm(queries[:, None, :] - points[None, :, :], axis=2)
+    order = np.argsort(distances, axis=1, kind="stable")[:, :k]
+    return np.take_along_axis(distances, order, axis=1), order
+
+class EmojiColorIndexTest(unittest.TestCase):
+    def check(self, points, queries, k, leaf_size=32):
+        index = EmojiColorIndex(points, leaf_size=leaf_size)
+        distances, indices = index.query(queries, k=k)
+        expected_distances, expected_indices = brute_force(points, queries, min(k, len(points)))
+        np.testing.assert_allclose(distances, expected_distances, rtol=1e-4, atol=1e-5)
+        np.testing.assert_array_equal(indices, expected_indices)
+
+    def test_matches_brute_force_on_emoji_features(self):
+        rng = np.random.default_rng(0)
+        colors = rng.integers(0, 256, (3000, 3))
+        queries = rng.integers(0, 256, (500, 3))
+        for k in (1, 5, 16):
+            self.check(rgb_to_match_features(colors), rgb_to_match_features(queries), k)
+            self.check(srgb_to_oklab(colors), srgb_to_oklab(queries), k)
+
+    def test_small_leaves_and_more_neighbours_than_points(self):
+        rng = np.random.default_rng(1)
+        points = rng.random((50, 3)).astype(np.float32)
+        queries = rng.random((20, 3)).astype(np.float32)
+        self.check(points, queries, 1, leaf_size=1)
+        self.check(points, queries, 7, leaf_size=4)
+        self.check(points, queries, 80, leaf_size=8)
+
+    def test_clustered_points(self):
+        # Lots of (nearly) identical colors, like emoji sets with many variants of the same emoji
+        rng = np.random.default_rng(2)
+        centers = rng.random((10, 3)).astype(np.float32)
+        points = np.repeat(centers, 100, axis=0) + rng.normal(0, 1e-3, (1000, 3)).astype(np.float32)
+        queries = rng.random((100, 3)).astype(np.float32)
+        self.check(points, queries, 3)
+
+    def test_survives_to_dict(self):
+        rng = np.random.default_rng(3)
+        points = rng.random((200, 4)).astype(np.float32)
+        queries = rng.random((30, 4)).astype(np.float32)
+        index = EmojiColorIndex.from_dict(EmojiColorIndex(points).to_dict())
+        np.testing.assert_array_equal(index.query(queries, k=4)[1], brute_force(points, queries, 4)[1])
+
+    def test_empty_index(self):
+        with self.assertRaises(ValueError):
+            EmojiColorIndex(np.zeros((0, 3), dtype=np.float32)).query(np.zeros((1, 3), dtype=np.float32))
+
+if __name__ == "__main__":
+    unittest.main()
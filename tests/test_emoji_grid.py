@@ -0,0 +1,41 @@
+import unittest
+import numpy as np
+
+from EmojiGrid import EmojiGrid
+
+class EmojiGridTest(unittest.TestCase):
+    def test_remove_index_moves_higher_indices_down(self):
+        grid = EmojiGrid.from_list([[0, 1, 2], [3, 2, 4]])
+        grid.remove_index(2)
+        self.assertEqual(grid.tolist(), [[0, 1, 0], [2, 0, 3]])
+
+    def test_remove_index_with_replacement(self):
+        grid = EmojiGrid.from_list([[0, 1, 2], [3, 2, 1]])
+        grid.remove_index(1, replacement=2)
+        self.assertEqual(grid.tolist(), [[0, 2, 1], [2, 1, 2]])
+
+    def test_remove_index_that_is_not_in_the_grid(self):
+        grid = EmojiGrid.from_list([[0, 1], [1, 0]])
+        grid.remove_index(5)
+        self.assertEqual(grid.tolist(), [[0, 1], [1, 0]])
+        grid.remove_index(0)
+        self.assertEqual(grid.tolist(), [[0, 0], [0, 0]])
+
+    def test_remove_index_matches_removing_from_the_palette(self):
+        rng = np.random.default_rng(0)
+        palette = [f":emoji_{i}:" for i in range(8)]
+        grid = EmojiGrid.from_list(rng.integers(0, 8, (6, 7)).tolist())
+        names = [[palette[index] for index in row] for row in grid.tolist()]
+
+        grid.remove_index(3)
+        del palette[3]
+        expected = [[palette[0] if name == ":emoji_3:" else name for name in row] for row in names]
+        self.assertEqual([[palette[index] for index in row] for row in grid.tolist()], expected)
+
+    def test_resize_keeps_the_top_left(self):
+        grid = EmojiGrid.from_list([[1, 2], [3, 4]])
+        grid.resize(3, 1)
+        self.assertEqual(grid.tolist(), [[1], [3], [0]])
+
+if __name__ == "__main__":
+    unittest.main()